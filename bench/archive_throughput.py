@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Download of a many-file share: one streamed tar over HTTP vs per-file RETR over FTP (FTP part needs pyftpdlib)"""
+
+import argparse
+import ftplib
+import http.client
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tbot'))
+
+from httpshare import HTTPDrop
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_tree(root, files, size, per_dir=500):
+    """Returns the list of relative file paths"""
+    paths = []
+    block = os.urandom(size)
+    for i in range(files):
+        rel = f'Disc {i // per_dir:03}/Track {i:05}.flac'
+        if i % per_dir == 0:
+            os.makedirs(os.path.join(root, os.path.dirname(rel)))
+        with open(os.path.join(root, rel), 'wb') as f:
+            f.write(block)
+        paths.append(rel)
+    return paths
+
+
+def http_archive(root):
+    port = free_port()
+    drop = HTTPDrop(('127.0.0.1', port))
+    url = drop.share(root, False, 'bench')
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        start = time.perf_counter()
+        conn.request('GET', '/' + url.split('/', 3)[3] + '?archive')
+        response = conn.getresponse()
+        received = 0
+        while True:
+            chunk = response.read(2**20)
+            if not chunk:
+                break
+            received += len(chunk)
+        return received, time.perf_counter() - start
+    finally:
+        drop.force_stop()
+
+
+def ftp_per_file(root, paths):
+    from ftp import FTPDrop
+    drop = FTPDrop(('127.0.0.1', 0), 'threaded')
+    login, password = drop.share(root, False, 'bench')
+    while drop.server is None:  # server thread is started by share(), the port is known once it is bound
+        time.sleep(0.01)
+    port = drop.server.address[1]
+    received = 0
+
+    def count(block):
+        nonlocal received
+        received += len(block)
+
+    try:
+        ftp = ftplib.FTP()
+        ftp.connect('127.0.0.1', port, timeout=60)
+        ftp.login(login, password)
+        start = time.perf_counter()
+        for rel in paths:
+            ftp.retrbinary(f'RETR {rel}', count, blocksize=65536)
+        elapsed = time.perf_counter() - start
+        ftp.quit()
+        return received, elapsed
+    finally:
+        drop.force_stop()
+
+
+def report(name, files, received, elapsed):
+    print(f'{name:22} {received / 2**20:8.1f} MB in {elapsed:6.2f} s: {received / elapsed / 2**20:8.1f} MB/s, {files / elapsed:8.0f} files/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=16384, help='Size of each file (bytes)')
+    parser.add_argument('--no-ftp', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'Album collection')
+        paths = make_tree(root, args.files, args.size)
+
+        received, elapsed = http_archive(root)
+        report('HTTP tar stream', args.files, received, elapsed)
+
+        if args.no_ftp:
+            return
+        try:
+            received, elapsed = ftp_per_file(root, paths)
+        except (ImportError, NameError):  # ftp.py can't be imported without pyftpdlib
+            print('pyftpdlib is not installed, skipping FTP', file=sys.stderr)
+            return
+        report('FTP RETR per file', args.files, received, elapsed)
+
+
+if __name__ == '__main__':
+    main()
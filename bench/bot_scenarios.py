@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Scripted scenarios driving the real TBot handlers and jobs against local stand-ins for transmission-daemon
+(fake_transmission.py) and the Bot API (FakeBotAPI from webhook_latency.py).
+
+Updates are passed to the dispatcher directly (no polling), jobs are called directly, so latencies include
+handler code, transmission RPC and Bot API round trips, and DB writes. Scenarios:
+update_db over the whole library (cold and after simulated activity), list paging, torrent info refresh,
+bulk adds of magnet links, paging of own torrents, the disk guard check, check_downloads with finished torrents and the notification fan-out.
+
+For each scenario p50 / p99 / max latency and RPC / Bot API call counts are printed, one line per scenario,
+so regressions show up in a diff of two runs (use the same --seed).
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tbot'))
+
+from telegram import Update
+
+import strings
+from bot import TBot
+from fake_transmission import FakeTransmission, infohash
+from webhook_latency import BOT_USER, FakeBotAPI
+
+
+ADMIN = 1000
+FIRST_USER = 2000
+DIR_BUTTON = next(button for button, dirname in strings.dir_buttons.items() if dirname)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Harness():
+    def __init__(self, workdir, fake, api, args):
+        config = {
+            'token': '123456:bench', 'password': 'bench', 'admins': [ADMIN],
+            'bot_api_url': f'http://127.0.0.1:{api.port}/bot',
+            'rootdir': workdir, 'reserved_space': 0,
+            'client_cfg': {'host': '127.0.0.1', 'port': fake.port},
+            'rpc': {'pool_size': 4, 'timeout': 60},
+            'cache': {'ttl': args.cache_ttl, 'incremental': args.incremental},
+            'notifications': {'global_rate': args.global_rate, 'chat_rate': args.chat_rate, 'digest_window': 0},
+            'profiling': {'slow_threshold': 0},
+            'ftp': {'enabled': False},
+        }
+        cfg_path = os.path.join(workdir, 'config.yaml')
+        with open(cfg_path, 'w') as f:
+            yaml.safe_dump(config, f)
+        db_path = os.path.join(workdir, 'data.sqlite' if args.db_backend == 'sqlite' else 'data.db')
+        self.bot = TBot(cfg_path, db_path, args.db_backend)
+        self.bot.get_disk_stats = lambda: (0, 10**18)  # the synthetic download rates would trigger the disk guard
+        self.fake = fake
+        self.api = api
+        self.errors = []
+        self.bot.dispatcher.add_error_handler(lambda update, context: self.errors.append(context.error))
+        self._ids = itertools.count(1)
+
+    def _user(self, uid):
+        return {'id': uid, 'is_bot': False, 'first_name': 'bench'}
+
+    def _message(self, uid, text, sender):
+        return {'message_id': next(self._ids), 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'}, 'from': sender, 'text': text}
+
+    def message(self, uid, text):
+        message = self._message(uid, text, self._user(uid))
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self.process({'update_id': next(self._ids), 'message': message})
+
+    def callback(self, uid, data):
+        return self.process({'update_id': next(self._ids), 'callback_query': {
+            'id': str(next(self._ids)), 'from': self._user(uid), 'chat_instance': str(uid), 'data': data,
+            'message': self._message(uid, 'menu', BOT_USER)
+        }})
+
+    def process(self, data):
+        update = Update.de_json(data, self.bot.updater.bot)
+        start = time.perf_counter()
+        self.bot.dispatcher.process_update(update)
+        return time.perf_counter() - start
+
+    def job(self, callback):
+        start = time.perf_counter()
+        callback(SimpleNamespace(job=None, bot=self.bot.updater.bot))
+        return time.perf_counter() - start
+
+    def close(self):
+        self.bot.ingest.shutdown()
+        self.bot.db.close()
+
+
+class Report():
+    def __init__(self, harness):
+        self.harness = harness
+
+    def run(self, name, calls):
+        """Runs the callables (each returns its latency) and prints a line for the scenario"""
+        fake, api = self.harness.fake, self.harness.api
+        rpc_before, api_before, errors_before = Counter(fake.calls), Counter(api.calls), len(self.harness.errors)
+        latencies = sorted(call() for call in calls)
+        rpc = fake.calls - rpc_before
+        bot_api = api.calls - api_before
+        errors = len(self.harness.errors) - errors_before
+        self.line(name, latencies, rpc, bot_api, errors)
+        return latencies
+
+    @staticmethod
+    def line(name, latencies, rpc, bot_api, errors=0):
+        methods = ' '.join(f'{method}={count}' for method, count in sorted(rpc.items()))
+        print(f'{name:18} n={len(latencies):<5} p50 {percentile(latencies, 0.5) * 1000:9.1f} ms  p99 {percentile(latencies, 0.99) * 1000:9.1f} ms  '
+              f'max {latencies[-1] * 1000:9.1f} ms  RPC {sum(rpc.values()):<5} [{methods}]  API {sum(bot_api.values())}'
+              + (f'  ERRORS {errors}' if errors else ''), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--torrents', type=int, default=10000, help='Size of the synthetic library')
+    parser.add_argument('--requests', type=int, default=200, help='Number of updates in paging / info scenarios')
+    parser.add_argument('--users', type=int, default=20, help='Number of users adding torrents')
+    parser.add_argument('--batch', type=int, default=5, help='Number of magnet links in each bulk add')
+    parser.add_argument('--rounds', type=int, default=5, help='Number of update_db runs after simulated activity')
+    parser.add_argument('--db-backend', choices=['shelve', 'sqlite'], default='shelve')
+    parser.add_argument('--incremental', action='store_true', help='Incremental torrent cache (cache.incremental)')
+    parser.add_argument('--cache-ttl', type=float, default=5, help='cache.ttl, use 0 to measure uncached paths')
+    parser.add_argument('--global-rate', type=float, default=25, help='Notification rate limit for all chats (messages/s)')
+    parser.add_argument('--chat-rate', type=float, default=1, help='Notification rate limit for a single chat (messages/s)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    rnd = random.Random(args.seed)
+    started = time.perf_counter()
+    fake = FakeTransmission(args.torrents, seed=args.seed)
+    api = FakeBotAPI(0)
+    print(f'{args.torrents} torrents ({time.perf_counter() - started:.1f} s to generate), {args.db_backend} DB, '
+          f'{"incremental" if args.incremental else "full"} cache refresh, ttl {args.cache_ttl} s', flush=True)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        harness = Harness(workdir, fake, api, args)
+        bot = harness.bot
+        users = list(range(FIRST_USER, FIRST_USER + args.users))
+        for uid in [ADMIN] + users:
+            bot.db.whitelist_user(uid)
+        report = Report(harness)
+
+        report.run('update_db cold', [lambda: harness.job(bot.update_db)])
+
+        def page():
+            return harness.callback(ADMIN, f'offset={rnd.randrange(0, args.torrents, 10)},all')
+        report.run('all_torrents', [lambda: harness.message(ADMIN, '/all_torrents')])
+        report.run('list paging', [page] * args.requests)
+
+        hashes = [infohash(i) for i in range(args.torrents)]
+
+        def info():
+            return harness.callback(ADMIN, f'hash={rnd.choice(hashes)},0,all')
+        report.run('info refresh', [info] * args.requests)
+
+        added = [infohash(i, 'added') for i in range(len(users) * args.batch)]
+        links = ['\n'.join(f'magnet:?xt=urn:btih:{t_hash}&dn=Bench+{i}' for i, t_hash in enumerate(added[n * args.batch:(n + 1) * args.batch]))
+                 for n in range(len(users))]
+        report.run('send magnets', [lambda uid=uid, text=text: harness.message(uid, text) for uid, text in zip(users, links)])
+
+        def bulk_add(uid):  # the reply is sent from the ingestion pool, measured until the batch is done
+            start = time.perf_counter()
+            harness.message(uid, DIR_BUTTON)
+            while bot.ingest.pending():
+                time.sleep(0.001)
+            return time.perf_counter() - start
+        report.run('bulk add', [lambda uid=uid: bulk_add(uid) for uid in users])
+        owned = sum(len(bot.db.owned_torrents(uid)) for uid in users)
+        if owned != len(added):
+            print(f'Only {owned} of {len(added)} torrents were added', file=sys.stderr)
+
+        report.run('my_torrents', [lambda uid=uid: harness.message(uid, '/my_torrents') for uid in users])
+
+        def tick_and_update():
+            fake.tick(0.01)
+            return harness.job(bot.update_db)
+        report.run('update_db warm', [tick_and_update] * args.rounds)
+
+        report.run('disk check', [lambda: harness.job(bot._check_disk)] * args.rounds)
+
+        fake.finish(added)
+        bot.torrents.invalidate()  # the job runs less often than the cache ttl
+        sent_before = api.calls['sendMessage']
+        report.run('check_downloads', [lambda: harness.job(bot.check_downloads)])
+        start = time.perf_counter()
+        while bot.notifier.depth() and time.perf_counter() - start < 600:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        sent = api.calls['sendMessage'] - sent_before
+        print(f'{"notify fan-out":18} {sent} messages to {len(users)} chats in {elapsed:.2f} s ({sent / elapsed if elapsed else 0:.1f} messages/s), '
+              f'{bot.notifier.failed} failed', flush=True)
+
+        harness.close()
+        if harness.errors:
+            print(f'{len(harness.errors)} handler errors, first: {harness.errors[0]!r}', file=sys.stderr)
+    fake.close()
+    api.close()
+
+
+if __name__ == '__main__':
+    main()
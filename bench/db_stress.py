@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Stress test for BotDB thread-safety: concurrent writers, finishers and lock-free readers.
+
+Checks that no reader fails, every torrent is marked finished exactly once
+(check-then-act under db.transaction()) and the final state matches what writers did.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tbot'))
+
+from db import BotDB
+from db_sqlite import SqliteBotDB
+
+
+def thash(writer, i):
+    return f'{writer:08x}{i:032x}'
+
+
+def writer(db, n, per_writer, expected, errors):
+    rnd = random.Random(n)
+    try:
+        alive = []
+        for i in range(per_writer):
+            t_hash = thash(n, i)
+            with db.transaction():
+                if not db.has_torrent(t_hash):
+                    db.add_torrent(t_hash, n, active=True)
+            alive.append(t_hash)
+            if rnd.random() < 0.3:
+                db.remove_torrent(alive.pop(rnd.randrange(len(alive))))
+        expected[n] = set(alive)
+    except Exception as e:
+        errors.append(('writer', repr(e)))
+
+
+def finisher(db, stop, finished, errors):
+    try:
+        while not stop.is_set():
+            with db.transaction():
+                active = db.get_active()
+                batch = list(active)[:50]
+                db.mark_finished(batch)
+                finished.update(batch)
+    except Exception as e:
+        errors.append(('finisher', repr(e)))
+
+
+def reader(db, stop, writers, counter, errors):
+    rnd = random.Random()
+    try:
+        while not stop.is_set():
+            db.get_active()
+            db.owned_torrents(rnd.randrange(writers))
+            hashes = db.all_torrents()
+            for t_hash in hashes[:20]:
+                try:
+                    db.get_owner(t_hash)
+                except KeyError:  # removed concurrently
+                    pass
+            counter[0] += 1
+            time.sleep(0.0005)
+    except Exception as e:
+        errors.append(('reader', repr(e)))
+
+
+def run(backend, path, writers, readers, finishers, per_writer):
+    db = SqliteBotDB(path) if backend == 'sqlite' else BotDB(path)
+    stop = threading.Event()
+    expected = {}
+    errors = []
+    finished = Counter()
+    reads = [0]
+
+    background = [threading.Thread(target=reader, args=(db, stop, writers, reads, errors)) for _ in range(readers)]
+    background += [threading.Thread(target=finisher, args=(db, stop, finished, errors)) for _ in range(finishers)]
+    workers = [threading.Thread(target=writer, args=(db, n, per_writer, expected, errors)) for n in range(writers)]
+
+    started = time.perf_counter()
+    for t in background + workers:
+        t.start()
+    for t in workers:
+        t.join()
+    # let finishers drain the active set
+    while db.get_active() and not errors:
+        time.sleep(0.01)
+    stop.set()
+    for t in background:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    for n in range(writers):
+        if set(db.owned_torrents(n)) != expected.get(n, set()):
+            errors.append(('state', f'owned torrents of writer {n} differ'))
+    if set(db.all_torrents()) != set().union(*expected.values()):
+        errors.append(('state', 'torrent set differs'))
+    duplicates = [t_hash for t_hash, count in finished.items() if count > 1]
+    if duplicates:
+        errors.append(('state', f'{len(duplicates)} torrents were finished more than once'))
+    db.close()
+
+    ops = writers * per_writer
+    print(f'{backend}: {ops} adds, {reads[0]} read rounds, {sum(finished.values())} finished in {elapsed:.2f}s')
+    for kind, msg in errors[:20]:
+        print(f'  {kind}: {msg}')
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backend', choices=['shelve', 'sqlite', 'all'], default='all')
+    parser.add_argument('--writers', type=int, default=16)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--finishers', type=int, default=4)
+    parser.add_argument('-n', type=int, default=100, help='Torrents added by each writer')
+    args = parser.parse_args()
+
+    backends = ['shelve', 'sqlite'] if args.backend == 'all' else [args.backend]
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in backends:
+            ok &= run(backend, os.path.join(tmp, f'stress_{backend}.db'), args.writers, args.readers, args.finishers, args.n)
+    print('OK' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Local stand-in for transmission-daemon's RPC with a synthetic library of 10k-100k torrents.
+
+Implements the methods used by the bot (session-get/set/stats, torrent-get/add/start/stop/remove/set, free-space),
+the X-Transmission-Session-Id 409 handshake, and "recently-active" queries with removed ids.
+Only the requested fields are returned, with realistic values, so response sizes match a real daemon.
+Counts calls by method. Used by bot_scenarios.py, can also be run standalone for a manually started bot.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+STOPPED, DOWNLOAD_PENDING, DOWNLOADING, SEEDING = 0, 3, 4, 6
+RECENTLY_ACTIVE = 60  # seconds, as in transmission
+DOWNLOAD_DIR = '/mnt/data/transmission_downloads'
+
+SHOWS = ['The.Expanse', 'Severance', 'Dark', 'Better.Call.Saul', 'The.Bear', 'Chernobyl', 'Fargo', 'Succession', 'Andor', 'Mr.Robot']
+MOVIES = ['Arrival', 'Dune.Part.Two', 'Blade.Runner.2049', 'Heat', 'Alien', 'Parasite', 'Oppenheimer', 'Sicario', 'Drive', 'Her']
+ARTISTS = ['Radiohead', 'Boards of Canada', 'Massive Attack', 'Portishead', 'Aphex Twin', 'Björk', 'Кино', 'Земфира']
+GROUPS = ['NTb', 'FLUX', 'SPARKS', 'GECKOS', 'RARBG', 'TEPES', 'HONE', 'EDITH']
+
+
+def synthetic_name(rnd, i):
+    kind = rnd.random()
+    if kind < 0.5:
+        return (f'{rnd.choice(SHOWS)}.S{rnd.randint(1, 9):02}E{rnd.randint(1, 24):02}.{rnd.choice(["720p", "1080p", "2160p"])}'
+                f'.{rnd.choice(["WEB-DL", "WEBRip", "BluRay"])}.{rnd.choice(["x264", "x265", "H.264"])}-{rnd.choice(GROUPS)} [{i}]')
+    if kind < 0.8:
+        return f'{rnd.choice(MOVIES)}.{rnd.randint(1970, 2025)}.{rnd.choice(["1080p", "2160p"])}.BluRay.x264-{rnd.choice(GROUPS)} [{i}]'
+    return f'{rnd.choice(ARTISTS)} - Album {i} ({rnd.randint(1970, 2025)}) [FLAC]'
+
+
+def infohash(i, salt='bench'):
+    return hashlib.sha1(f'{salt}{i}'.encode()).hexdigest()
+
+
+class FakeTransmission():
+    def __init__(self, torrents=10000, port=0, seed=0, session_id=None):
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.torrents = {}  # id: fields
+        self.hashes = {}  # hash: id
+        self.removed = []  # (time, id)
+        self.next_id = 1
+        self.calls = Counter()
+        self.handshakes = 0
+        self.session_id = session_id or secrets.token_hex(16)
+        self.session = {
+            'rpc-version': 17, 'rpc-version-minimum': 14, 'version': '4.0.5 (a6fe2a64aa)', 'download-dir': DOWNLOAD_DIR,
+            'speed-limit-down': 100, 'speed-limit-down-enabled': False, 'speed-limit-up': 100, 'speed-limit-up-enabled': False,
+            'alt-speed-enabled': False, 'peer-limit-global': 200, 'seedRatioLimited': False, 'start-added-torrents': True,
+        }
+        now = time.time()
+        for i in range(torrents):
+            self._add(synthetic_name(self.rnd, i), infohash(i), now - self.rnd.uniform(3600, 86400 * 365), initial=True)
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, as the bot's Transport expects
+            disable_nagle_algorithm = True  # headers and body are written separately, don't wait for delayed ACKs
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('X-Transmission-Session-Id') != fake.session_id:
+                    fake.handshakes += 1
+                    return self._reply(409, b'<h1>409: Conflict</h1>', {'X-Transmission-Session-Id': fake.session_id})
+                query = json.loads(body)
+                response = fake.call(query['method'], query.get('arguments') or {})
+                if 'tag' in query:
+                    response['tag'] = query['tag']
+                self._reply(200, json.dumps(response).encode(), {'Content-Type': 'application/json'})
+
+            def _reply(self, status, body, headers):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='FakeTransmission', daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _add(self, name, t_hash, added, initial=False):
+        rnd = self.rnd
+        size = int(rnd.lognormvariate(21, 1.5))  # median ~1.3 GB
+        state = rnd.random() if initial else 1.0
+        if state < 0.75:
+            status, left = SEEDING, 0
+        elif state < 0.85:
+            status, left = STOPPED, 0
+        elif state < 0.9:
+            status, left = STOPPED, rnd.randint(1, size)
+        elif state < 0.95:
+            status, left = DOWNLOAD_PENDING, size
+        else:
+            status, left = DOWNLOADING, rnd.randint(1, size)
+        t_id = self.next_id
+        self.next_id += 1
+        downloading = status == DOWNLOADING
+        self.torrents[t_id] = {
+            'id': t_id, 'hashString': t_hash, 'name': name, 'status': status,
+            'totalSize': size, 'sizeWhenDone': size, 'leftUntilDone': left, 'percentDone': 1 - left / size,
+            'rateDownload': rnd.randint(50000, 5000000) if downloading else 0,
+            'rateUpload': rnd.randint(0, 500000) if status in (SEEDING, DOWNLOADING) else 0,
+            'peersConnected': rnd.randint(1, 50) if status in (SEEDING, DOWNLOADING) else 0,
+            'peersSendingToUs': rnd.randint(1, 30) if downloading else 0,
+            'peersGettingFromUs': rnd.randint(0, 10) if status in (SEEDING, DOWNLOADING) else 0,
+            'uploadRatio': round(rnd.uniform(0, 5), 2) if left == 0 else 0.0,
+            'eta': rnd.randint(60, 36000) if downloading else -1,
+            'addedDate': int(added), 'activityDate': int(time.time() if downloading or not initial else added),
+            'doneDate': int(added) + 3600 if left == 0 else 0,
+            'downloadDir': DOWNLOAD_DIR, 'error': 0, 'errorString': '', 'isFinished': False,
+            'queuePosition': t_id, 'labels': [],
+        }
+        self.hashes[t_hash] = t_id
+        return self.torrents[t_id]
+
+    # simulation of daemon activity
+
+    def tick(self, fraction=0.01):
+        """Progress of a random fraction of the library, marks the touched torrents as recently active"""
+        now = int(time.time())
+        with self.lock:
+            ids = self.rnd.sample(list(self.torrents), max(1, int(len(self.torrents) * fraction)))
+            for t_id in ids:
+                t = self.torrents[t_id]
+                t['rateUpload'] = self.rnd.randint(0, 500000)
+                if t['leftUntilDone'] > 0 and t['status'] == DOWNLOADING:
+                    t['leftUntilDone'] = max(0, t['leftUntilDone'] - t['rateDownload'] * 30)
+                    t['percentDone'] = 1 - t['leftUntilDone'] / t['sizeWhenDone']
+                t['activityDate'] = now
+        return len(ids)
+
+    def finish(self, hashes):
+        """Completes the downloads (they become seeding)"""
+        now = int(time.time())
+        with self.lock:
+            for t_hash in hashes:
+                t = self.torrents[self.hashes[t_hash]]
+                t.update(status=SEEDING, leftUntilDone=0, percentDone=1.0, rateDownload=0, eta=-1, doneDate=now, activityDate=now)
+
+    def remove(self, hashes):
+        with self.lock:
+            self._remove([self.hashes[t_hash] for t_hash in hashes])
+
+    def _remove(self, ids):
+        now = time.time()
+        for t_id in ids:
+            t = self.torrents.pop(t_id, None)
+            if t is not None:
+                del self.hashes[t['hashString']]
+                self.removed.append((now, t_id))
+
+    # RPC
+
+    def _select(self, ids):
+        """ids - None (all), "recently-active", an id, a hash or a list of ids / hashes"""
+        if ids is None:
+            return list(self.torrents.values())
+        if ids == 'recently-active':
+            since = time.time() - RECENTLY_ACTIVE
+            return [t for t in self.torrents.values() if t['activityDate'] >= since]
+        if not isinstance(ids, list):
+            ids = [ids]
+        selected = []
+        for t_id in ids:
+            if isinstance(t_id, str):
+                t_id = self.hashes.get(t_id)
+            t = self.torrents.get(t_id)
+            if t is not None:
+                selected.append(t)
+        return selected
+
+    def call(self, method, args):
+        self.calls[method] += 1
+        handler = getattr(self, 'rpc_' + method.replace('-', '_'), None)
+        if handler is None:
+            return {'result': 'method name not recognized', 'arguments': {}}
+        with self.lock:
+            result = handler(args)
+        return {'result': 'success', 'arguments': result}
+
+    def rpc_session_get(self, args):
+        return dict(self.session)
+
+    def rpc_session_set(self, args):
+        self.session.update(args)
+        return {}
+
+    def rpc_session_stats(self, args):
+        active = sum(t['status'] in (DOWNLOADING, SEEDING) for t in self.torrents.values())
+        return {'torrentCount': len(self.torrents), 'activeTorrentCount': active, 'pausedTorrentCount': len(self.torrents) - active,
+                'downloadSpeed': sum(t['rateDownload'] for t in self.torrents.values()),
+                'uploadSpeed': sum(t['rateUpload'] for t in self.torrents.values())}
+
+    def rpc_free_space(self, args):
+        return {'path': args.get('path', DOWNLOAD_DIR), 'size-bytes': 2 * 10**12, 'total_size': 8 * 10**12}
+
+    def rpc_torrent_get(self, args):
+        fields = args.get('fields') or ['id']
+        ids = args.get('ids')
+        torrents = [{field: t[field] for field in fields if field in t} for t in self._select(ids)]
+        result = {'torrents': torrents}
+        if ids == 'recently-active':
+            since = time.time() - RECENTLY_ACTIVE
+            self.removed = [(when, t_id) for when, t_id in self.removed if when >= since]
+            result['removed'] = [t_id for _, t_id in self.removed]
+        return result
+
+    def rpc_torrent_add(self, args):
+        link = args.get('filename', '')
+        if link.startswith('magnet:'):
+            query = parse_qs(urlparse(link).query)
+            t_hash = query['xt'][0].rsplit(':', 1)[-1].lower()
+            name = query.get('dn', [t_hash])[0]
+        else:  # metainfo or an URL: a unique synthetic torrent
+            t_hash = hashlib.sha1((args.get('metainfo') or link).encode()).hexdigest()
+            name = synthetic_name(self.rnd, self.next_id)
+        if t_hash in self.hashes:
+            t = self.torrents[self.hashes[t_hash]]
+            return {'torrent-duplicate': {'id': t['id'], 'name': t['name'], 'hashString': t_hash}}
+        t = self._add(name, t_hash, time.time())
+        t.update(status=DOWNLOADING, leftUntilDone=t['sizeWhenDone'], percentDone=0.0, rateDownload=self.rnd.randint(50000, 5000000))
+        t['downloadDir'] = args.get('download-dir', DOWNLOAD_DIR)
+        return {'torrent-added': {'id': t['id'], 'name': name, 'hashString': t_hash}}
+
+    def _set_status(self, args, stop):
+        now = int(time.time())
+        for t in self._select(args.get('ids')):
+            if stop:
+                t.update(status=STOPPED, rateDownload=0, rateUpload=0, peersConnected=0, eta=-1)
+            else:
+                t['status'] = DOWNLOADING if t['leftUntilDone'] else SEEDING
+            t['activityDate'] = now
+        return {}
+
+    def rpc_torrent_start(self, args):
+        return self._set_status(args, stop=False)
+
+    rpc_torrent_start_now = rpc_torrent_start
+
+    def rpc_torrent_stop(self, args):
+        return self._set_status(args, stop=True)
+
+    def rpc_torrent_remove(self, args):
+        self._remove([t['id'] for t in self._select(args.get('ids'))])
+        return {}
+
+    def rpc_torrent_set(self, args):
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9091)
+    parser.add_argument('--torrents', type=int, default=10000, help='Size of the synthetic library')
+    parser.add_argument('--tick', type=float, default=30, help='Interval (in seconds) of simulated activity (0 - disabled)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeTransmission(args.torrents, args.port, args.seed)
+    print(f'Fake transmission with {args.torrents} torrents on http://127.0.0.1:{fake.port}/transmission/rpc', flush=True)
+    try:
+        while True:
+            time.sleep(args.tick or 3600)
+            if args.tick:
+                fake.tick()
+            print(f'RPC calls: {dict(fake.calls)}', flush=True)
+    except KeyboardInterrupt:
+        fake.close()
+
+
+if __name__ == '__main__':
+    main()
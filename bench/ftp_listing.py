@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""LIST / MLSD formatting and path validation of RestrictedFS vs pyftpdlib's AbstractedFS over a synthetic tree (needs pyftpdlib)"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tbot'))
+
+from ftp import ftp_available
+
+if ftp_available:
+    from pyftpdlib.filesystems import AbstractedFS
+    from ftp import RestrictedFS
+
+
+class CmdChannel():
+    use_gmt_times = True
+    unicode_errors = 'replace'
+
+
+def sorted_listing(fs, path):
+    # sorted in place like pyftpdlib's LIST, so a Listing keeps its stats
+    listing = fs.listdir(path)
+    listing.sort()
+    return listing
+
+
+def make_tree(root, entries, depth):
+    """A flat directory with `entries` files and subdirs, and a chain of `depth` nested dirs. Returns the deepest dir"""
+    flat = os.path.join(root, 'flat')
+    os.mkdir(flat)
+    for i in range(entries):
+        name = os.path.join(flat, f'Episode.{i:05}.mkv')
+        if i % 10 == 0:
+            os.mkdir(name[:-4])
+        else:
+            open(name, 'wb').close()
+    deep = root
+    for i in range(depth):
+        deep = os.path.join(deep, f'Season {i}')
+        os.mkdir(deep)
+    for i in range(100):
+        open(os.path.join(deep, f'file{i}.mkv'), 'wb').close()
+    return flat, deep
+
+
+def timed(fn, repeat, setup=None):
+    """Best time of fn(setup()) (setup is not timed)"""
+    best = float('inf')
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn() if setup is None else fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(fs_cls, root, flat, deep, repeat):
+    fs = fs_cls(root, CmdChannel())
+
+    def list_cmd():
+        for _ in fs.format_list(flat, sorted_listing(fs, flat)):
+            pass
+
+    def mlsd_cmd():
+        for _ in fs.format_mlsx(flat, fs.listdir(flat), 'elr', ['type', 'size', 'modify', 'perm', 'unique']):
+            pass
+
+    paths = [os.path.join(deep, name) for name in os.listdir(deep)] * 10
+
+    def validate():
+        for path in paths:
+            assert fs.validpath(path)
+
+    def format_list(listing):
+        for _ in fs.format_list(flat, listing):
+            pass
+
+    def format_mlsd(listing):
+        for _ in fs.format_mlsx(flat, listing, 'elr', ['type', 'size', 'modify', 'perm', 'unique']):
+            pass
+
+    # format_list / format_mlsx alone: AbstractedFS stats each entry there, RestrictedFS already did it in listdir
+    results = [timed(list_cmd, repeat), timed(mlsd_cmd, repeat), timed(validate, repeat) / len(paths) * 1e6,
+               timed(format_list, repeat, lambda: sorted_listing(fs, flat)), timed(format_mlsd, repeat, lambda: fs.listdir(flat))]
+    print(f'{fs_cls.__name__:14} LIST {results[0] * 1000:8.1f} ms   MLSD {results[1] * 1000:8.1f} ms   '
+          f'validpath {results[2]:6.1f} us/path   formatting only: LIST {results[3] * 1000:6.1f} ms  MLSD {results[4] * 1000:6.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=20000, help='Number of entries in the flat directory')
+    parser.add_argument('--depth', type=int, default=8, help='Depth of the nested directory chain')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if not ftp_available:
+        print('pyftpdlib is not installed', file=sys.stderr)
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.realpath(tmp)
+        flat, deep = make_tree(root, args.entries, args.depth)
+        for fs_cls in (AbstractedFS, RestrictedFS):
+            run(fs_cls, root, flat, deep, args.repeat)
+
+        # single-file share inside the large directory: LIST of the share root
+        shared = os.path.join(flat, 'Episode.00001.mkv')
+        fs = RestrictedFS(shared, CmdChannel())
+        elapsed = timed(lambda: list(fs.format_list(fs.root, fs.listdir(fs.root))), args.repeat)
+        print(f'RestrictedFS single-file share LIST {elapsed * 1000:.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Aggregate RETR throughput and server memory of FTPDrop engines with many concurrent clients (Linux only, needs pyftpdlib)"""
+
+import argparse
+import ftplib
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tbot'))
+
+from ftp import FTPDrop, ftp_available, ftp_engines
+
+
+def run_server(engine, path, max_cons, creds_queue):
+    logging.basicConfig(level=logging.WARNING)  # otherwise pyftpdlib logs every session
+    ftpd = FTPDrop(('127.0.0.1', 0), engine, max_cons=max_cons, max_cons_per_ip=max_cons)
+    creds = ftpd.share(path, False, 'bench')
+    while ftpd.server is None:  # server thread is started by share(), the port is known once it is bound
+        time.sleep(0.01)
+    creds_queue.put((ftpd.server.address[1], creds))
+    while True:
+        time.sleep(3600)
+
+
+def proc_status(pid):
+    """Returns (rss in KB, threads) of a process"""
+    rss = threads = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+def children(pid):
+    result = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    result.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return result
+
+
+class Sampler(threading.Thread):
+    """Peak RSS (server and its child processes, summed: pages shared after fork are counted in each) and thread count"""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak_rss = self.peak_threads = self.peak_procs = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.1):
+            rss = threads = procs = 0
+            for pid in [self.pid] + children(self.pid):
+                try:
+                    r, t = proc_status(pid)
+                except OSError:
+                    continue
+                rss += r
+                threads += t
+                procs += 1
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_threads = max(self.peak_threads, threads)
+            self.peak_procs = max(self.peak_procs, procs)
+
+
+def client(port, login, password, name, results, barrier):
+    received = 0
+
+    def count(block):
+        nonlocal received
+        received += len(block)
+
+    try:
+        ftp = ftplib.FTP()
+        ftp.connect('127.0.0.1', port, timeout=60)
+        ftp.login(login, password)
+        barrier.wait()
+        ftp.retrbinary(f'RETR {name}', count, blocksize=65536)
+        ftp.quit()
+        results.append(received)
+    except Exception as e:
+        barrier.abort()  # don't leave the others waiting
+        results.append(e)
+
+
+def bench(engine, clients, path):
+    creds_queue = multiprocessing.Queue()
+    # data channels are counted by max_cons too
+    server = multiprocessing.Process(target=run_server, args=(engine, path, 2 * clients + 10, creds_queue))  # not a daemon, multiprocess forks children
+    server.start()
+    try:
+        port, (login, password) = creds_queue.get(timeout=10)
+        idle_rss, idle_threads = proc_status(server.pid)
+        sampler = Sampler(server.pid)
+        sampler.start()
+
+        results = []
+        barrier = threading.Barrier(clients + 1)
+        threads = [threading.Thread(target=client, args=(port, login, password, Path(path).name, results, barrier)) for _ in range(clients)]
+        for t in threads:
+            t.start()
+        barrier.wait(timeout=60)  # all clients are logged in
+        start = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        sampler.stopped.set()
+        sampler.join()
+    finally:
+        server.terminate()
+        server.join()
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    total = sum(r for r in results if not isinstance(r, Exception))
+    print(f'{engine:12} {clients} clients: {total / elapsed / 2**20:8.1f} MB/s aggregate, {elapsed:.2f} s, '
+          f'server RSS {idle_rss / 1024:.1f} -> {sampler.peak_rss / 1024:.1f} MB, '
+          f'threads {idle_threads} -> {sampler.peak_threads}, processes {sampler.peak_procs}, errors {len(errors)}')
+    if errors:
+        print(f'    first error: {errors[0]!r}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--engine', choices=['all'] + sorted(ftp_engines()) if ftp_available else ['all'], default='all')
+    parser.add_argument('--clients', type=int, default=128, help='Number of concurrent RETR clients')
+    parser.add_argument('--size', type=int, default=32, help='Size of the shared file (MB)')
+    args = parser.parse_args()
+
+    if not ftp_available:
+        print('pyftpdlib is not installed', file=sys.stderr)
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'share.bin')
+        with open(path, 'wb') as f:
+            block = os.urandom(2**20)
+            for _ in range(args.size):
+                f.write(block)
+        engines = sorted(ftp_engines()) if args.engine == 'all' else [args.engine]
+        for engine in engines:
+            bench(engine, args.clients, path)
+
+
+if __name__ == '__main__':
+    main()
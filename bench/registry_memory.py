@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Memory usage of TorrentRegistry vs the old dict-of-sets layout of BotDB.
+
+Registry rows also have the size column used by quotas (8 bytes per torrent in memory and pickled),
+which the old layout never stored, so the figures published before it was added
+(147.9 bytes per torrent, 359 KB pickled at 10k torrents) are lower than what this prints now.
+"""
+
+import argparse
+import os
+import pickle
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tbot'))
+
+from registry import TorrentRegistry
+
+
+def synthetic(n, users, active_ratio):
+    rnd = random.Random(42)
+    torrents = []
+    for _ in range(n):
+        owner = rnd.randrange(users) + 100000000 if rnd.random() > 0.1 else None
+        torrents.append((os.urandom(20).hex(), owner, rnd.random() < active_ratio))
+    return torrents
+
+
+def build_legacy(torrents):
+    data = {'active': set(), 'owner': {}, 'owned': {}}
+    for t_hash, owner, active in torrents:
+        data['owner'][t_hash] = owner
+        if active:
+            data['active'].add(t_hash)
+        if owner is not None:
+            data['owned'].setdefault(owner, set()).add(t_hash)
+    return data
+
+
+def build_registry(torrents):
+    registry = TorrentRegistry()
+    for t_hash, owner, active in torrents:
+        registry.add(t_hash, owner, active)
+    return registry
+
+
+def measure(build, torrents):
+    # input is decoded while tracing, so hash strings kept by a layout are counted too
+    blob = pickle.dumps(torrents)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    torrents = pickle.loads(blob)
+    obj = build(torrents)
+    torrents = None
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, len(pickle.dumps(obj, protocol=3)), obj
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, nargs='+', default=[1000, 10000, 50000], help='Torrent counts')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--active', type=float, default=0.1, help='Share of active torrents')
+    args = parser.parse_args()
+
+    print(f'{"torrents":>9} | {"layout":>9} | {"memory":>12} | {"per torrent":>11} | {"pickled":>12}')
+    for n in args.n:
+        torrents = synthetic(n, args.users, args.active)
+        for name, build in [('dict/sets', build_legacy), ('registry', build_registry)]:
+            mem, pickled, _ = measure(build, torrents)
+            print(f'{n:>9} | {name:>9} | {mem:>12} | {mem / n:>11.1f} | {pickled:>12}')
+    print('registry rows include the size column (quotas), the dict/sets layout has no sizes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Build and query time of the torrent name search index"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tbot'))
+
+from search import SearchIndex
+
+
+WORDS = ['the', 'matrix', 'lord', 'rings', 'star', 'wars', 'ubuntu', 'debian', 'season', 'complete',
+         'collection', 'remastered', 'edition', 'soundtrack', 'discography', 'linux', 'server', 'desktop',
+         'amd64', 'x264', 'hevc', 'bluray', 'webrip', 'flac', 'mp3', 'russian', 'english', 'extended']
+QUERIES = ['matrix', 'star wars', '1080p', 'ubuntu 22', 'x26', 'S05E1', 'remastered flac', 'qwerty', 'a']
+
+
+def synthetic(n):
+    rnd = random.Random(42)
+    names = []
+    for i in range(n):
+        words = rnd.sample(WORDS, rnd.randint(2, 5))
+        words.append(str(rnd.randint(1960, 2024)))
+        if rnd.random() < 0.3:
+            words.append(f'S{rnd.randint(1, 12):02d}E{rnd.randint(1, 24):02d}')
+        words.append(rnd.choice(['720p', '1080p', '2160p', 'iso', 'tar.gz']))
+        names.append('.'.join(w.capitalize() for w in words))
+    return sorted((name, f'{i:040x}', i) for i, name in enumerate(names))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=50000, help='Number of torrents')
+    parser.add_argument('--changes', type=int, default=100, help='Torrents added and removed for the incremental sync')
+    args = parser.parse_args()
+
+    entries = synthetic(args.n)
+    index = SearchIndex()
+    start = time.perf_counter()
+    index.sync(entries)
+    print(f'Initial build: {len(index)} names in {(time.perf_counter() - start) * 1000:.0f} ms')
+
+    changed = entries[args.changes:] + [(f'New.Torrent.{i}', f'{args.n + i:040x}', args.n + i) for i in range(args.changes)]
+    start = time.perf_counter()
+    index.sync(sorted(changed))
+    print(f'Incremental sync (+{args.changes}/-{args.changes}): {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    for query in QUERIES:
+        times = []
+        for _ in range(20):
+            start = time.perf_counter()
+            found = index.find(query)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        print(f'{query!r:20} {len(found):6} results, median {times[len(times) // 2] * 1000:.2f} ms, max {times[-1] * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
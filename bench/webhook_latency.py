@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""End-to-end handler latency harness for polling and webhook modes.
+
+The harness acts as the Bot API endpoint for the bot (set `bot_api_url: "http://127.0.0.1:PORT/bot"`
+in the bot config) and feeds it recorded updates, either from getUpdates (polling mode)
+or by POSTing them to the bot's webhook listener (webhook mode, --webhook URL).
+Latency is measured from update delivery to the first Bot API call the bot makes for the update's chat.
+
+Updates are read from a JSONL file (one Telegram Update object per line). Without --updates,
+"/help" commands from --user are generated.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'tbot', 'username': 'tbot'}
+
+
+class FakeBotAPI():
+    def __init__(self, port):
+        self.updates = []  # pending updates for getUpdates
+        self.cond = threading.Condition()
+        self.replies = {}  # chat_id: threading.Event
+        self.delivered = {}  # chat_id: delivery time
+        self.latencies = []
+        self.callback_chats = {}  # callback query id: chat_id
+        self.calls = collections.Counter()  # by method
+        self._msg_ids = itertools.count(1)
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                params = api.parse(body, self.headers.get('Content-Type', ''))
+                result = api.call(method, params)
+                out = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = do_POST
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.port = self.server.server_address[1]
+        self.server.daemon_threads = False  # let in-flight replies finish on close()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def parse(body, content_type):
+        if not body:
+            return {}
+        if 'json' in content_type:
+            return json.loads(body)
+        from urllib.parse import parse_qsl
+        return dict(parse_qsl(body.decode()))
+
+    def call(self, method, params):
+        self.calls[method] += 1
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('setWebhook', 'deleteWebhook'):
+            return True
+        if method == 'getUpdates':
+            timeout = float(params.get('timeout', 0) or 0)
+            with self.cond:
+                if not self.updates:
+                    self.cond.wait(timeout)
+                updates, self.updates = self.updates, []
+            now = time.perf_counter()
+            for update in updates:
+                self.delivered[chat_of(update)] = now
+            return updates
+        chat_id = params.get('chat_id')
+        if chat_id is None and 'callback_query_id' in params:
+            chat_id = self.callback_chats.get(str(params['callback_query_id']))
+        self.reply(chat_id)
+        if method == 'answerCallbackQuery':
+            return True
+        return {'message_id': next(self._msg_ids), 'date': int(time.time()),
+                'chat': {'id': int(chat_id or 0), 'type': 'private'}, 'text': params.get('text', '')}
+
+    def reply(self, chat_id):
+        if chat_id is None:
+            return
+        chat_id = int(chat_id)
+        event = self.replies.get(chat_id)
+        if event is not None and not event.is_set():
+            self.latencies.append(time.perf_counter() - self.delivered[chat_id])
+            event.set()
+
+    def expect(self, update):
+        chat = chat_of(update)
+        if 'callback_query' in update:
+            self.callback_chats[str(update['callback_query']['id'])] = chat
+        event = self.replies[chat] = threading.Event()
+        return event
+
+    def close(self):
+        with self.cond:
+            self.cond.notify_all()  # release pending getUpdates
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push(self, update):
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+
+def chat_of(update):
+    for key in ('message', 'edited_message'):
+        if key in update:
+            return update[key]['chat']['id']
+    if 'callback_query' in update:
+        return update['callback_query']['from']['id']
+    raise ValueError(f'Unsupported update: {update}')
+
+
+def generated_updates(user, n, command):
+    for i in range(n):
+        yield {
+            'update_id': 100000 + i,
+            'message': {
+                'message_id': i + 1, 'date': int(time.time()),
+                'chat': {'id': user, 'type': 'private'},
+                'from': {'id': user, 'is_bot': False, 'first_name': 'bench'},
+                'text': command,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}]
+            }
+        }
+
+
+def post(url, update):
+    req = urllib.request.Request(url, data=json.dumps(update).encode(), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        resp.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--api-port', type=int, default=8081, help='Port of the fake Bot API endpoint')
+    parser.add_argument('--webhook', metavar='URL', help='Webhook URL of the bot (webhook mode). Polling mode if omitted')
+    parser.add_argument('--updates', metavar='FILE', help='Recorded updates (JSONL)')
+    parser.add_argument('--user', type=int, default=123, help='User id for generated updates (must be whitelisted)')
+    parser.add_argument('--command', default='/help', help='Command for generated updates')
+    parser.add_argument('-n', type=int, default=100, help='Number of generated updates')
+    parser.add_argument('--timeout', type=float, default=10, help='Max wait for a reply')
+    args = parser.parse_args()
+
+    if args.updates:
+        with open(args.updates) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = list(generated_updates(args.user, args.n, args.command))
+
+    api = FakeBotAPI(args.api_port)
+    print(f'Fake Bot API listening on http://127.0.0.1:{args.api_port}/bot, waiting for the bot...', file=sys.stderr)
+    lost = 0
+    for update in updates:
+        event = api.expect(update)
+        if args.webhook:
+            api.delivered[chat_of(update)] = time.perf_counter()
+            post(args.webhook, update)
+        else:
+            api.push(update)
+        if not event.wait(args.timeout):
+            lost += 1
+
+    api.close()
+    mode = 'webhook' if args.webhook else 'polling'
+    lat = sorted(api.latencies)
+    if not lat:
+        print(f'{mode}: no replies received')
+        sys.exit(1)
+    p99 = lat[min(len(lat) - 1, int(len(lat) * 0.99))]
+    print(f'{mode}: {len(lat)} replies, {lost} lost, '
+          f'p50 {statistics.median(lat) * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms, max {lat[-1] * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import base64
+import binascii
+import hashlib
+import re
+from urllib.parse import parse_qs, urlparse
+
+
+token = re.compile(rb'([ld])|(e)|i(-?\d+)e|(\d+):')  # groups: container start, end, integer, string length
+
+
+class BencodeError(ValueError):
+    pass
+
+
+class Decoder():
+    """Bencode decoder over a memoryview (e.g. BytesIO.getbuffer()), the data is never copied as a whole.
+
+    Values can be skipped without decoding, which is used to find the raw span of the info dict
+    and to avoid copying large values (e.g. "pieces").
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        if self.data.ndim != 1 or self.data.itemsize != 1:
+            self.data = self.data.cast('B')
+
+    def _byte(self, pos):
+        try:
+            return self.data[pos]
+        except IndexError:
+            raise BencodeError('Unexpected end of data') from None
+
+    def _int(self, pos, end_char):
+        """Returns (int, position after end_char)"""
+        chunk = bytes(self.data[pos:pos + 65])  # only the integer is copied
+        end = chunk.find(end_char)
+        if end == -1:
+            raise BencodeError(f'Unterminated or too long integer at {pos}')
+        try:
+            return int(chunk[:end]), pos + end + 1
+        except ValueError:
+            raise BencodeError(f'Invalid integer at {pos}') from None
+
+    def _string_span(self, pos):
+        length, start = self._int(pos, ord(':'))
+        if length < 0 or start + length > len(self.data):
+            raise BencodeError(f'Invalid string length at {pos}')
+        return start, start + length
+
+    def skip(self, pos):
+        """Returns the end position of the value at pos (a flat token loop, re works on the memoryview directly)"""
+        data = self.data
+        depth = 0
+        while True:
+            m = token.match(data, pos)
+            if m is None:
+                raise BencodeError(f'Invalid or truncated data at {pos}')
+            kind = m.lastindex
+            pos = m.end()
+            if kind == 1:
+                depth += 1
+            elif kind == 2:
+                depth -= 1
+                if depth < 0:
+                    raise BencodeError(f'Unexpected end of container at {pos - 1}')
+            elif kind == 4:
+                pos += int(m.group(4))
+                if pos > len(data):
+                    raise BencodeError(f'Invalid string length at {m.start()}')
+            if depth == 0:
+                return pos
+
+    def dict_items(self, pos):
+        """Yields (key, value position) of the dict at pos"""
+        if self._byte(pos) != ord('d'):
+            raise BencodeError(f'Expected a dict at {pos}')
+        pos += 1
+        while self._byte(pos) != ord('e'):
+            start, end = self._string_span(pos)
+            key = bytes(self.data[start:end])
+            yield key, end
+            pos = self.skip(end)
+
+    def decode(self, pos=0, skip_keys=()):
+        """Returns (value, end position). Strings are returned as bytes.
+        Values of dict keys in skip_keys (at any depth) are replaced with their (start, end) span
+        """
+        m = token.match(self.data, pos)
+        if m is None:
+            raise BencodeError(f'Invalid or truncated data at {pos}')
+        kind = m.lastindex
+        pos = m.end()
+        if kind == 3:
+            return int(m.group(3)), pos
+        if kind == 4:
+            end = pos + int(m.group(4))
+            if end > len(self.data):
+                raise BencodeError(f'Invalid string length at {m.start()}')
+            return bytes(self.data[pos:end]), end
+        if kind == 2:
+            raise BencodeError(f'Unexpected end of container at {m.start()}')
+        if m.group(1) == b'l':
+            items = []
+            while self._byte(pos) != ord('e'):
+                value, pos = self.decode(pos, skip_keys)
+                items.append(value)
+            return items, pos + 1
+        result = {}
+        while self._byte(pos) != ord('e'):
+            start, end = self._string_span(pos)
+            key = bytes(self.data[start:end])
+            if key in skip_keys:
+                pos = self.skip(end)
+                result[key] = (end, pos)
+            else:
+                result[key], pos = self.decode(end, skip_keys)
+        return result, pos + 1
+
+    def info(self):
+        """Returns (start, end, {key: value position}) of the info dict of a .torrent file"""
+        for key, pos in self.dict_items(0):
+            if key == b'info':
+                fields = dict(self.dict_items(pos))
+                if not fields:
+                    return pos, pos + 2, fields
+                end = self.skip(fields[max(fields, key=fields.get)])  # after the last value
+                if self._byte(end) != ord('e'):
+                    raise BencodeError(f'Expected end of dict at {end}')
+                return pos, end + 1, fields
+        raise BencodeError('No info dict')
+
+
+def infohashes(data):
+    """Returns (v1, v2) hex infohashes of a .torrent file (bytes-like object), v2 is None for v1-only torrents.
+
+    For v2-only torrents v1 is the SHA-1 of the info dict as well (as used by hybrid-unaware clients).
+    """
+    decoder = Decoder(data)
+    start, end, fields = decoder.info()
+    info = decoder.data[start:end]
+    v2 = None
+    if b'meta version' in fields and decoder.decode(fields[b'meta version'])[0] == 2:
+        v2 = hashlib.sha256(info).hexdigest()
+    return hashlib.sha1(info).hexdigest(), v2
+
+
+def _text(value):
+    return value.decode('utf-8', errors='replace')
+
+
+def iter_files(data):
+    """Yields (path, size, padding) for each file of a .torrent file, in transmission's file index order.
+    path is a tuple of str, padding is True for BEP 47 pad files.
+    File entries are decoded one at a time, "pieces" and other large values are never decoded.
+    """
+    decoder = Decoder(data)
+    _, _, fields = decoder.info()
+    name = _text(decoder.decode(fields[b'name.utf-8'] if b'name.utf-8' in fields else fields[b'name'])[0])
+    if b'files' in fields:
+        pos = fields[b'files']
+        if decoder._byte(pos) != ord('l'):
+            raise BencodeError(f'Expected a list at {pos}')
+        pos += 1
+        while decoder._byte(pos) != ord('e'):
+            entry, pos = decoder.decode(pos)
+            path = entry.get(b'path.utf-8') or entry[b'path']
+            yield (name, *map(_text, path)), entry[b'length'], b'p' in entry.get(b'attr', b'')
+    elif b'length' in fields:
+        yield (name,), decoder.decode(fields[b'length'])[0], False
+    elif b'file tree' in fields:  # v2-only torrent
+        def walk(pos, path):
+            for key, value_pos in decoder.dict_items(pos):
+                if key == b'':  # file node
+                    yield path, decoder.decode(value_pos)[0][b'length'], False
+                else:
+                    yield from walk(value_pos, path + (_text(key),))
+        yield from walk(fields[b'file tree'], (name,))
+    else:
+        raise BencodeError('No files in the info dict')
+
+
+def magnet_infohashes(link):
+    """Returns (v1, v2) hex infohashes from the xt parameters of a magnet link (None if missing)"""
+    v1 = v2 = None
+    for xt in parse_qs(urlparse(link).query).get('xt', []):
+        urn = xt.lower()
+        try:
+            if urn.startswith('urn:btih:'):
+                value = xt[len('urn:btih:'):]
+                if len(value) == 40:
+                    v1 = bytes.fromhex(value).hex()
+                elif len(value) == 32:
+                    v1 = base64.b32decode(value.upper()).hex()
+            elif urn.startswith('urn:btmh:1220') and len(urn) == len('urn:btmh:1220') + 64:  # sha2-256 multihash
+                v2 = bytes.fromhex(urn[len('urn:btmh:1220'):]).hex()
+        except (ValueError, binascii.Error):
+            continue
+    return v1, v2
@@ -1,34 +1,57 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
 import logging
 import os
 import re
 import sys
+import threading
 import time
 import traceback
+from array import array
 from functools import wraps, partial
 from io import BytesIO
 from pathlib import Path
 from signal import SIGINT, SIGTERM, SIGABRT
+from urllib.parse import parse_qs, urlparse
 
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import Updater, ExtBot, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler, InlineQueryHandler
 from telegram.ext.filters import Filters
 from telegram.error import BadRequest
-from transmission_rpc import Client as Transmission
+from telegram.utils.request import Request
 import yaml
 
 import strings
+from bencode import BencodeError, infohashes, iter_files, magnet_infohashes
+from cache import TorrentCache
 from db import BotDB
-from ftp import FTPDrop, ftp_available
+from db_sqlite import SqliteBotDB
+from ftp import FTPDrop, ftp_available, ftp_engines
+from httpshare import HTTPDrop
+from ingest import IngestQueue
+from metrics import Metrics, instrument_handler
+from notify import Notifier
+from profiling import Profiler, describe, section
+from rpc import PooledTransmission, Transport
+from search import SearchIndex
 
 valid_dirname = re.compile(r'^[\w. -]+$')
+magnet_link = re.compile(r'^magnet:\?', re.I | re.M)  # any line of a message
 offset_query = re.compile(r'^offset=(\w+),(\w+)$')
 hash_query = re.compile(r'^hash=(\w+),(\d+),(\w+)$')
 toggle_query = re.compile(r'^(run|stop)=(\w+),(\d+),(\w+)$')
-ftp_query = re.compile(r'^([+-]?)ftp=(\w+),(\d+),(\w+)$')
+ftp_query = re.compile(r'^([+-]?)(ftp|http)=(\w+),(\d+),(\w+)$')
 del_query = re.compile(r'^(del2?)=(\w+),(\d+),(\w+)$')
+select_query = re.compile(r'^sel=(\d+),(\w+)$')
+pick_query = re.compile(r'^pick=(\w+),(\d+),(\w+)$')
+pick_all_query = re.compile(r'^pickall=(finished|stopped|none),(\d+),(\w+)$')
+bulk_query = re.compile(r'^bulk=(run|stop|del2?),(\d+),(\w+)$')
+file_query = re.compile(r'^file=(\d+),(\d+),(\d+)$')  # preview id, file, page
+files_query = re.compile(r'^files=(\d+),(page|all|none|add|cancel),(\d+)$')
 
 
 class State:
@@ -51,6 +74,44 @@ def speed_format(kbps):
     return f'{kbps/1000:.2f} MB/s'
 
 
+def magnet_links(text):
+    return [line.strip() for line in text.splitlines() if magnet_link.match(line.strip())]
+
+
+def magnet_name(link):
+    names = parse_qs(urlparse(link).query).get('dn')
+    return names[0] if names else link[:60]
+
+
+def item_title(item):
+    """Title of a batch item for replies"""
+    kind, data = item
+    return (data.file_name or 'torrent') if kind == 'file' else magnet_name(data)
+
+
+def timed_job(method):
+    """Measures a JobQueue callback (see Profiler.measure), counts runs of repeating jobs which took longer than their interval"""
+    @wraps(method)
+    def wrapped(self, context):
+        with self.profiler.measure(method.__name__, 'job', context, self.job_duration) as call:
+            try:
+                return method(self, context)
+            finally:
+                trigger = getattr(getattr(getattr(context, 'job', None), 'job', None), 'trigger', None)
+                interval = getattr(trigger, 'interval_length', None)  # repeating jobs only
+                if interval is not None and time.perf_counter() - call.start > interval:
+                    self.job_overruns.inc(method.__name__)
+    return wrapped
+
+
+class TimedRequest(Request):
+    """Bot API requests are accounted to the current handler or job (see profiling.section)"""
+
+    def _request_wrapper(self, *args, **kwargs):
+        with section('telegram'):
+            return super()._request_wrapper(*args, **kwargs)
+
+
 def restricted_template(func, *, whitelist):
     @wraps(func)
     def wrapped(update, context, *args, **kwargs):
@@ -62,19 +123,46 @@ def restricted_template(func, *, whitelist):
 
 
 class TBot():
-    def __init__(self, cfg_path, db_path):
+    def __init__(self, cfg_path, db_path, db_backend='shelve'):
         with open(cfg_path) as f:
             config = yaml.safe_load(f)
 
         self.admins = config['admins']
         self.rootdir = config['rootdir']
         self.reserved_space = config['reserved_space']
+        self.disk_guard_cfg = {'horizon': 300, 'min_interval': 10, 'max_interval': 600, **config.get('disk_guard', {})}
+        self.disk_full_rate = 0  # aggregate download rate when the disk guard was triggered
         self.password = config['password']
-        self.client = Transmission(**config['client_cfg'])
-        self.updater = Updater(token=config['token'], use_context=True, user_sig_handler=self.signal)
+        self.quota_cfg = config.get('quota') or {}
+        rpc_cfg = config.get('rpc', {})
+        self.rpc = Transport(**{'timeout': rpc_cfg.get('timeout', 30), 'pool_size': rpc_cfg.get('pool_size', 4), **config['client_cfg']})
+        self.client = PooledTransmission(self.rpc, **config['client_cfg'])
+        cache_cfg = config.get('cache', {})
+        self.torrents = TorrentCache(self.client, cache_cfg.get('ttl', 5), cache_cfg.get('incremental', False))
+        self.search = SearchIndex()  # synced with the cache's list index on each query
+        self.updates_cfg = config.get('updates', {})
+        if self.updates_cfg.get('mode', 'polling') == 'webhook' and not self.updates_cfg.get('webhook', {}).get('url'):
+            # python-telegram-bot always registers the webhook, an empty url would be replaced with https://<listen>:<port>/...
+            logging.error('updates.webhook.url is required in webhook mode (the webhook is registered on startup)')
+            sys.exit(1)
+        bot_kwargs = {}
+        if config.get('bot_api_url'):  # e.g. a local Bot API server or a test harness
+            bot_kwargs['base_url'] = config['bot_api_url']
+        workers = self.updates_cfg.get('workers', 4)
+        bot = ExtBot(config['token'], request=TimedRequest(con_pool_size=workers + 4), **bot_kwargs)
+        self.updater = Updater(bot=bot, use_context=True, user_sig_handler=self.signal, workers=workers)
         self.dispatcher = self.updater.dispatcher
         self.jq = self.updater.job_queue
-        self.db = BotDB(db_path)
+        notify_cfg = config.get('notifications', {})
+        self.notifier = Notifier(self.updater.bot, notify_cfg.get('global_rate', 25), notify_cfg.get('chat_rate', 1), notify_cfg.get('retries', 5))
+        self.digest_window = notify_cfg.get('digest_window', 60)
+        self.digest_max_length = notify_cfg.get('digest_max_length', 4096)
+        self.finished_digest = {}  # user: list of finished torrent names
+        self.digest_lock = threading.Lock()
+        self.db = SqliteBotDB(db_path) if db_backend == 'sqlite' else BotDB(db_path)
+        self.batch_cfg = {'workers': 4, 'chat_workers': 2, 'max_size': 100, 'preview_ttl': 900, **config.get('batch', {})}
+        self.preview_ids = itertools.count(1)  # callbacks of an older preview message are rejected
+        self.ingest = IngestQueue(self.batch_cfg['workers'], self.batch_cfg['chat_workers'])
         self.ftp_cfg = config['ftp']
         self.ftp_enabled = self.ftp_cfg['enabled']
         if self.ftp_enabled:
@@ -82,9 +170,34 @@ class TBot():
                 logging.error('pyftpdlib is not installed, cannot enable FTP access. Install it using "pip install pyftpdlib" and restart the bot.')
                 sys.exit(1)
             self.ftp_cfg['root'] = self.ftp_cfg.get('root') or self.rootdir  # empty or missing root -> rootdir
-            self.ftpd = FTPDrop(self.ftp_cfg['address'].split(':'))
-        self.shares = {}  # (hash, user): timer
-
+            engine = self.ftp_cfg.get('engine', 'threaded')
+            if engine not in ftp_engines():
+                logging.error(f'Unknown or unsupported FTP engine "{engine}", available engines: {", ".join(ftp_engines())}')
+                sys.exit(1)
+            limits_cfg = self.ftp_cfg.get('limits') or {}
+            limits = {  # KB/s -> bytes/s, "download" is sent to clients
+                'share_write': limits_cfg.get('share_download', 0) * 1000,
+                'share_read': limits_cfg.get('share_upload', 0) * 1000,
+                'total_write': limits_cfg.get('total_download', 0) * 1000,
+                'total_read': limits_cfg.get('total_upload', 0) * 1000,
+            }
+            self.ftpd = FTPDrop(self.ftp_cfg['address'].split(':'), engine,
+                                self.ftp_cfg.get('max_cons', 20), self.ftp_cfg.get('max_cons_per_ip', 5), limits)
+        self.http_cfg = config.get('http') or {'enabled': False}
+        self.http_enabled = self.http_cfg['enabled']
+        if self.http_enabled:
+            self.httpd = HTTPDrop(self.http_cfg['address'].split(':'), self.http_cfg.get('url'))
+        self.drops = {}  # enabled share engines
+        if self.ftp_enabled:
+            self.drops['ftp'] = self.ftpd
+        if self.http_enabled:
+            self.drops['http'] = self.httpd
+        self.shares = {}  # (hash, user) or (hash, user, 'http'): timer
+        self.shares_lock = threading.RLock()  # for mutations, reads are lock-free
+
+        profiling_cfg = config.get('profiling') or {}
+        self.profiler = Profiler(profiling_cfg.get('slow_threshold', 1), profiling_cfg.get('top', 15))
+        self.create_metrics(config.get('metrics') or {})
         self.restore_persistent_timer('reset_limit', self.reset_limit)
 
         self.create_dl_checker()
@@ -115,15 +228,22 @@ class TBot():
 
         self.handlers['mytorr'] = (CommandHandler('my_torrents', restricted(self.my_torrents)), 0)
         self.handlers['alltorr'] = (CommandHandler('all_torrents', restricted(self.all_torrents), filters=Filters.user(user_id=self.admins)), 0)
+        self.handlers['find'] = (CommandHandler('find', restricted(self.find)), 0)
+        self.handlers['inline_find'] = (InlineQueryHandler(restricted(self.inline_find)), 0)
 
+        torrent_file = Filters.document.mime_type('application/x-bittorrent')
+        batch_handlers = [  # more torrents for the same batch
+            MessageHandler(torrent_file, self.add_to_batch),
+            MessageHandler(Filters.regex(magnet_link), self.add_to_batch)
+        ]
         self.handlers['newtorr'] = (ConversationHandler(
             [
-                MessageHandler(Filters.document.mime_type('application/x-bittorrent'), restricted(self.add_torrent)),
-                MessageHandler(Filters.regex(re.compile(r'^magnet:\?', re.I)), restricted(self.add_magnet))
+                MessageHandler(torrent_file, restricted(self.add_torrent)),
+                MessageHandler(Filters.regex(magnet_link), restricted(self.add_magnet))
             ],
             {
-                State.SELDIR: [MessageHandler(Filters.text(list(strings.dir_buttons.keys())), self.sel_dir)],
-                State.MKDIR: [MessageHandler(Filters.text & (~Filters.command), self.make_dir)]
+                State.SELDIR: [MessageHandler(Filters.text(list(strings.dir_buttons.keys())), self.sel_dir)] + batch_handlers,
+                State.MKDIR: batch_handlers + [MessageHandler(Filters.text & (~Filters.command), self.make_dir)]
             },
             conv_fallbacks
         ), 0)
@@ -132,19 +252,45 @@ class TBot():
         self.handlers['torrent_info'] = (CallbackQueryHandler(self.torrent_info, pattern=hash_query), 0)
         self.handlers['toggle_torrent'] = (CallbackQueryHandler(self.toggle_torrent, pattern=toggle_query), 0)
         self.handlers['del_torrent'] = (CallbackQueryHandler(self.del_torrent, pattern=del_query), 0)
+        self.handlers['select_mode'] = (CallbackQueryHandler(self.select_mode, pattern=select_query), 0)
+        self.handlers['pick_torrent'] = (CallbackQueryHandler(self.pick_torrent, pattern=pick_query), 0)
+        self.handlers['pick_all'] = (CallbackQueryHandler(self.pick_all, pattern=pick_all_query), 0)
+        self.handlers['bulk_action'] = (CallbackQueryHandler(self.bulk_action, pattern=bulk_query), 0)
+        self.handlers['file_priority'] = (CallbackQueryHandler(self.file_priority, pattern=file_query), 0)
+        self.handlers['preview_action'] = (CallbackQueryHandler(self.preview_action, pattern=files_query), 0)
 
         if self.ftp_enabled:
             self.handlers['ftp'] = (CommandHandler('ftp', restricted(self.ftp), filters=Filters.user(user_id=self.admins)), 0)
             self.handlers['noftp'] = (CommandHandler('noftp', restricted(self.no_ftp), filters=Filters.user(user_id=self.admins)), 0)
+        if self.drops:
             self.handlers['ftp_access'] = (CallbackQueryHandler(self.ftp_access, pattern=ftp_query), 0)
 
         self.handlers['disk'] = (CommandHandler('disk', restricted(self.show_disk_usage)), 0)
+        self.handlers['stats'] = (CommandHandler('stats', restricted(self.show_stats), filters=Filters.user(user_id=self.admins)), 0)
+        self.handlers['profile'] = (CommandHandler('profile', restricted(self.profile), filters=Filters.user(user_id=self.admins)), 0)
         self.handlers['auth']= (MessageHandler(Filters.text & (~Filters.command), self.auth), 1)
 
-        for h, gr in self.handlers.values():
+        seen = set()
+        for name, (h, gr) in self.handlers.items():
+            instrument_handler(h, lambda callback, handler: self.profiler.wrap(callback, name, describe(handler), self.handler_duration), seen)
             self.dispatcher.add_handler(h, group=gr)
 
-        self.updater.start_polling()
+    def run(self):
+        if self.updates_cfg.get('mode', 'polling') == 'webhook':
+            webhook_cfg = self.updates_cfg['webhook']
+            url_path = webhook_cfg.get('url_path') or self.updater.bot.token
+            webhook_url = webhook_cfg['url'].rstrip('/') + '/' + url_path
+            self.updater.start_webhook(
+                listen=webhook_cfg.get('listen', '127.0.0.1'),
+                port=webhook_cfg.get('port', 8443),
+                url_path=url_path,
+                cert=webhook_cfg.get('cert') or None,
+                key=webhook_cfg.get('key') or None,
+                webhook_url=webhook_url,
+                max_connections=webhook_cfg.get('max_connections', 40)
+            )
+        else:
+            self.updater.start_polling()
         self.updater.idle()
 
     def answer(self, update, context, msg, **kwargs):
@@ -172,7 +318,29 @@ class TBot():
         # available = [ reported as available | reserved by us ]
         used, avail = self.get_disk_stats()
         avail = max(0, avail - self.reserved_space)
-        self.answer(update, context, strings.disk_usage.format(strings.format_size(used), strings.format_size(used + avail), used / (used + avail) * 100))
+        msg = strings.disk_usage.format(strings.format_size(used), strings.format_size(used + avail), used / (used + avail) * 100)
+        user = update.effective_user.id
+        usage, quota = self.db.usage(user), self.get_quota(user)
+        if quota is None:
+            msg += '\n' + strings.quota_usage_unlimited.format(strings.format_size(usage))
+        else:
+            msg += '\n' + strings.quota_usage.format(strings.format_size(usage), strings.format_size(quota), usage / quota * 100)
+        self.answer(update, context, msg)
+
+    def show_stats(self, update, context):
+        rate, methods = self.rpc.stats.summary()
+        self.answer(update, context, strings.format_stats(self.torrents.stats(), rate, methods))
+
+    def profile(self, update, context):
+        try:
+            count = int(context.args[0]) if context.args else 10
+        except ValueError:
+            count = 0
+        if not 1 <= count <= 1000:
+            return self.answer(update, context, strings.profile_usage)
+        chat = update.effective_chat.id
+        self.profiler.profile_next(count, lambda rows: self.notifier.send(chat, strings.format_profile(count, rows), parse_mode='markdown'))
+        self.answer(update, context, strings.profile_started.format(count))
 
     def auth(self, update, context):
         user = update.effective_user.id
@@ -187,25 +355,32 @@ class TBot():
 
     def ftp(self, update, context):
         # NOTE on restart all shares are silently deleted
-        creds = self.ftpd.share(self.ftp_cfg['root'], True, 'root')
-        self.shares['root'] = time.time() + self.ftp_cfg['tl']
-        timer_info = time.strftime('%H:%M:%S %Z', time.localtime(self.shares['root']))
-        self.create_timer('stop_ftp_root', self.stop_ftp, self.shares['root'], ('root', update.effective_chat.id, None))
+        with self.shares_lock:
+            creds = self.ftpd.share(self.ftp_cfg['root'], True, 'root')
+            self.shares['root'] = time.time() + self.ftp_cfg['tl']
+            timer_info = time.strftime('%H:%M:%S %Z', time.localtime(self.shares['root']))
+            self.create_timer('stop_ftp_root', self.stop_ftp, self.shares['root'], ('root', update.effective_chat.id, None))
 
         self.answer(update, context, strings.ftp_start.format(*creds, timer_info), parse_mode='markdown')
 
     def no_ftp(self, update, context):
-        if 'root' not in self.shares:
-            return self.answer(update, context, strings.ftp_stopped)
-        self.cancel_timer('stop_ftp_root')
-        self.ftpd.unshare('root')
-        del self.shares['root']
+        with self.shares_lock:
+            if 'root' not in self.shares:
+                return self.answer(update, context, strings.ftp_stopped)
+            self.cancel_timer('stop_ftp_root')
+            self.ftpd.unshare('root')
+            del self.shares['root']
         self.answer(update, context, strings.ftp_stop)
 
 # --------------------------------------------------------------------------------------------------
 # setlimit conversation
 # --------------------------------------------------------------------------------------------------
 
+    def _pop_limit(self, context):
+        # chat_data is shared with other features (/find query, list selection, preview), only own keys are dropped
+        for key in ['dl', 'ul']:
+            context.chat_data.pop(key, None)
+
     def setlimit(self, update, context):
         self.answer(update, context, strings.select_dl, reply_markup=ReplyKeyboardMarkup(strings.dl_kb, resize_keyboard=True))
         return State.SELDL
@@ -222,7 +397,7 @@ class TBot():
             self.reset_limit_now()
             self.answer(update, context, strings.limit_reset, reply_markup=ReplyKeyboardRemove())
             self.notify_limit_change(update.effective_user.id)
-            context.chat_data.clear()
+            self._pop_limit(context)
             return State.END
         self.answer(update, context, strings.select_dur, reply_markup=ReplyKeyboardMarkup(strings.dur_kb, one_time_keyboard=True, resize_keyboard=True))
         return State.SELDUR
@@ -231,7 +406,7 @@ class TBot():
         params = {}
         self.set_limit(context.chat_data['dl'], context.chat_data['ul'])
         self.answer(update, context, strings.limit_set, reply_markup=ReplyKeyboardRemove())
-        context.chat_data.clear()
+        self._pop_limit(context)
         duration = strings.dur_buttons[update.message.text]
         self.create_persistent_timer('reset_limit', self.reset_limit, time.time() + duration if duration is not None else None)
         self.notify_limit_change(update.effective_user.id)
@@ -241,9 +416,10 @@ class TBot():
 # torrent management
 # --------------------------------------------------------------------------------------------------
 
-    def show_torrents(self, update, context, torrents, category, offset=0, message=None):
-        #TODO cache torrent list in chat_data? (WTF?)
+    def show_torrents(self, update, context, index, category, offset=0, message=None):
+        """index - sorted list of (name, hash, id), see TorrentCache.index(). Only the visible page is fetched"""
         elements_per_page = 10
+        selection = self._selection(context, category)
 
         def build_menu(torrents, offset, total_count):
             step = elements_per_page
@@ -256,7 +432,10 @@ class TBot():
 
             if not torrents:  # still need update button. Full row is used for consistency
                 return InlineKeyboardMarkup([navigation_row])
-            buttons = [InlineKeyboardButton(str(i+1), callback_data=f'hash={t.hashString},{offset},{category}') for i, t in enumerate(torrents)]
+            if selection is None:
+                buttons = [InlineKeyboardButton(str(i+1), callback_data=f'hash={t.hashString},{offset},{category}') for i, t in enumerate(torrents)]
+            else:
+                buttons = [InlineKeyboardButton(('✅' if t.hashString in selection else '') + str(i+1), callback_data=f'pick={t.hashString},{offset},{category}') for i, t in enumerate(torrents)]
             if len(torrents) <= 6:
                 rows = [buttons]
             else:  # too many buttons for a nice single row
@@ -266,9 +445,23 @@ class TBot():
                     buttons[mid_point:]
                 ]
             rows.append(navigation_row)
+            if selection is None:
+                rows.append([InlineKeyboardButton('☑ Выбрать несколько', callback_data=f'sel={offset},{category}')])
+            else:
+                rows.append([
+                    InlineKeyboardButton('✔ Завершённые', callback_data=f'pickall=finished,{offset},{category}'),
+                    InlineKeyboardButton('⏸ Остановленные', callback_data=f'pickall=stopped,{offset},{category}'),
+                    InlineKeyboardButton('🧹 Сбросить', callback_data=f'pickall=none,{offset},{category}')
+                ])
+                rows.append([
+                    InlineKeyboardButton('▶', callback_data=f'bulk=run,{offset},{category}'),
+                    InlineKeyboardButton('⏸', callback_data=f'bulk=stop,{offset},{category}'),
+                    InlineKeyboardButton('❌', callback_data=f'bulk=del,{offset},{category}'),
+                    InlineKeyboardButton('↩ Готово', callback_data=f'sel={offset},{category}')
+                ])
             return InlineKeyboardMarkup(rows)
 
-        total_count = len(torrents)
+        total_count = len(index)
         if offset >= total_count:  # e.g. last page contained only one torrent and it was deleted
             # show the current last page instead
             if total_count == 0:
@@ -276,12 +469,14 @@ class TBot():
             else:
                 # max multiple of elements_per_page below total_count
                 offset = (total_count - 1) // elements_per_page * elements_per_page
-        torrents = torrents[offset:offset + elements_per_page]
+        torrents = self.torrents.get_page(index[offset:offset + elements_per_page])
 
         uid = update.effective_user.id
-        ftp = [(t.hashString, uid) in self.shares for t in torrents]
+        ftp = [self._is_shared(t.hashString, uid) for t in torrents]
 
         msg = strings.format_torrents(torrents, offset, total_count, ftp)
+        if selection is not None and torrents:
+            msg += '\n\n' + strings.selected.format(len(selection))
         markup = build_menu(torrents, offset, total_count)
         if message is None:
             self.answer(update, context, msg, reply_markup=markup)
@@ -296,55 +491,180 @@ class TBot():
         if offset == 'right':
             self.answer_callback(update, context, strings.right)
             return
-        if owner == 'my':
-            uid = update.effective_user.id
-            torrents = self._get_torrents(self.db.owned_torrents(uid))
-        else:
-            if update.effective_user.id not in self.admins:
-                logging.warning(f'Unauthorized access attempt (list_offset, user {update.effective_user.id})')
-                return
-            torrents = self._get_torrents(None)
+        self._refresh_list(update, context, owner, int(offset))
+
+    def _category_index(self, update, context, category):
+        """Returns the index for a list category, None if it's not available (the callback is answered then)"""
+        uid = update.effective_user.id
+        if category == 'my':
+            return self._get_index(self.db.owned_torrents(uid))
+        if category == 'find':
+            query = context.chat_data.get('find')
+            if query is None:  # chat_data is not persistent
+                self.answer_callback(update, context, strings.find_expired)
+                return None
+            return self._find(query, uid)
+        if uid not in self.admins:
+            logging.warning(f'Unauthorized access attempt (list {category}, user {uid})')
+            return None
+        return self._get_index(None)
+
+    def _refresh_list(self, update, context, category, offset, notice=None):
+        index = self._category_index(update, context, category)
+        if index is None:
+            return
         try:
-            self.show_torrents(update, context, torrents, owner, int(offset), message=update.callback_query.message)
+            self.show_torrents(update, context, index, category, offset, message=update.callback_query.message)
         except BadRequest:
             pass
-        update.callback_query.answer()
+        update.callback_query.answer(notice)
+
+    def _selection(self, context, category):
+        """Returns the set of selected hashes, None if the list is not in select mode"""
+        selection = context.chat_data.get('selection')
+        if selection is None or selection[0] != category:
+            return None
+        return selection[1]
+
+    def select_mode(self, update, context):
+        offset, category = context.match.groups()
+        if self._selection(context, category) is None:
+            context.chat_data['selection'] = (category, set())
+        else:
+            del context.chat_data['selection']
+        self._refresh_list(update, context, category, int(offset))
+
+    def pick_torrent(self, update, context):
+        t_hash, offset, category = context.match.groups()
+        selection = self._selection(context, category)
+        if selection is None:  # e.g. after restart
+            update.callback_query.answer()
+            return
+        selection ^= {t_hash}
+        self._refresh_list(update, context, category, int(offset))
+
+    def pick_all(self, update, context):
+        what, offset, category = context.match.groups()
+        selection = self._selection(context, category)
+        if selection is None:
+            update.callback_query.answer()
+            return
+        index = self._category_index(update, context, category)
+        if index is None:
+            return
+        selection.clear()
+        if what != 'none':
+            torrents = self.torrents.get_torrents([entry[1] for entry in index])
+            if what == 'finished':
+                selection.update(t.hashString for t in torrents if t.status in ['seeding', 'stopped'] and t.leftUntilDone == 0)
+            else:
+                selection.update(t.hashString for t in torrents if t.status == 'stopped')
+        self._refresh_list(update, context, category, int(offset), strings.selected.format(len(selection)))
+
+    def bulk_action(self, update, context):
+        action, offset, category = context.match.groups()
+        selection = self._selection(context, category)
+        uid = update.effective_user.id
+        hashes = sorted(selection or [])
+        if uid not in self.admins:
+            owned = set(self.db.owned_torrents(uid))
+            hashes = [t_hash for t_hash in hashes if t_hash in owned]
+        if not hashes:
+            self.answer_callback(update, context, strings.nothing_selected)
+            return
+        if action == 'del':
+            cancel_btn = InlineKeyboardButton('🚫 Отмена', callback_data=f'offset={offset},{category}')
+            ok_btn = InlineKeyboardButton('❌ Удалить', callback_data=f'bulk=del2,{offset},{category}')
+            update.callback_query.message.edit_text(strings.bulk_del_confirm.format(len(hashes)), reply_markup=InlineKeyboardMarkup([[cancel_btn, ok_btn]]))
+            update.callback_query.answer()
+            return
+        # a single RPC call for all selected torrents
+        if action == 'run':
+            self.client.start_torrent(hashes)
+        elif action == 'stop':
+            self.client.stop_torrent(hashes)
+        else:
+            # FTP access may still be open, eventually it will be closed (will just return error to clients)
+            self.client.remove_torrent(hashes, delete_data=True)
+            self.torrents.invalidate(membership=True)
+            self.db.remove_torrents(hashes)
+        self.torrents.invalidate()
+        del context.chat_data['selection']
+        self._refresh_list(update, context, category, int(offset), strings.bulk_done.format(len(hashes)))
 
     def my_torrents(self, update, context):
         uid = update.effective_user.id
-        torrents = self._get_torrents(self.db.owned_torrents(uid))
-        self.show_torrents(update, context, torrents, 'my')
+        index = self._get_index(self.db.owned_torrents(uid))
+        self.show_torrents(update, context, index, 'my')
 
     def all_torrents(self, update, context):
-        torrents = self._get_torrents(None)
-        self.show_torrents(update, context, torrents, 'all')
+        index = self._get_index(None)
+        self.show_torrents(update, context, index, 'all')
 
-    def _get_torrents(self, ids):
-        if ids is not None and not ids:
+    def find(self, update, context):
+        query = ' '.join(context.args)
+        if not query:
+            self.answer(update, context, strings.find_usage)
+            return
+        context.chat_data['find'] = query  # for paging and "back" buttons
+        self.show_torrents(update, context, self._find(query, update.effective_user.id), 'find')
+
+    def inline_find(self, update, context):
+        results_per_page = 50  # max for inline queries
+        uid = update.effective_user.id
+        query = update.inline_query.query
+        offset = int(update.inline_query.offset or 0)
+        found = self._find(query, uid) if query.strip() else self._get_index(self.db.owned_torrents(uid))
+        torrents = self.torrents.get_page(found[offset:offset + results_per_page])
+        results = [
+            InlineQueryResultArticle(
+                t.hashString, t.name,
+                InputTextMessageContent(f'{t.name}\n{strings.format_short(t)}'),
+                description=strings.format_short(t)
+            )
+            for t in torrents
+        ]
+        next_offset = str(offset + results_per_page) if offset + results_per_page < len(found) else ''
+        update.inline_query.answer(results, cache_time=10, is_personal=True, next_offset=next_offset)
+
+    def _find(self, query, uid):
+        """Returns sorted (name, hash, id) entries matching the query. Non-admins can find only their own torrents"""
+        self.search.sync(self.torrents.index())
+        found = self.search.find(query)
+        if uid not in self.admins:
+            owned = set(self.db.owned_torrents(uid))
+            found = [entry for entry in found if entry[1] in owned]
+        return found
+
+    def _is_shared(self, t_hash, user):
+        """True if the user has an open share of the torrent by any protocol"""
+        return (t_hash, user) in self.shares or (t_hash, user, 'http') in self.shares
+
+    def _get_index(self, hashes):
+        if hashes is not None and not hashes:
             return []
-        return sorted(self.client.get_torrents(ids=ids, arguments=['id', 'hashString', 'name', 'status', 'progress', 'sizeWhenDone', 'leftUntilDone']), key=lambda t: (t.name, t.hashString))
+        return self.torrents.index(hashes)
 
     def _torrent_info(self, update, context, t_hash, offset, owner, stopping=False):
         user = update.effective_user.id
-        key = (t_hash, user)
 
         def build_menu(t_hash, offset, owner, active):
             action = 'stop' if active else 'run'
             toggle_btn = InlineKeyboardButton('⏸ Остановить' if active else '▶ Запустить', callback_data=f'{action}={t_hash},{offset},{owner}')
-            ftp_btn = InlineKeyboardButton('📁 Настройки FTP-доступа', callback_data=f'ftp={t_hash},{offset},{owner}')
+            ftp_btn = InlineKeyboardButton('📁 Доступ к файлам', callback_data=f'ftp={t_hash},{offset},{owner}')
             delete_btn = InlineKeyboardButton('❌ Удалить торрент и скачанные файлы', callback_data=f'del={t_hash},{offset},{owner}')
             back_btn = InlineKeyboardButton('↩ Назад', callback_data=f'offset={offset},{owner}')
             refresh_btn = InlineKeyboardButton('🔄', callback_data=f'hash={t_hash},{offset},{owner}')
             rows = [
                 [toggle_btn],
-                [ftp_btn] if self.ftp_enabled else [],
+                [ftp_btn] if self.drops else [],
                 [delete_btn],
                 [back_btn, refresh_btn]
             ]
             return InlineKeyboardMarkup(rows)
 
-        torrent = self.client.get_torrent(t_hash)
-        msg = strings.format_torrent(torrent, override_status='stopping' if stopping else None, ftp=key in self.shares)
+        torrent = self.torrents.get_torrent(t_hash)
+        msg = strings.format_torrent(torrent, override_status='stopping' if stopping else None, ftp=self._is_shared(t_hash, user))
         try:
             update.callback_query.message.edit_text(msg, reply_markup=build_menu(t_hash, offset, owner, torrent.status!='stopped' and not stopping))
         except BadRequest:
@@ -362,70 +682,91 @@ class TBot():
             self.client.start_torrent(t_hash)
         else:
             self.client.stop_torrent(t_hash)
+        self.torrents.invalidate()
         self._torrent_info(update, context, t_hash, offset, owner, action != 'run')
         update.callback_query.answer()
 
     def ftp_access(self, update, context):
         # TODO allow filtered access to categories
         # TODO select tl (manually / based on size? 1h/18GB(5MBps))
-        action, t_hash, offset, owner = context.match.groups()
+        action, proto, t_hash, offset, owner = context.match.groups()
         user = update.effective_user.id
-        key = (t_hash, user)
+        keys = {'ftp': (t_hash, user), 'http': (t_hash, user, 'http')}
+        key = keys[proto]
+        drop = self.drops.get(proto)
+        if action and drop is None:  # old message, engine was disabled
+            update.callback_query.answer()
+            return
 
-        def build_menu(t_hash, offset, owner, shared):
-            start_btn = InlineKeyboardButton('▶ Открыть доступ' if not shared else '🔄 Продлить доступ', callback_data=f'+ftp={t_hash},{offset},{owner}')
-            stop_btn = InlineKeyboardButton('⏹️ Остановить доступ', callback_data=f'-ftp={t_hash},{offset},{owner}')
+        def build_menu(t_hash, offset, owner):
+            rows = []
+            for proto in self.drops:
+                shared = keys[proto] in self.shares
+                name = proto.upper()
+                rows.append([InlineKeyboardButton(f'▶ Открыть доступ по {name}' if not shared else f'🔄 Продлить доступ по {name}', callback_data=f'+{proto}={t_hash},{offset},{owner}')])
+                rows.append([InlineKeyboardButton(f'⏹️ Остановить доступ по {name}', callback_data=f'-{proto}={t_hash},{offset},{owner}')])
             back_btn = InlineKeyboardButton('↩ Назад', callback_data=f'hash={t_hash},{offset},{owner}')
-            return InlineKeyboardMarkup([[start_btn], [stop_btn], [back_btn]])
+            refresh_btn = InlineKeyboardButton('🔄', callback_data=f'ftp={t_hash},{offset},{owner}')
+            rows.append([back_btn, refresh_btn] if any(k in self.shares for k in keys.values()) else [back_btn])
+            return InlineKeyboardMarkup(rows)
 
-        details = None
         if action == '-':
-            if key in self.shares:
-                self.cancel_timer(f'stop_ftp_{key}')
-                self.ftpd.unshare(key)
-                del self.shares[key]
+            with self.shares_lock:
+                if key in self.shares:
+                    self.cancel_timer(f'stop_ftp_{key}')
+                    drop.unshare(key)
+                    del self.shares[key]
             self.answer_callback(update, context, strings.ftp_stop_access)
             self._torrent_info(update, context, t_hash, offset, owner)
             return
         elif action == '+':
-            if key not in self.shares:  # TODO!! check jq implementation. is a lock required to avoid data races?
-                try:
-                    torrent = self.client.get_torrent(t_hash)
-                    root = Path(torrent.downloadDir) / Path(torrent.files()[0].name).parts[0]
-                except Exception as e:
-                    logging.error('FTP access error (cannot find torrent root):' + str(e))
-                    self.answer_callback(update, context, strings.ftp_error)
-                    return
-
-                if torrent.left_until_done > 0:  # allow sharing if incomplete_dir is not used?
-                    self.answer_callback(update, context, strings.ftp_incomplete)
-                    return
-                creds = self.ftpd.share(root, False, key)
-            else:
-                creds = self.ftpd.get_creds(key)
-            if creds is None:
-                logging.error('FTP access error (no credentials found)')
+            # the torrent is fetched and the share is opened (may start the server) without holding shares_lock,
+            # share() returns the existing credentials if the key is already shared
+            try:
+                torrent = self.client.get_torrent(t_hash)
+                root = Path(torrent.downloadDir) / Path(torrent.files()[0].name).parts[0]
+            except Exception as e:
+                logging.error(f'{proto.upper()} access error (cannot find torrent root):' + str(e))
                 self.answer_callback(update, context, strings.ftp_error)
                 return
 
-            timer = time.time() + self.ftp_cfg['tl']
-            if key not in self.shares:
-                self.create_timer(f'stop_ftp_{key}', self.stop_ftp, timer, (key, update.effective_chat.id, torrent.name))
-            else:
-                self.reschedule_timer(f'stop_ftp_{key}', timer)
-            self.shares[key] = timer
-            details = (*creds, timer)
-
-        else:
-            creds = self.ftpd.get_creds(key)
-            timer = self.shares.get(key)
-            if creds is not None and timer is not None:
-                details = (*creds, timer)
+            if torrent.left_until_done > 0:  # allow sharing if incomplete_dir is not used?
+                self.answer_callback(update, context, strings.ftp_incomplete)
+                return
+            try:
+                drop.share(root, False, key)
+            except OSError as e:
+                logging.error(f'{proto.upper()} access error (cannot start the server): {e}')
+                self.answer_callback(update, context, strings.ftp_error)
+                return
+            with self.shares_lock:  # check-then-act, stop_ftp may run concurrently
+                creds = drop.get_creds(key)  # None if stop_ftp has just closed the share
+                if creds is None:
+                    logging.error(f'{proto.upper()} access error (no credentials found)')
+                    self.answer_callback(update, context, strings.ftp_error)
+                    return
 
-        msg = strings.format_ftp(self.ftp_cfg['address'], details)
+                timer = time.time() + (self.ftp_cfg if proto == 'ftp' else self.http_cfg)['tl']
+                if key not in self.shares:
+                    self.create_timer(f'stop_ftp_{key}', self.stop_ftp, timer, (key, update.effective_chat.id, torrent.name))
+                else:
+                    self.reschedule_timer(f'stop_ftp_{key}', timer)
+                self.shares[key] = timer
+
+        parts = []
+        if 'ftp' in self.drops:
+            creds = self.ftpd.get_creds(keys['ftp'])
+            timer = self.shares.get(keys['ftp'])
+            details = (*creds, timer) if creds is not None and timer is not None else None
+            parts.append(strings.format_ftp(self.ftp_cfg['address'], details, self.ftpd.transfer_stats(keys['ftp']) if details else None))
+        if 'http' in self.drops:
+            url = self.httpd.get_creds(keys['http'])
+            timer = self.shares.get(keys['http'])
+            parts.append(strings.format_http(url, timer) if url is not None and timer is not None else strings.format_http(None))
+        msg = '\n\n'.join(parts)
 
         try:
-            update.callback_query.message.edit_text(msg, reply_markup=build_menu(t_hash, offset, owner, key in self.shares), parse_mode='markdown')
+            update.callback_query.message.edit_text(msg, reply_markup=build_menu(t_hash, offset, owner), parse_mode='markdown')
         except BadRequest:
             pass
         update.callback_query.answer()
@@ -435,11 +776,12 @@ class TBot():
         if action == 'del2':
             # FTP access may still be open, eventually it will be closed (will just return error to clients)
             self.client.remove_torrent(t_hash, delete_data=True)
+            self.torrents.invalidate(membership=True)
             self.db.remove_torrent(t_hash)
             back_btn = InlineKeyboardButton('↩ Назад', callback_data=f'offset={offset},{owner}')
             update.callback_query.message.edit_text(strings.deleted, reply_markup=InlineKeyboardMarkup([[back_btn]]))
         else:
-            torrent = self.client.get_torrent(t_hash, arguments=['id', 'hashString', 'name'])
+            torrent = self.torrents.get_torrent(t_hash)
             cancel_btn = InlineKeyboardButton('🚫 Отмена', callback_data=f'hash={t_hash},{offset},{owner}')
             ok_btn = InlineKeyboardButton('❌ Удалить', callback_data=f'del2={t_hash},{offset},{owner}')
             update.callback_query.message.edit_text(strings.del_confirm.format(torrent.name), reply_markup=InlineKeyboardMarkup([[cancel_btn, ok_btn]]))
@@ -450,77 +792,309 @@ class TBot():
 # --------------------------------------------------------------------------------------------------
 
     def add_torrent(self, update, context):
-        context.chat_data['torrent'] = update.message.document
+        context.chat_data['batch'] = [('file', update.message.document)]
         self.answer(update, context, strings.select_dir, reply_markup=ReplyKeyboardMarkup(strings.dir_kb, one_time_keyboard=True, resize_keyboard=True))
         return State.SELDIR
 
     def add_magnet(self, update, context):
-        context.chat_data['magnet'] = update.message.text
+        context.chat_data['batch'] = []
+        self._extend_batch(update, context, [('magnet', link) for link in magnet_links(update.message.text)])
         self.answer(update, context, strings.select_dir, reply_markup=ReplyKeyboardMarkup(strings.dir_kb, one_time_keyboard=True, resize_keyboard=True))
         return State.SELDIR
 
+    def add_to_batch(self, update, context):
+        """Files and magnet links sent before the directory is selected are added to the same batch"""
+        if update.message.document:
+            items = [('file', update.message.document)]
+        else:
+            items = [('magnet', link) for link in magnet_links(update.message.text)]
+        self._extend_batch(update, context, items)
+        return None  # stay in the current state
+
+    def _extend_batch(self, update, context, items):
+        """Adds items to the batch up to max_size, the user is told how many were dropped"""
+        batch = context.chat_data.setdefault('batch', [])
+        free = max(0, self.batch_cfg['max_size'] - len(batch))
+        if len(items) > free:
+            self.answer(update, context, strings.batch_full.format(self.batch_cfg['max_size'], len(items) - free))
+        batch.extend(items[:free])
+
     def sel_dir(self, update, context):
         if not strings.dir_buttons[update.message.text]:
             self.answer(update, context, strings.make_dir, reply_markup=ReplyKeyboardRemove())
             return State.MKDIR
-        self._add_torrent(strings.dir_buttons[update.message.text], context, update)
+        self._add_batch(strings.dir_buttons[update.message.text], context, update)
         return State.END
 
     def make_dir(self, update, context):
         dirname = update.message.text
         if valid_dirname.match(dirname) and dirname not in ['.', '..']:
-            self._add_torrent(dirname, context, update)
+            self._add_batch(dirname, context, update)
         else:
             self.answer(update, context, strings.invalid_dirname)
             return State.MKDIR
         return State.END
 
-    def _add_torrent(self, dirname, context, update):
-        def client_add(torr_data):
-            try:
-                session = self.client.get_session()
-                torr = self.client.add_torrent(torr_data, download_dir=str(Path(session.download_dir).joinpath(dirname).absolute()))
-            except Exception as e:
-                self.answer(update, context, strings.error, reply_markup=ReplyKeyboardRemove())
-                log_error()
-                return
+    def _add_batch(self, dirname, context, update):
+        """Adds all torrents of the batch concurrently (on the shared ingestion pool), a single reply is sent when all are done"""
+        batch = context.chat_data.pop('batch', [])
+        if not batch:
+            self.answer(update, context, strings.error, reply_markup=ReplyKeyboardRemove())
+            return
+        try:
+            session = self.client.get_session()
+        except Exception:
+            self.answer(update, context, strings.error, reply_markup=ReplyKeyboardRemove())
+            log_error()
+            return
+        download_dir = str(Path(session.download_dir).joinpath(dirname).absolute())
+        uid = update.effective_user.id
+        if len(batch) == 1 and batch[0][0] == 'file':
+            # downloaded and parsed on the ingestion pool, the file list (or the result of adding) is sent from there
+            document = batch[0][1]
+            self.ingest.submit(update.effective_chat.id, [partial(self._load_torrent, document)],
+                               lambda results: self._start_preview(results[0], document, download_dir, update, context))
+            return
 
+        def done(results):
+            results = [result or ('error', item_title(item), strings.error) for item, result in zip(batch, results)]
+            if len(results) == 1:
+                msg = results[0][2]
+            else:
+                msg = strings.format_batch([(status, title) for status, title, _ in results])
+            self.answer(update, context, msg, reply_markup=ReplyKeyboardRemove())
+        self.ingest.submit(update.effective_chat.id, [partial(self._add_one, item, uid, download_dir) for item in batch], done)
+
+    def _download(self, document):
+        buf = BytesIO()
+        document.get_file().download(out=buf)
+        buf.seek(0)
+        return buf
+
+    def _add_one(self, item, uid, download_dir, buf=None, **add_args):
+        """Adds a single torrent (item - ('file', Document) or ('magnet', link)). Returns (status, title, message)
+        buf - already downloaded file, add_args - extra arguments for add_torrent (e.g. file priorities)
+        """
+        kind, data = item
+        title = item_title(item)
+        quota = self.get_quota(uid)
+        if quota is not None and self.db.usage(uid) >= quota:  # no need to download the file
+            return 'quota', title, strings.quota_exceeded.format(strings.format_size(self.db.usage(uid)), strings.format_size(quota))
+
+        if kind == 'file':
+            if buf is None:
+                try:
+                    buf = self._download(data)
+                except Exception:
+                    log_error()
+                    return 'error_load_file', title, strings.error_load_file
+            data = buf
             try:
-                t_hash = torr.hashString
-            except AttributeError:
-                logging.error(f'Transmission did not return hash for {torr!r}')
+                local_hash = infohashes(buf.getbuffer())[0]
+            except (BencodeError, RecursionError) as e:  # let transmission decide
+                logging.warning(f'Cannot parse torrent file "{title}": {e}')
+                local_hash = None
+        else:
+            local_hash = magnet_infohashes(data)[0]
+        # duplicates are rejected without a daemon round trip (checked again after adding, in case of concurrent adds)
+        if local_hash is not None and self.db.has_torrent(local_hash):
+            return 'duplicate', title, strings.duplicate
+
+        try:
+            torr, created = self.client.add(data, download_dir=download_dir, **add_args)  # created - not a torrent-duplicate
+            self.torrents.invalidate(membership=True)
+        except Exception:
+            log_error()
+            return 'error', title, strings.error
+
+        t_hash = getattr(torr, 'hashString', None) or local_hash
+        if t_hash is None:
+            logging.error(f'Transmission did not return hash for {torr!r}')
+            if created:
                 self.client.remove_torrent(torr.id, delete_data=True)
-                self.answer(update, context, strings.nohash, reply_markup=ReplyKeyboardRemove())
-                return
+            return 'nohash', title, strings.nohash
 
-            uid = update.effective_user.id
-            if self.db.has_torrent(t_hash):
-                self.answer(update, context, strings.duplicate, reply_markup=ReplyKeyboardRemove())
-                return
-            self.db.add_torrent(t_hash, uid, active=True)
-            self.answer(update, context, strings.added, reply_markup=ReplyKeyboardRemove())
+        try:
+            size = self.client.get_torrent(torr.id, arguments=['id', 'sizeWhenDone']).sizeWhenDone
+        except Exception:  # not critical, will be fixed by the db updater
+            log_error()
+            size = 0
+        with self.db.transaction():  # concurrent adds of the same user are checked against the quota one by one
+            duplicate = self.db.has_torrent(t_hash)
+            usage = self.db.usage(uid)
+            over_quota = not duplicate and quota is not None and usage + size > quota
+            if not duplicate and not over_quota:
+                self.db.add_torrent(t_hash, uid, active=True, size=size)
+        if duplicate:
+            return 'duplicate', title, strings.duplicate
+        if over_quota:
+            if created:  # a torrent which was already in transmission (e.g. added externally) is left as is
+                self.client.remove_torrent(torr.id, delete_data=True)
+                self.torrents.invalidate(membership=True)
+            return 'quota', title, strings.quota_exceeded.format(strings.format_size(usage + size), strings.format_size(quota))
+        return 'added', title, strings.added
+
+    def _load_torrent(self, document):
+        """Downloads a torrent file, returns (buf, files) or None if it cannot be downloaded.
+        files - list of (index, path, size) without padding files, empty if the file cannot be parsed
+        """
+        try:
+            buf = self._download(document)
+        except Exception:
+            log_error()
+            return None
+        try:
+            files = [(i, path, size) for i, (path, size, padding) in enumerate(iter_files(buf.getbuffer())) if not padding]
+        except (BencodeError, RecursionError, KeyError, TypeError) as e:  # let transmission decide
+            logging.warning(f'Cannot parse torrent file "{document.file_name}": {e}')
+            files = []
+        return buf, files
+
+    def _start_preview(self, loaded, document, download_dir, update, context):
+        """Shows the file list of a multi-file torrent to select files before adding it,
+        a torrent with nothing to select is added as is. loaded - result of _load_torrent
+        """
+        if loaded is None:
+            self.answer(update, context, strings.error_load_file, reply_markup=ReplyKeyboardRemove())
+            return
+        buf, files = loaded
+        if len(files) <= 1:
+            item = ('file', document)
+
+            def done(results):
+                msg = results[0][2] if results[0] else strings.error
+                self.answer(update, context, msg, reply_markup=ReplyKeyboardRemove())
+            self.ingest.submit(update.effective_chat.id, [partial(self._add_one, item, update.effective_user.id, download_dir, buf=buf)], done)
+            return
+        # parsed once and kept for this preview only, dropped (with the file) on add, cancel or after preview_ttl
+        pid = next(self.preview_ids)
+        self.jq.run_once(self.expire_preview, self.batch_cfg['preview_ttl'], context=(context.chat_data, pid), name=f'preview_{pid}')
+        context.chat_data['preview'] = {
+            'id': pid,
+            'document': document,
+            'buf': buf,
+            'download_dir': download_dir,
+            'indices': array('l', (i for i, _, _ in files)),  # transmission file indices
+            'paths': ['/'.join(path[1:]) for _, path, _ in files],
+            'sizes': array('q', (size for _, _, size in files)),
+            'priority': bytearray(len(files)),  # index in strings.file_priority
+        }
+        self.answer(update, context, strings.preview_hint, reply_markup=ReplyKeyboardRemove())
+        text, markup = self._preview_page(context.chat_data['preview'], 0)
+        self.answer(update, context, text, reply_markup=markup)
+
+    @timed_job
+    def expire_preview(self, context):
+        chat_data, pid = context.job.context
+        preview = chat_data.get('preview')
+        if preview is not None and preview['id'] == pid:  # not added, cancelled or replaced by a newer one
+            del chat_data['preview']
+
+    def _preview_page(self, preview, page):
+        """Returns (text, markup) for a page of the file list"""
+        files_per_page = 8
+        count = len(preview['paths'])
+        pages = (count + files_per_page - 1) // files_per_page
+        page = min(page, pages - 1)
+        first = page * files_per_page
+        shown = range(first, min(first + files_per_page, count))
+        skip = len(strings.file_priority) - 1
+        pid = preview['id']
+
+        selected = [i for i in range(count) if preview['priority'][i] != skip]
+        text = strings.format_preview(
+            preview['document'].file_name or 'torrent',
+            len(selected), count, sum(preview['sizes'][i] for i in selected), sum(preview['sizes']),
+            [(i + 1, preview['paths'][i], preview['sizes'][i], preview['priority'][i]) for i in shown]
+        )
+        rows = [
+            [InlineKeyboardButton(strings.format_file_button(i + 1, preview['paths'][i], preview['priority'][i]), callback_data=f'file={pid},{i},{page}')]
+            for i in shown
+        ]
+        rows.append([
+            InlineKeyboardButton('⬅', callback_data=f'files={pid},page,{max(page - 1, 0)}'),
+            InlineKeyboardButton(f'{page + 1} / {pages}', callback_data=f'files={pid},page,{page}'),
+            InlineKeyboardButton('➡', callback_data=f'files={pid},page,{min(page + 1, pages - 1)}')
+        ])
+        rows.append([
+            InlineKeyboardButton('✅ Все', callback_data=f'files={pid},all,{page}'),
+            InlineKeyboardButton('❌ Ничего', callback_data=f'files={pid},none,{page}')
+        ])
+        rows.append([
+            InlineKeyboardButton('➕ Добавить', callback_data=f'files={pid},add,{page}'),
+            InlineKeyboardButton('🚫 Отмена', callback_data=f'files={pid},cancel,{page}')
+        ])
+        return text, InlineKeyboardMarkup(rows)
+
+    def _edit_preview(self, update, preview, page):
+        text, markup = self._preview_page(preview, page)
+        try:
+            update.callback_query.message.edit_text(text, reply_markup=markup)
+        except BadRequest:
+            pass  # not modified
+        update.callback_query.answer()
 
-        if context.chat_data.get('torrent'):
-            try:
-                tfile = context.chat_data['torrent'].get_file()
-                with BytesIO() as buf:
-                    tfile.download(out=buf)
-                    buf.seek(0)
-                    client_add(buf)
-            except Exception as e:
-                self.answer(update, context, strings.error_load_file, reply_markup=ReplyKeyboardRemove())
-                log_error()
-            del context.chat_data['torrent']
+    def _get_preview(self, context, pid):
+        """Current preview of the chat, None if there is none or the button belongs to another (older) preview"""
+        preview = context.chat_data.get('preview')
+        return preview if preview is not None and preview['id'] == pid else None
+
+    def file_priority(self, update, context):
+        """Cycles normal -> high -> low -> skip"""
+        pid, i, page = map(int, context.match.groups())
+        preview = self._get_preview(context, pid)
+        if preview is None or i >= len(preview['priority']):
+            self.answer_callback(update, context, strings.preview_expired)
+            return
+        preview['priority'][i] = (preview['priority'][i] + 1) % len(strings.file_priority)
+        self._edit_preview(update, preview, page)
+
+    def preview_action(self, update, context):
+        pid, action, page = context.match.groups()
+        preview = self._get_preview(context, int(pid))
+        if preview is None:
+            self.answer_callback(update, context, strings.preview_expired)
+            return
+        skip = len(strings.file_priority) - 1
+        if action == 'page':
+            self._edit_preview(update, preview, int(page))
+        elif action in ['all', 'none']:
+            preview['priority'][:] = bytes([0 if action == 'all' else skip]) * len(preview['priority'])
+            self._edit_preview(update, preview, int(page))
+        elif action == 'cancel':
+            del context.chat_data['preview']
+            update.callback_query.message.edit_text(strings.cancelled)
+            update.callback_query.answer()
         else:
-            client_add(context.chat_data['magnet'])
-            del context.chat_data['magnet']
+            by_priority = {}
+            for index, priority in zip(preview['indices'], preview['priority']):
+                by_priority.setdefault(priority, []).append(index)
+            if skip in by_priority and len(by_priority) == 1:
+                self.answer_callback(update, context, strings.no_files_selected)
+                return
+            del context.chat_data['preview']
+            add_args = {}
+            for priority, arg in [(1, 'priority_high'), (2, 'priority_low'), (skip, 'files_unwanted')]:
+                if by_priority.get(priority):
+                    add_args[arg] = by_priority[priority]
+            update.callback_query.answer()
+            message = update.callback_query.message
+
+            def done(results):
+                message.edit_text(results[0][2] if results[0] else strings.error)
+            self.ingest.submit(update.effective_chat.id, [partial(
+                self._add_one, ('file', preview['document']), update.effective_user.id, preview['download_dir'],
+                buf=preview['buf'], **add_args
+            )], done)
 
 # --------------------------------------------------------------------------------------------------
 # conversation fallbacks
 # --------------------------------------------------------------------------------------------------
 
     def conv_cancel(self, update, context):
-        context.chat_data.clear()
+        # only the state of the conversations, the list selection and /find query are kept
+        for key in ['dl', 'ul', 'batch']:
+            context.chat_data.pop(key, None)
         self.answer(update, context, strings.cancelled, reply_markup=ReplyKeyboardRemove())
         return State.END
 
@@ -560,85 +1134,211 @@ class TBot():
             job.schedule_removal()
             self.create_timer(name, callback, timer, context)
 
-    def create_dl_checker(self): #TODO is db threadsafe? add lock/etc
-        self.jq.run_repeating(self.check_downloads, 60, first=5)
+    def create_metrics(self, metrics_cfg):
+        self.metrics = m = Metrics()
+        self.rpc.stats.histogram = m.histogram('tbot_rpc_duration_seconds', 'Transmission RPC latency', ['method'])
+        self.handler_duration = m.histogram('tbot_handler_duration_seconds', 'Update handler run time', ['handler'])
+        self.job_duration = m.histogram('tbot_job_duration_seconds', 'JobQueue callback run time', ['job'], buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+        self.job_overruns = m.counter('tbot_job_overruns_total', 'Runs of repeating jobs which took longer than their interval', ['job'])
+        job_skipped = m.counter('tbot_job_skipped_total', 'Job runs skipped by the scheduler (previous run still running or misfire)', ['job', 'reason'])
+
+        def on_skipped(event):
+            job = self.jq.scheduler.get_job(event.job_id)
+            job_skipped.inc(job.func.__name__ if job is not None else 'unknown', 'missed' if event.code == EVENT_JOB_MISSED else 'running')
+        self.jq.scheduler.add_listener(on_skipped, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+
+        m.gauge('tbot_notification_queue_depth', 'Messages waiting in the notification queue', self.notifier.depth)
+        m.gauge('tbot_shares', 'Open file shares', lambda: {
+            ('http',): sum(isinstance(key, tuple) and key[-1] == 'http' for key in list(self.shares)),
+            ('ftp',): sum(not (isinstance(key, tuple) and key[-1] == 'http') for key in list(self.shares)),
+        }, ['engine'])
+        if self.ftp_enabled:
+            m.gauge('tbot_ftp_connections', 'Open FTP connections', lambda: dict(zip([('control',), ('data',)], self.ftpd.connections())), ['kind'])
+
+        db_sync = m.histogram('tbot_db_sync_duration_seconds', 'Time of DB writes of torrent state', buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+        db_size = 0
+
+        def on_sync(elapsed, size):
+            nonlocal db_size
+            db_sync.observe(elapsed)
+            db_size = size
+        self.db.on_sync = on_sync
+        m.gauge('tbot_db_sync_size_bytes', 'Size of the last written torrent state (shelve) or of the DB file (sqlite)', lambda: db_size)
+
+        if metrics_cfg.get('enabled'):
+            m.serve(metrics_cfg.get('address', '127.0.0.1:9465').split(':'))
+
+    def create_dl_checker(self):
+        self.jq.run_repeating(self.check_downloads, 30 if self.torrents.incremental else 60, first=5)
 
     def create_disk_checker(self):
-        self.jq.run_repeating(self.check_disk, 60 * 10, first=75)
+        self.jq.run_once(self.check_disk, 75, name='check_disk')  # reschedules itself
 
-    def create_db_updater(self): #TODO is db threadsafe? add lock/etc
+    def create_db_updater(self):
         self.jq.run_repeating(self.update_db, 60 * 15, first=30)
 
 # --------------------------------------------------------------------------------------------------
 # job callbacks
 # --------------------------------------------------------------------------------------------------
 
+    @timed_job
     def stop_ftp(self, context):
         key, user, torrent = context.job.context
-        if key not in self.shares:  # WTF??
-            return
-        del self.shares[key]
-        if self.ftpd.active():
-            self.ftpd.unshare(key)
-        msg = strings.ftp_stop if torrent is None else strings.ftp_unshare.format(torrent)
-        self.updater.bot.send_message(chat_id=user, text=msg, disable_notification=True)
+        with self.shares_lock:
+            if key not in self.shares:  # share was closed manually while the job was starting
+                return
+            del self.shares[key]
+            http = isinstance(key, tuple) and key[-1] == 'http'
+            drop = self.httpd if http else self.ftpd
+            if drop.active():
+                drop.unshare(key)
+        if torrent is None:
+            msg = strings.ftp_stop
+        else:
+            msg = (strings.http_unshare if http else strings.ftp_unshare).format(torrent)
+        self.notifier.send(user, msg, disable_notification=True)
 
     def reset_limit_now(self):
         self.set_limit(None, None)
         self.db.set_timer('reset_limit', None)
 
+    @timed_job
     def reset_limit(self, context):
         self.reset_limit_now()
         self.notify_limit_change()
 
-    def process_finished(self, torrents):
-        for t_hash, t_name in torrents:
-            owner = self.db.get_owner(t_hash)
-            if owner is not None:
-                self.notify_download_finished(owner, t_name)
-        self.db.mark_finished([t[0] for t in torrents])
+    def _mark_finished(self, torrents):
+        """Returns notifications (owner, name) for torrents which weren't processed by another job yet"""
+        with self.db.transaction():
+            active = self.db.get_active()
+            torrents = [t for t in torrents if t[0] in active]
+            self.db.mark_finished([t[0] for t in torrents])
+            owners = [(self.db.get_owner(t_hash), t_name) for t_hash, t_name in torrents]
+        return [(owner, t_name) for owner, t_name in owners if owner is not None]
 
+    def process_finished(self, torrents):
+        for owner, t_name in self._mark_finished(torrents):
+            self.notify_download_finished(owner, t_name)
 
+    @timed_job
     def check_downloads(self, context):
+        if self.torrents.incremental:
+            self.torrents.sync()  # keep deltas within transmission's "recently-active" window
         active = self.db.get_active()
         if not active:
             return
-        finished = [(t.hashString, t.name)
-                    for t in self.client.get_torrents(ids=list(active), arguments=['id', 'hashString', 'name', 'status', 'leftUntilDone'])  # id is used by client
-                    if t.status in ['seeding', 'stopped'] and t.leftUntilDone == 0]
+        torrents = self.torrents.get_torrents(list(active))
+        # sizes change when magnet metadata is received or files are (de)selected
+        self.db.set_sizes([(t.hashString, t.sizeWhenDone) for t in torrents])
+        finished = [(t.hashString, t.name) for t in torrents if t.status in ['seeding', 'stopped'] and t.leftUntilDone == 0]
         if finished:
             self.process_finished(finished)
-
+        self.enforce_quotas(torrents)
+
+    def enforce_quotas(self, torrents):
+        """Stops downloads of users whose torrents exceed their quota. torrents - active torrents"""
+        over_quota = {}  # owner: torrents
+        for t in torrents:
+            if t.status not in ['downloading', 'download pending']:
+                continue
+            try:
+                owner = self.db.get_owner(t.hashString)
+            except KeyError:  # removed concurrently
+                continue
+            quota = self.get_quota(owner) if owner is not None else None
+            if quota is not None and self.db.usage(owner) > quota:
+                over_quota.setdefault(owner, []).append(t)
+        if not over_quota:
+            return
+        self.client.stop_torrent(ids=[t.id for owned in over_quota.values() for t in owned])
+        self.torrents.invalidate()
+        for owner, owned in over_quota.items():
+            usage, quota = self.db.usage(owner), self.get_quota(owner)
+            logging.info(f'Quota exceeded by {owner} ({usage} of {quota} bytes), stopped {len(owned)} torrents')
+            names = '\n'.join(f'• {t.name}' for t in owned)
+            self.notifier.send(owner, strings.quota_stopped.format(strings.format_size(usage), strings.format_size(quota), names))
+
+    @timed_job
     def check_disk(self, context):
+        interval = self.disk_guard_cfg['max_interval']
+        try:
+            interval = self._check_disk(context)
+        finally:
+            self.jq.run_once(self.check_disk, interval, name='check_disk')
+
+    def _check_disk(self, context):
+        """Stops all downloads if the free space is expected to go below reserved_space within the guard horizon.
+        Returns the delay before the next check (shorter when time-to-full is small)
+        """
+        cfg = self.disk_guard_cfg
         used, avail = self.get_disk_stats()
-        if avail <= self.reserved_space and not self.db.disk_full():
-            #TODO thread-safety for client and db?
-            self.update_db(context) # is it ok?  #if executed with db updater (in different thread) (is it possible?)
-            active = self.db.get_active()
-            if active:
-                self.client.stop_torrent(ids=list(active))
-                self.db.mark_finished(list(self.db.get_active()))
-            self.notify_disk_full(True)
-            self.db.set_disk_full(True)
-        if avail > self.reserved_space and self.db.disk_full():
-            self.notify_disk_full(False)
-            self.db.set_disk_full(False)
-
+        headroom = avail - self.reserved_space
+        # the job may run every min_interval seconds: a fresh cached snapshot is used if there is one, otherwise
+        # only the aggregate rate and the remaining bytes of torrents which aren't finished (according to the db) are fetched
+        snapshot = self.torrents.peek()
+        if snapshot is not None:
+            incomplete = [t for t in snapshot.values() if t.leftUntilDone > 0]
+            rate = sum(t.rateDownload for t in incomplete if t.status == 'downloading')
+            left = sum(t.leftUntilDone for t in incomplete)
+        else:
+            rate = self.client.raw_call('session-stats')['downloadSpeed']
+            pending = list(self.db.get_active())
+            left = sum(t.leftUntilDone for t in self.client.get_torrents(pending, arguments=['id', 'leftUntilDone'])) if pending else 0
+        time_to_full = headroom / rate if rate > 0 else float('inf')
+        interval = min(max(time_to_full / 4, cfg['min_interval']), cfg['max_interval'])
+
+        if not self.db.disk_full():
+            # remaining downloads don't fit and the free space will run out soon
+            full = headroom <= 0 or (left > headroom and time_to_full <= cfg['horizon'])
+        else:
+            # hysteresis: wait until the downloads fit or there is enough space for the rate which triggered the guard
+            full = headroom <= 0 or (left > headroom and headroom <= 2 * self.disk_full_rate * cfg['horizon'])
+        if full == self.db.disk_full():
+            return interval
+        active = None
+        if full:
+            self.update_db(context)  # serialized with the db updater job by db.transaction()
+            active = list(self.db.get_active())
+            if active:  # stopping twice (if another thread does the same) is harmless, the RPC is done without the db lock
+                self.client.stop_torrent(ids=active)
+                self.torrents.invalidate()
+        with self.db.transaction():
+            if full == self.db.disk_full():  # already processed in another thread
+                return interval
+            if full:
+                if active:
+                    self.db.mark_finished(active)
+                self.disk_full_rate = rate
+                logging.warning(f'Disk guard: {headroom} bytes left above reserved space, download rate {rate} B/s, {left} bytes left to download. All torrents were stopped')
+            self.db.set_disk_full(full)
+        self.notify_disk_full(full, predicted=headroom > 0)
+        return interval
+
+    @timed_job
     def update_db(self, context):
-        torrents = self.client.get_torrents(arguments=['id', 'hashString', 'name', 'status', 'leftUntilDone'])  # id is used by client
-        active = self.db.get_active()
-        finished = [(t.hashString, t.name) for t in torrents if t.status in ['seeding', 'stopped'] and t.leftUntilDone == 0 and t.hashString in active]
-        if finished:
-            self.process_finished(finished)
-        self.db.update_torrents([(t.hashString, t.status not in ['seeding', 'stopped'] or t.leftUntilDone > 0) for t in torrents])
+        # in incremental mode only torrents changed since the previous call are processed (unless a full resync was done)
+        notifications = []
+        self.torrents.sync()  # RPC is done without the db lock, changes made meanwhile are popped by the next call
+        with self.db.transaction():  # changes must be popped and applied atomically
+            full, torrents, removed = self.torrents.pop_changes()
+            logging.debug(f'Torrent cache stats: {self.torrents.stats()}, RPC stats: {self.rpc.stats.summary()}')
+            active = self.db.get_active()
+            finished = [(t.hashString, t.name) for t in torrents if t.status in ['seeding', 'stopped'] and t.leftUntilDone == 0 and t.hashString in active]
+            if finished:
+                notifications = self._mark_finished(finished)
+            states = [(t.hashString, t.status not in ['seeding', 'stopped'] or t.leftUntilDone > 0, t.sizeWhenDone) for t in torrents]
+            if full:
+                self.db.update_torrents(states)
+            else:
+                self.db.apply_changes(states, removed)
+        for owner, t_name in notifications:
+            self.notify_download_finished(owner, t_name)
 
 # --------------------------------------------------------------------------------------------------
 # notifications
 # --------------------------------------------------------------------------------------------------
 
     def notify_limit_change(self, origin=None):
-        # TODO async? is session threadsafe?
-        # NOTE is spam limit an issue?
         active, descr = self.get_limit_info()
         if active:
             msg = strings.notif_limit_set + descr
@@ -646,17 +1346,32 @@ class TBot():
             msg = strings.notif_limit_reset
         for user in self.db.whitelist():
             if user != origin:
-                self.updater.bot.send_message(chat_id=user, text=msg, disable_notification=True)
+                self.notifier.send(user, msg, disable_notification=True)
 
     def notify_download_finished(self, user, title):
-        self.updater.bot.send_message(chat_id=user, text=strings.finished.format(title))
-
-    def notify_disk_full(self, full):
-        # TODO async?
-        # NOTE is spam limit an issue?
-        msg = strings.disk_full if full else strings.disk_ok
+        # completions are buffered for digest_window seconds and sent as a single digest
+        if self.digest_window <= 0:
+            for msg in strings.format_finished([title], self.digest_max_length):
+                self.notifier.send(user, msg)
+            return
+        with self.digest_lock:
+            titles = self.finished_digest.setdefault(user, [])
+            titles.append(title)
+            if len(titles) == 1:
+                self.jq.run_once(self.send_finished_digest, self.digest_window, context=user, name=f'digest_{user}')
+
+    @timed_job
+    def send_finished_digest(self, context):
+        user = context.job.context
+        with self.digest_lock:
+            titles = self.finished_digest.pop(user, [])
+        for msg in strings.format_finished(titles, self.digest_max_length):
+            self.notifier.send(user, msg)
+
+    def notify_disk_full(self, full, predicted=False):
+        msg = (strings.disk_full_soon if predicted else strings.disk_full) if full else strings.disk_ok
         for user in self.db.whitelist():
-            self.updater.bot.send_message(chat_id=user, text=msg)
+            self.notifier.send(user, msg)
 
 # --------------------------------------------------------------------------------------------------
 # utils
@@ -690,6 +1405,17 @@ class TBot():
             params['speed_limit_up'] = ul
         self.client.set_session(**params)
 
+    def get_quota(self, user):
+        """Returns the quota (in bytes) or None if the user is not limited"""
+        users = self.quota_cfg.get('users') or {}
+        if user in users:
+            quota = users[user]
+        elif user in self.admins:
+            return None
+        else:
+            quota = self.quota_cfg.get('default', 0)
+        return quota or None
+
     def get_disk_stats(self):
         # use self.client.free_space(...)?
         stats = os.statvfs(self.rootdir)
@@ -702,6 +1428,10 @@ class TBot():
             return
         if hasattr(self, 'ftpd'):
             self.ftpd.force_stop()
+        if hasattr(self, 'httpd'):
+            self.httpd.force_stop()
+        if hasattr(self, 'metrics'):
+            self.metrics.stop()
 
 # --------------------------------------------------------------------------------------------------
 # BOT END
@@ -710,7 +1440,8 @@ class TBot():
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', metavar='FILE', help='Config file', required=True)
-    parser.add_argument('--db', metavar='FILE', help='DB file (default: "config_directory/data.db")')
+    parser.add_argument('--db', metavar='FILE', help='DB file (default: "config_directory/data.db" or "config_directory/data.sqlite")')
+    parser.add_argument('--db-backend', choices=['shelve', 'sqlite'], default='shelve', help='DB backend (default: shelve). Use migrate_db.py to import an existing shelve DB into SQLite')
     parser.add_argument('--log', metavar='FILE', help='Log file (default: write to stderr)')
     args = parser.parse_args()
 
@@ -720,8 +1451,10 @@ def main():
     else:
         logging_cfg['stream'] = sys.stderr
     logging.basicConfig(**logging_cfg)
-    db_path = args.db or str(Path(args.config).parent.joinpath('data.db').absolute())
-    bot = TBot(args.config, db_path)
+    default_db = 'data.sqlite' if args.db_backend == 'sqlite' else 'data.db'
+    db_path = args.db or str(Path(args.config).parent.joinpath(default_db).absolute())
+    bot = TBot(args.config, db_path, args.db_backend)
+    bot.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+
+
+# union of fields used by list/info views and background jobs ('id' is used by client)
+FIELDS = ['id', 'hashString', 'name', 'status', 'progress', 'sizeWhenDone', 'leftUntilDone',
+          'rateDownload', 'rateUpload', 'peersConnected', 'peersSendingToUs', 'peersGettingFromUs',
+          'uploadRatio', 'eta']
+# fields of the sorted list index and of a torrent list page (progress is computed from sizeWhenDone and leftUntilDone)
+INDEX_FIELDS = ['id', 'hashString', 'name']
+PAGE_FIELDS = INDEX_FIELDS + ['status', 'sizeWhenDone', 'leftUntilDone']
+PAGE_CACHE_SIZE = 1000
+
+# transmission reports torrents (and removals) from the last 60 seconds as "recently-active"
+# deltas older than that may miss changes, so a full resync is done instead
+RECENTLY_ACTIVE_WINDOW = 50
+
+
+class TorrentCache():
+    """In-process snapshot of torrent state, shared by all views and jobs.
+
+    The snapshot is refreshed when it is older than `ttl` seconds or after invalidate()
+    is called (e.g. after start/stop/remove/add).
+    In incremental mode only "recently-active" torrents are fetched on refresh.
+    A full fetch is done on the first refresh and when drift is detected
+    (torrent count differs from the daemon's one or the last refresh is too old).
+
+    Torrent lists are paginated with a sorted (name, hash, id) index, which is rebuilt only when
+    torrents are added, removed or renamed. Pages are fetched separately (see get_page()),
+    so a page view doesn't depend on the library size.
+    """
+
+    def __init__(self, client, ttl, incremental=False):
+        self.client = client
+        self.ttl = ttl
+        self.incremental = incremental
+        self.hits = 0
+        self.misses = 0
+        self.full_syncs = 0
+        self.delta_syncs = 0
+        self.index_builds = 0
+        self.page_fetches = 0
+
+        self._lock = threading.Lock()
+        self._torrents = {}  # hash: Torrent
+        self._ids = {}  # id: hash
+        self._updated = None
+        self._synced = None  # time of the last successful fetch, also used for delta window checks
+        self._entries = {}  # hash: (name, hash, id)
+        self._index = None  # sorted list of (name, hash, id), None if it should be rebuilt
+        self._pages = {}  # hash: (time, Torrent) fetched for list pages
+
+        # changes since the last pop_changes() call
+        self._full = True
+        self._changed = set()
+        self._removed = set()
+
+    def _fresh(self, max_age):
+        if self._updated is None:
+            return False
+        age = time.monotonic() - self._updated
+        return age < self.ttl and (max_age is None or age < max_age)
+
+    def _store(self, torrents, items):
+        for t in items:
+            torrents[t.hashString] = t
+            self._ids[t.id] = t.hashString
+            self._changed.add(t.hashString)
+
+    def _check_index(self, torrents, changed):
+        """Drops the index if torrents were added, removed or renamed. changed - Torrents to compare"""
+        entries = self._entries
+        if len(torrents) != len(entries) or any(entries.get(t.hashString, (None,))[0] != t.name for t in changed):
+            self._index = None
+
+    def _full_sync(self):
+        items = self.client.get_torrents(arguments=FIELDS)
+        torrents = {}
+        self._ids = {}
+        self._store(torrents, items)
+        self._check_index(torrents, torrents.values())
+        self._torrents = torrents
+        self._full = True
+        self.full_syncs += 1
+
+    def _delta_sync(self):
+        changed, removed = self.client.get_recently_active(FIELDS)
+        torrents = dict(self._torrents)  # snapshots returned earlier are never modified
+        for t_id in removed:
+            t_hash = self._ids.pop(t_id, None)
+            if t_hash is not None and torrents.pop(t_hash, None) is not None:
+                self._removed.add(t_hash)
+        self._store(torrents, changed)
+        self._check_index(torrents, changed)
+        self._torrents = torrents
+        self.delta_syncs += 1
+
+        count = self.client.raw_call('session-stats')['torrentCount']
+        if count != len(torrents):
+            logging.warning(f'Torrent cache drift detected ({len(torrents)} cached, {count} in transmission), doing full resync')
+            self._full_sync()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if not self.incremental:
+            torrents = self.client.get_torrents(arguments=FIELDS)
+            self._torrents = {t.hashString: t for t in torrents}
+            self._check_index(self._torrents, torrents)
+            self._full = True
+            self.full_syncs += 1
+        elif self._synced is None or now - self._synced > RECENTLY_ACTIVE_WINDOW:
+            self._full_sync()
+        else:
+            self._delta_sync()
+        self._updated = self._synced = now
+
+    def snapshot(self, max_age=None):
+        """Returns {hash: Torrent} for all torrents. The returned dict is never modified in place."""
+        with self._lock:
+            if self._fresh(max_age):
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._refresh()
+            return self._torrents
+
+    def peek(self):
+        """Returns the snapshot ({hash: Torrent}) if it is fresh, None otherwise. Never refreshes it"""
+        with self._lock:
+            return self._torrents if self._fresh(None) else None
+
+    def sync(self):
+        """Refresh the snapshot now"""
+        return self.snapshot(max_age=0)
+
+    def pop_changes(self):
+        """Returns (full, changed, removed) accumulated since the previous call.
+
+        full - True if a full fetch was done, `changed` then contains all torrents
+        changed - list of new or updated Torrents
+        removed - list of hashes of removed torrents
+        """
+        with self._lock:
+            full = self._full
+            if full or not self.incremental:
+                changed = list(self._torrents.values())
+                removed = []
+            else:
+                changed = [self._torrents[t_hash] for t_hash in self._changed if t_hash in self._torrents]
+                removed = [t_hash for t_hash in self._removed if t_hash not in self._torrents]
+            self._full = False
+            self._changed = set()
+            self._removed = set()
+            return full, changed, removed
+
+    def get_torrents(self, hashes=None, max_age=None):
+        """hashes - iterable of hashStrings or None (all torrents). Unknown hashes are skipped"""
+        torrents = self.snapshot(max_age)
+        if hashes is None:
+            return list(torrents.values())
+        return [torrents[t_hash] for t_hash in hashes if t_hash in torrents]
+
+    def get_torrent(self, t_hash, max_age=None):
+        """Raises KeyError if there is no such torrent"""
+        return self.snapshot(max_age)[t_hash]
+
+    def index(self, hashes=None):
+        """Returns a list of (name, hash, id) sorted by name.
+        hashes - iterable of hashStrings or None (all torrents). Unknown hashes are skipped
+        """
+        with self._lock:
+            if self._index is None:
+                if self._fresh(None):
+                    torrents = self._torrents.values()
+                else:  # a full snapshot would be too expensive, only the light fields are fetched
+                    torrents = self.client.get_torrents(arguments=INDEX_FIELDS)
+                self._entries = {t.hashString: (t.name, t.hashString, t.id) for t in torrents}
+                self._index = sorted(self._entries.values())
+                self.index_builds += 1
+            entries, index = self._entries, self._index
+        if hashes is None:
+            return index
+        return sorted(entries[t_hash] for t_hash in hashes if t_hash in entries)
+
+    def get_page(self, entries):
+        """entries - slice of index(). Returns Torrents (with at least PAGE_FIELDS) in the same order.
+        Torrents which are neither in a fresh snapshot nor in the page cache are fetched with a single request.
+        """
+        now = time.monotonic()
+        with self._lock:
+            snapshot = self._torrents if self._fresh(None) else {}
+        pages = self._pages
+        torrents = {}
+        missing = []
+        for _, t_hash, t_id in entries:
+            t = snapshot.get(t_hash)
+            if t is None:
+                cached = pages.get(t_hash)
+                if cached is not None and now - cached[0] < self.ttl:
+                    t = cached[1]
+            if t is None:
+                missing.append((t_hash, t_id))
+            else:
+                torrents[t_hash] = t
+        if missing:
+            fetched = self.client.get_torrents([t_id for _, t_id in missing], arguments=PAGE_FIELDS)
+            self.page_fetches += 1
+            with self._lock:
+                if len(self._pages) > PAGE_CACHE_SIZE:
+                    self._pages = {t_hash: cached for t_hash, cached in self._pages.items() if now - cached[0] < self.ttl}
+                for t in fetched:
+                    self._pages[t.hashString] = (now, t)
+                    torrents[t.hashString] = t
+                if any(t_hash not in torrents for t_hash, _ in missing):  # removed outside of the bot or ids changed
+                    self._index = None
+        return [torrents[t_hash] for _, t_hash, _ in entries if t_hash in torrents]
+
+    def invalidate(self, membership=False):
+        """membership - torrents were added or removed, the list index should be rebuilt"""
+        with self._lock:
+            self._updated = None
+            self._pages = {}
+            if membership:
+                self._index = None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'full_syncs': self.full_syncs,
+            'delta_syncs': self.delta_syncs,
+            'index_builds': self.index_builds,
+            'page_fetches': self.page_fetches,
+            'torrents': len(self._torrents),
+        }
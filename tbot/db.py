@@ -1,14 +1,38 @@
+import threading
+import time
+from functools import wraps
+
 import shelve2 as shelve
+from profiling import section
+from registry import TorrentRegistry
+
+
+def locked(method):
+    """Serialize calls to a DB method (see BotDB.transaction)"""
+    @wraps(method)
+    def wrapped(self, *args, **kwargs):
+        with section('db'), self.lock:
+            return method(self, *args, **kwargs)
+    return wrapped
 
 
 class BotDB():
+    """Mutations (and shelve file access) are serialized with a reentrant lock, torrent state reads are lock-free.
+    Use `with db.transaction():` for read-modify-write sequences.
+    """
+
     def __init__(self, path):
+        self.lock = threading.RLock()
         self.db = shelve.open(path)
-        # FIXME need something better
-        self.db.setdefault('torrents', {'active': set(), 'owner': {}, 'owned': {}})
+        torrents = self.db.setdefault('torrents', TorrentRegistry())
+        if isinstance(torrents, dict):  # old dict-of-sets layout
+            self.db['torrents'] = TorrentRegistry.from_legacy(torrents)
+        self.torrents = self.db['torrents']
         self.db.setdefault('whitelist', [])
+        self.on_sync = None  # callback(elapsed, size in bytes) after each write of the torrent registry
 
 
+    @locked
     def whitelist_user(self, user):
         self.db['whitelist'].append(user)
         self.db.sync(['whitelist'])
@@ -16,81 +40,110 @@ class BotDB():
     def whitelist(self):
         return self.db['whitelist']
 
+    @locked
     def set_timer(self, name, time):
         self.db[f'timer_{name}'] = time
 
+    @locked
     def get_timer(self, name):
         return self.db.get(f'timer_{name}')
 
+    def transaction(self):
+        return self.lock
+
+    @locked
     def update_torrents(self, torrents):
-        """torrents - list of (hash, active)"""
-        hashes = {t[0] for t in torrents}
+        """torrents - list of (hash, active, size) for all existing torrents"""
+        self.apply_changes(torrents, self.torrents.missing(t[0] for t in torrents))
+        self.torrents.recount_usage()  # full reconciliation, in case per-owner totals have drifted
+
+    @locked
+    def apply_changes(self, torrents, removed):
+        """torrents - list of (hash, active, size) for new or changed torrents, removed - list of hashes"""
         need_sync = False
-        for t_hash in self.all_torrents():
-            if t_hash not in hashes:
+        for t_hash in removed:
+            if self.has_torrent(t_hash):
                 need_sync = True
-                self._remove_torrent(t_hash)
-        for t_hash, active in torrents:
+                self.torrents.remove(t_hash)
+        for t_hash, active, size in torrents:
             if not self.has_torrent(t_hash):
                 need_sync = True
-                self._add_torrent(t_hash, None, active=active)
-            elif active and t_hash not in self.get_active():  # if user selected additional files to download?
+                self.torrents.add(t_hash, None, active, size)
+                continue
+            if active and self.torrents.set_active(t_hash, True):  # if user selected additional files to download?
+                need_sync = True
+            if self.torrents.set_size(t_hash, size):
                 need_sync = True
-                self.db['torrents']['active'].add(t_hash)
         if need_sync:
             self._sync_torrents()
 
-    def add_torrent(self, t_hash, owner=None, *, active):
-        self._add_torrent(t_hash, owner, active)
+    @locked
+    def add_torrent(self, t_hash, owner=None, *, active, size=0):
+        self.torrents.add(t_hash, owner, active, size)
         self._sync_torrents()
 
-    def _add_torrent(self, t_hash, owner, active):
-        self.db['torrents']['owner'][t_hash] = owner
-        if active:
-            self.db['torrents']['active'].add(t_hash)
-        if owner is not None:
-            self.db['torrents']['owned'].setdefault(owner, set()).add(t_hash)
-
+    @locked
     def remove_torrent(self, t_hash):
-        self._remove_torrent(t_hash)
+        self.torrents.remove(t_hash)
         self._sync_torrents()
 
-    def _remove_torrent(self, t_hash):
-        owner = self.get_owner(t_hash)
-        if owner is not None:
-            self.db['torrents']['owned'][owner].discard(t_hash)
-        del self.db['torrents']['owner'][t_hash]
-        self.db['torrents']['active'].discard(t_hash)
+    @locked
+    def remove_torrents(self, hashes):
+        """Unknown hashes are ignored"""
+        for t_hash in hashes:
+            if self.has_torrent(t_hash):
+                self.torrents.remove(t_hash)
+        self._sync_torrents()
 
     def has_torrent(self, t_hash):
-        return t_hash in self.db['torrents']['owner']
+        return t_hash in self.torrents
 
     def get_active(self):
-        return self.db['torrents']['active']
+        return self.torrents.active()
 
     def get_owner(self, t_hash):
-        return self.db['torrents']['owner'][t_hash]
+        return self.torrents.owner(t_hash)
 
     def all_torrents(self):
-        return list(self.db['torrents']['owner'].keys())
+        return self.torrents.hashes()
 
     def owned_torrents(self, owner):
-        return list(self.db['torrents']['owned'].get(owner, []))
+        return self.torrents.owned(owner)
+
+    def usage(self, owner):
+        """Total size (in bytes) of torrents owned by `owner`"""
+        return self.torrents.usage(owner)
+
+    @locked
+    def set_sizes(self, sizes):
+        """sizes - list of (hash, size)"""
+        changed = False
+        for t_hash, size in sizes:
+            changed = self.torrents.set_size(t_hash, size) or changed
+        if changed:
+            self._sync_torrents()
 
+    @locked
     def mark_finished(self, hashes):
         for t_hash in hashes:
-            self.db['torrents']['active'].discard(t_hash)
+            self.torrents.set_active(t_hash, False)
         self._sync_torrents()
 
+    @locked
     def disk_full(self):
-        return self.db['disk_full']
+        return self.db.get('disk_full', False)
 
+    @locked
     def set_disk_full(self, value):
         self.db['disk_full'] = value
 
     def _sync_torrents(self):
+        start = time.perf_counter()
         self.db.sync(['torrents'])
+        if self.on_sync is not None:
+            self.on_sync(time.perf_counter() - start, self.db.sizes.get('torrents', 0))
 
 
+    @locked
     def close(self):
         self.db.close()
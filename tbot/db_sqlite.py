@@ -0,0 +1,221 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from db import locked
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    uid INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS torrents (
+    hash TEXT PRIMARY KEY,
+    owner INTEGER,
+    active INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS torrents_owner ON torrents(owner);
+CREATE INDEX IF NOT EXISTS torrents_active ON torrents(active) WHERE active;
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS usage (
+    owner INTEGER PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0
+);
+-- per-owner totals are maintained by triggers, so usage() is a single primary key lookup
+CREATE TRIGGER IF NOT EXISTS usage_insert AFTER INSERT ON torrents WHEN NEW.owner IS NOT NULL BEGIN
+    INSERT OR IGNORE INTO usage (owner) VALUES (NEW.owner);
+    UPDATE usage SET size = size + NEW.size WHERE owner = NEW.owner;
+END;
+CREATE TRIGGER IF NOT EXISTS usage_delete AFTER DELETE ON torrents WHEN OLD.owner IS NOT NULL BEGIN
+    UPDATE usage SET size = size - OLD.size WHERE owner = OLD.owner;
+END;
+CREATE TRIGGER IF NOT EXISTS usage_update AFTER UPDATE OF owner, size ON torrents BEGIN
+    UPDATE usage SET size = size - OLD.size WHERE owner = OLD.owner;
+    INSERT OR IGNORE INTO usage (owner) SELECT NEW.owner WHERE NEW.owner IS NOT NULL;
+    UPDATE usage SET size = size + NEW.size WHERE owner = NEW.owner;
+END;
+'''
+
+
+class SqliteBotDB():
+    """BotDB with the same API, stored in SQLite (WAL mode).
+
+    Each thread uses its own connection. Single-row mutations are executed in autocommit mode,
+    multi-row ones are wrapped in a single transaction.
+    Mutations are also serialized in-process (see BotDB), reads are lock-free.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.path = path
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self.on_sync = None  # callback(elapsed, size of the DB and WAL files) after each multi-row transaction
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        # whitelist is shared with handlers by reference (see restricted_template), so it's kept in memory too
+        self._whitelist = [row[0] for row in conn.execute('SELECT uid FROM users ORDER BY uid')]
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        start = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        if self.on_sync is not None:
+            wal = self.path + '-wal'
+            self.on_sync(time.perf_counter() - start, os.path.getsize(self.path) + (os.path.getsize(wal) if os.path.exists(wal) else 0))
+
+
+    @locked
+    def whitelist_user(self, user):
+        self._conn().execute('INSERT OR IGNORE INTO users (uid) VALUES (?)', (user,))
+        self._whitelist.append(user)
+
+    def whitelist(self):
+        return self._whitelist
+
+    @locked
+    def _set_value(self, key, value):
+        self._conn().execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def _get_value(self, key, default=None):
+        row = self._conn().execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set_timer(self, name, time):
+        self._set_value(f'timer_{name}', time)
+
+    def get_timer(self, name):
+        return self._get_value(f'timer_{name}')
+
+    def transaction(self):
+        return self.lock
+
+    @locked
+    def update_torrents(self, torrents):
+        """torrents - list of (hash, active, size) for all existing torrents"""
+        hashes = {t[0] for t in torrents}
+        self.apply_changes(torrents, [t_hash for t_hash in self.all_torrents() if t_hash not in hashes])
+        with self._transaction() as conn:  # full reconciliation, in case per-owner totals have drifted
+            conn.execute('DELETE FROM usage')
+            conn.execute('INSERT INTO usage (owner, size) SELECT owner, SUM(size) FROM torrents WHERE owner IS NOT NULL GROUP BY owner')
+
+    @locked
+    def apply_changes(self, torrents, removed):
+        """torrents - list of (hash, active, size) for new or changed torrents, removed - list of hashes"""
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM torrents WHERE hash = ?', ((t_hash,) for t_hash in removed))
+            conn.executemany('INSERT OR IGNORE INTO torrents (hash, owner, active, size) VALUES (?, NULL, ?, ?)',
+                             ((t_hash, int(active), size) for t_hash, active, size in torrents))
+            # if user selected additional files to download?
+            conn.executemany('UPDATE torrents SET active = 1 WHERE hash = ? AND NOT active',
+                             ((t[0],) for t in torrents if t[1]))
+            conn.executemany('UPDATE torrents SET size = ? WHERE hash = ? AND size != ?',
+                             ((size, t_hash, size) for t_hash, active, size in torrents))
+
+    @locked
+    def add_torrent(self, t_hash, owner=None, *, active, size=0):
+        # not INSERT OR REPLACE: the implicit delete wouldn't fire the usage trigger
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM torrents WHERE hash = ?', (t_hash,))
+            conn.execute('INSERT INTO torrents (hash, owner, active, size) VALUES (?, ?, ?, ?)', (t_hash, owner, int(active), size))
+
+    @locked
+    def remove_torrent(self, t_hash):
+        self._conn().execute('DELETE FROM torrents WHERE hash = ?', (t_hash,))
+
+    @locked
+    def remove_torrents(self, hashes):
+        """Unknown hashes are ignored"""
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM torrents WHERE hash = ?', ((t_hash,) for t_hash in hashes))
+
+    def has_torrent(self, t_hash):
+        return self._conn().execute('SELECT 1 FROM torrents WHERE hash = ?', (t_hash,)).fetchone() is not None
+
+    def get_active(self):
+        return {row[0] for row in self._conn().execute('SELECT hash FROM torrents WHERE active')}
+
+    def get_owner(self, t_hash):
+        row = self._conn().execute('SELECT owner FROM torrents WHERE hash = ?', (t_hash,)).fetchone()
+        if row is None:
+            raise KeyError(t_hash)
+        return row[0]
+
+    def all_torrents(self):
+        return [row[0] for row in self._conn().execute('SELECT hash FROM torrents')]
+
+    def owned_torrents(self, owner):
+        return [row[0] for row in self._conn().execute('SELECT hash FROM torrents WHERE owner = ?', (owner,))]
+
+    def usage(self, owner):
+        """Total size (in bytes) of torrents owned by `owner`"""
+        row = self._conn().execute('SELECT size FROM usage WHERE owner = ?', (owner,)).fetchone()
+        return row[0] if row is not None else 0
+
+    @locked
+    def set_sizes(self, sizes):
+        """sizes - list of (hash, size)"""
+        with self._transaction() as conn:
+            conn.executemany('UPDATE torrents SET size = ? WHERE hash = ? AND size != ?',
+                             ((size, t_hash, size) for t_hash, size in sizes))
+
+    @locked
+    def mark_finished(self, hashes):
+        with self._transaction() as conn:
+            conn.executemany('UPDATE torrents SET active = 0 WHERE hash = ?', ((t_hash,) for t_hash in hashes))
+
+    def disk_full(self):
+        return self._get_value('disk_full', False)
+
+    def set_disk_full(self, value):
+        self._set_value('disk_full', value)
+
+    @locked
+    def import_data(self, torrents, whitelist, values):
+        """Bulk import (used for migration).
+        torrents - list of (hash, owner, active, size), values - dict of raw key-value pairs (timers etc.)
+        """
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO users (uid) VALUES (?)', ((uid,) for uid in whitelist))
+            conn.executemany('DELETE FROM torrents WHERE hash = ?', ((t[0],) for t in torrents))
+            conn.executemany('INSERT INTO torrents (hash, owner, active, size) VALUES (?, ?, ?, ?)',
+                             ((t_hash, owner, int(active), size) for t_hash, owner, active, size in torrents))
+            conn.executemany('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+                             ((key, json.dumps(value)) for key, value in values.items()))
+        self._whitelist[:] = [row[0] for row in self._conn().execute('SELECT uid FROM users ORDER BY uid')]
+
+
+    @locked
+    def close(self):
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+        self._local = threading.local()
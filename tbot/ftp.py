@@ -1,17 +1,31 @@
 import os
 import random
 import threading
+import time
+from collections import OrderedDict
+from functools import wraps
 from pathlib import Path
+from stat import S_ISDIR, S_ISLNK, filemode
 
 try:
     from pyftpdlib.authorizers import DummyAuthorizer
-    from pyftpdlib.handlers import FTPHandler
-    from pyftpdlib.servers import ThreadedFTPServer
-    from pyftpdlib.filesystems import AbstractedFS
+    from pyftpdlib.handlers import DTPHandler, FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import FTPServer, ThreadedFTPServer
+    from pyftpdlib.filesystems import AbstractedFS, FilesystemError
     ftp_available = True
 except ImportError:
     ftp_available = False
 
+try:
+    from pyftpdlib.servers import MultiprocessFTPServer  # POSIX only
+except ImportError:
+    MultiprocessFTPServer = None
+
+
+MONTHS = {1: 'Jan', 2: 'Feb', 3: 'Mar', 4: 'Apr', 5: 'May', 6: 'Jun', 7: 'Jul', 8: 'Aug', 9: 'Sep', 10: 'Oct', 11: 'Nov', 12: 'Dec'}
+SIX_MONTHS = 180 * 24 * 60 * 60
+CDIR_TYPES = {'.': 'cdir', '..': 'pdir'}
+
 
 def rand_password(n):
     # not totally secure, but ok for LAN-restricted access
@@ -27,7 +41,27 @@ def rand_creds(existing):
     return user, password
 
 
+class Listing(list):
+    """Entry names returned by RestrictedFS.listdir. stats - {name: lstat result} taken by the same scan.
+    pyftpdlib passes this list (sorted in place for LIST) to format_list / format_mlsx of the same command,
+    other commands (NLST copies it, MLST passes a new list) get fresh stat results
+    """
+    __slots__ = ('stats',)
+
+
 class RestrictedFS(AbstractedFS):
+    """Filesystem limited to the share root, which may be a single file.
+
+    Resolved parent directories are kept in a bounded LRU cache (entries expire after realpath_ttl seconds
+    and the cache is cleared by operations which modify the tree), so realpath() of a path usually costs
+    a single lstat instead of one per path component.
+    Listings are made with os.scandir. Its lstat results are returned with the names (see Listing), so only
+    format_list / format_mlsx of the same LIST / MLSD command use them, stat() / lstat() always hit the filesystem.
+    Each distinct mode, owner and date is formatted only once per listing.
+    """
+    realpath_cache_size = 1024
+    realpath_ttl = 5  # seconds, for changes made outside of FTP (e.g. by transmission)
+
     def __init__(self, root, cmd_channel):
         self._root_file = None
 
@@ -39,6 +73,31 @@ class RestrictedFS(AbstractedFS):
             root = str(rootpath.parent)
 
         super().__init__(root, cmd_channel)
+        self._realpaths = OrderedDict()  # directory: (time, resolved path)
+
+    def _cached_realpath(self, path):
+        now = time.monotonic()
+        cached = self._realpaths.get(path)
+        if cached is not None and now - cached[0] < self.realpath_ttl:
+            self._realpaths.move_to_end(path)
+            return cached[1]
+        resolved = os.path.realpath(path)
+        self._realpaths[path] = (now, resolved)
+        self._realpaths.move_to_end(path)
+        if len(self._realpaths) > self.realpath_cache_size:
+            self._realpaths.popitem(last=False)
+        return resolved
+
+    def realpath(self, path):
+        """Return the canonical version of path eliminating any symbolic links (see os.path.realpath)"""
+        assert isinstance(path, str), path
+        parent, name = os.path.split(path)
+        if name in ('', '.', '..') or not os.path.isabs(parent):
+            return os.path.realpath(path)
+        resolved = os.path.join(self._cached_realpath(parent), name)
+        if os.path.islink(resolved):
+            return os.path.realpath(resolved)
+        return resolved
 
     def validpath(self, path):
         """Check whether the path belongs to user's home directory.
@@ -51,7 +110,7 @@ class RestrictedFS(AbstractedFS):
         not valid.
         """
         assert isinstance(path, str), path
-        root = self.realpath(self.root)
+        root = self._cached_realpath(self.root)
         path = self.realpath(path)
         if not root.endswith(os.sep):
             root = root + os.sep
@@ -63,19 +122,266 @@ class RestrictedFS(AbstractedFS):
             return True
         return False
 
+    def _scan(self, path):
+        """Returns a Listing of the directory"""
+        names = Listing()
+        stats = names.stats = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                names.append(entry.name)
+                try:
+                    stats[entry.name] = entry.stat(follow_symlinks=False)
+                except OSError:
+                    pass  # lstat will raise it again
+        return names
+
     def listdir(self, path):
         """List the content of a directory."""
         assert isinstance(path, str), path
         if self._root_file is not None:
-            return [self._root_file] if self._root_file in os.listdir(path) else []
-        return os.listdir(path)
+            return [self._root_file] if os.path.lexists(os.path.join(path, self._root_file)) else []
+        return self._scan(path)
 
     def listdirinfo(self, path):
         """List the content of a directory."""
-        assert isinstance(path, str), path
-        if self._root_file is not None:
-            return [self._root_file] if self._root_file in os.listdir(path) else []
-        return os.listdir(path)
+        return self.listdir(path)
+
+    def format_list(self, basedir, listing, ignore_err=True):
+        """Same output as AbstractedFS.format_list ("ls -lA" lines)"""
+        listed = getattr(listing, 'stats', {})
+        timefunc = time.gmtime if self.cmd_channel.use_gmt_times else time.localtime
+        unicode_errors = self.cmd_channel.unicode_errors
+        prefix = os.path.join(basedir, '')
+        now = time.time()
+        modes, users, groups, dates = {}, {}, {}, {}
+        for basename in listing:
+            st = listed.get(basename)
+            if st is None:
+                try:
+                    st = self.lstat(prefix + basename)
+                except (OSError, FilesystemError):
+                    if ignore_err:
+                        continue
+                    raise
+            mode = st.st_mode
+            perms = modes.get(mode)
+            if perms is None:
+                perms = modes[mode] = filemode(mode)
+            uname = users.get(st.st_uid)
+            if uname is None:
+                uname = users[st.st_uid] = self.get_user_by_uid(st.st_uid)
+            gname = groups.get(st.st_gid)
+            if gname is None:
+                gname = groups[st.st_gid] = self.get_group_by_gid(st.st_gid)
+            # "month day year" if modified more than 6 months ago, else "month day hh:mm" (as in proftpd)
+            key = (st.st_mtime // 1, now - st.st_mtime > SIX_MONTHS)
+            mtimestr = dates.get(key)
+            if mtimestr is None:
+                try:
+                    mtime = timefunc(st.st_mtime)
+                    mtimestr = f'{MONTHS[mtime.tm_mon]} {time.strftime("%d  %Y" if key[1] else "%d %H:%M", mtime)}'
+                except ValueError:  # before 1900, the current time is shown
+                    mtime = timefunc()
+                    mtimestr = f'{MONTHS[mtime.tm_mon]} {time.strftime("%d %H:%M", mtime)}'
+                dates[key] = mtimestr
+            if S_ISLNK(mode):
+                try:
+                    basename = basename + ' -> ' + self.readlink(prefix + basename)
+                except (OSError, FilesystemError):
+                    if not ignore_err:
+                        raise
+            line = '%s %3s %-8s %-8s %8s %s %s\r\n' % (perms, st.st_nlink or 1, uname, gname, st.st_size, mtimestr, basename)
+            yield line.encode('utf8', unicode_errors)
+
+    def format_mlsx(self, basedir, listing, perms, facts, ignore_err=True):
+        """Same output as AbstractedFS.format_mlsx (MLSD / MLST lines)"""
+        listed = getattr(listing, 'stats', {})
+        timefunc = time.gmtime if self.cmd_channel.use_gmt_times else time.localtime
+        unicode_errors = self.cmd_channel.unicode_errors
+        prefix = os.path.join(basedir, '')
+        permdir = ''.join(x for x in perms if x not in 'arw')
+        permfile = ''.join(x for x in perms if x not in 'celmp')
+        if 'w' in perms or 'a' in perms or 'f' in perms:
+            permdir += 'c'
+        if 'd' in perms:
+            permdir += 'p'
+        show = {fact: fact in facts for fact in ('create', 'modify', 'perm', 'size', 'type', 'unique', 'unix.gid', 'unix.mode', 'unix.uid')}
+        dates = {}
+
+        def date(t):
+            key = t // 1
+            value = dates.get(key)
+            if value is None:
+                try:
+                    value = time.strftime('%Y%m%d%H%M%S', timefunc(t))
+                except ValueError:  # before 1900
+                    value = ''
+                dates[key] = value
+            return value
+
+        for basename in listing:
+            # symlinks are followed, as the "unique" fact should identify the target
+            st = listed.get(basename)
+            if st is None or S_ISLNK(st.st_mode):
+                try:
+                    st = self.stat(prefix + basename)
+                except (OSError, FilesystemError):
+                    if ignore_err:
+                        continue
+                    raise
+            isdir = S_ISDIR(st.st_mode)
+            # facts are sorted by name
+            parts = []
+            if show['create']:
+                value = date(st.st_ctime)
+                if value:
+                    parts.append(f'create={value};')
+            if show['modify']:
+                value = date(st.st_mtime)
+                if value:
+                    parts.append(f'modify={value};')
+            if show['perm']:
+                parts.append(f'perm={permdir if isdir else permfile};')
+            if show['size']:
+                parts.append(f'size={st.st_size};')
+            if show['type']:
+                parts.append('type=' + (CDIR_TYPES.get(basename, 'dir') if isdir else 'file') + ';')
+            if show['unique']:
+                parts.append('unique=%xg%x;' % (st.st_dev, st.st_ino))
+            if show['unix.gid']:
+                parts.append(f'unix.gid={st.st_gid};')
+            if show['unix.mode']:
+                parts.append(f'unix.mode={oct(st.st_mode & 511)};')
+            if show['unix.uid']:
+                parts.append(f'unix.uid={st.st_uid};')
+            line = ''.join(parts) + ' ' + basename + '\r\n'
+            yield line.encode('utf8', unicode_errors)
+
+    def _modified(method):
+        @wraps(method)
+        def wrapped(self, *args):
+            self._realpaths.clear()
+            return method(self, *args)
+        return wrapped
+
+    mkdir = _modified(AbstractedFS.mkdir)
+    rmdir = _modified(AbstractedFS.rmdir)
+    remove = _modified(AbstractedFS.remove)
+    rename = _modified(AbstractedFS.rename)
+    del _modified
+
+
+class RateLimit():
+    """Token bucket shared by data channels of several connections (and threads), bursts up to 1 second of traffic"""
+
+    def __init__(self, rate):
+        self.rate = rate  # bytes/s
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """Returns the delay (in seconds) before more data may be transferred"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - size
+            self.last = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class ShareTraffic():
+    """Rate limits and transfer counters of a share"""
+
+    def __init__(self, read_limits, write_limits):
+        self.read_limits = read_limits  # RateLimit objects: share's own and global
+        self.write_limits = write_limits
+        self.sent = self.received = 0  # by closed data channels
+        self.channels = set()
+        self.lock = threading.Lock()
+
+    def opened(self, channel):
+        with self.lock:
+            self.channels.add(channel)
+
+    def closed(self, channel):
+        with self.lock:
+            if channel in self.channels:
+                self.channels.remove(channel)
+                self.sent += channel.tot_bytes_sent
+                self.received += channel.tot_bytes_received
+
+    def stats(self):
+        """Returns (bytes sent, bytes received, send rate, receive rate).
+        Rates are in bytes/s, averaged over the lifetime of currently open data channels
+        """
+        with self.lock:
+            sent, received = self.sent, self.received
+            channels = list(self.channels)
+        now = time.monotonic()
+        send_rate = recv_rate = 0
+        for channel in channels:
+            elapsed = max(now - channel.started, 1e-3)
+            sent += channel.tot_bytes_sent
+            received += channel.tot_bytes_received
+            send_rate += channel.tot_bytes_sent / elapsed
+            recv_rate += channel.tot_bytes_received / elapsed
+        return sent, received, round(send_rate), round(recv_rate)
+
+
+class ThrottledDTP(ThrottledDTPHandler):
+    """Data channel limited by the rate limits of its share (shared by all connections of the share and by all shares).
+    The per-connection limits of ThrottledDTPHandler are not used.
+    """
+    traffic = None
+    read_limits = write_limits = ()
+
+    def __init__(self, sock, cmd_channel):
+        super().__init__(sock, cmd_channel)
+        self.started = time.monotonic()
+        self.traffic = cmd_channel.traffic.get(cmd_channel.username)  # None if the share was closed after login
+        self.read_limits = self.traffic.read_limits if self.traffic is not None else []
+        self.write_limits = self.traffic.write_limits if self.traffic is not None else []
+        # smaller buffers give smoother throughput (see ThrottledDTPHandler.auto_sized_buffers)
+        for limit in self.read_limits:
+            while self.ac_in_buffer_size > limit.rate:
+                self.ac_in_buffer_size //= 2
+        for limit in self.write_limits:
+            while self.ac_out_buffer_size > limit.rate:
+                self.ac_out_buffer_size //= 2
+        if self.traffic is not None:
+            self.traffic.opened(self)
+
+    def use_sendfile(self):
+        if self.write_limits:  # sent data has to pass through send()
+            return False
+        return DTPHandler.use_sendfile(self)
+
+    def recv(self, buffer_size):
+        chunk = super().recv(buffer_size)
+        self._throttle(self.read_limits, len(chunk))
+        return chunk
+
+    def send(self, data):
+        sent = super().send(data)
+        self._throttle(self.write_limits, sent)
+        return sent
+
+    def _throttle(self, limits, size):
+        delay = max([limit.consume(size) for limit in limits], default=0)
+        if delay <= 0:
+            return
+
+        def unsleep():
+            self.add_channel(events=self.ioloop.READ if self.receive else self.ioloop.WRITE)
+
+        self.del_channel()
+        self._cancel_throttler()
+        self._throttler = self.ioloop.call_later(delay, unsleep, _errback=self.handle_error)
+
+    def close(self):
+        if self.traffic is not None:
+            self.traffic.closed(self)
+        super().close()
 
 
 class DummyAuthorizer2(DummyAuthorizer):
@@ -99,25 +405,52 @@ class DummyAuthorizer2(DummyAuthorizer):
         self.user_table[username] = dic
 
 
+def ftp_engines():
+    """Available server classes:
+    threaded - a thread per connection
+    epoll - single-threaded event loop (epoll/kqueue/poll, whichever is available), scales to many idle or slow clients
+    multiprocess - a process per connection (forked on accept, POSIX only)
+    """
+    engines = {'threaded': ThreadedFTPServer, 'epoll': FTPServer}
+    if MultiprocessFTPServer is not None:
+        engines['multiprocess'] = MultiprocessFTPServer
+    return engines
+
+
 class FTPDrop():
-    def __init__(self, addr):
+    def __init__(self, addr, engine='threaded', max_cons=20, max_cons_per_ip=5, limits=None):
+        """engine - see ftp_engines(). Shares opened in multiprocess mode are visible only to new connections.
+        limits - rate limits in bytes/s (missing or 0 - unlimited): share_read, share_write, total_read, total_write.
+        "read" is receiving uploaded data, "write" is sending files to clients.
+        In multiprocess mode limits are applied per connection and transfer counters are not available.
+        """
         self.addr = addr
-
+        self.server_cls = ftp_engines()[engine]
+        self.max_cons = max_cons
+        self.max_cons_per_ip = max_cons_per_ip
+        self.limits = limits or {}
+        self.total_read = RateLimit(self.limits['total_read']) if self.limits.get('total_read') else None
+        self.total_write = RateLimit(self.limits['total_write']) if self.limits.get('total_write') else None
+
+        self.lock = threading.Lock()
         self.shares = {}
+        self.traffic = {}  # login: ShareTraffic
 
         self.authorizer = DummyAuthorizer2()
         self.handler = FTPHandler
         self.handler.use_sendfile = True
         self.handler.authorizer = self.authorizer
         self.handler.abstracted_fs = RestrictedFS
+        self.handler.dtp_handler = ThrottledDTP
+        self.handler.traffic = self.traffic
         self.handler.banner = "pyftpdlib based ftpd ready."
 
         self.server = None
 
     def _run_server(self):
-        self.server = ThreadedFTPServer(self.addr, self.handler)
-        self.server.max_cons = 20
-        self.server.max_cons_per_ip = 5
+        self.server = self.server_cls(self.addr, self.handler)
+        self.server.max_cons = self.max_cons
+        self.server.max_cons_per_ip = self.max_cons_per_ip
         self.server.serve_forever()
 
     def share(self, rootdir, writable, key=None):
@@ -128,33 +461,58 @@ class FTPDrop():
             rootdir = Path(rootdir)
         rootdir = str(rootdir.resolve())
 
-        if key in self.shares:
-            return self.shares[key]
-        login, password = rand_creds(self.authorizer.user_table)
-        self.authorizer.add_user(login, password, rootdir, perm='elr' if not writable else 'elradfmwMT')
-        self.shares[key] = (login, password)
+        with self.lock:
+            if key in self.shares:
+                return self.shares[key]
+            login, password = rand_creds(self.authorizer.user_table)
+            self.authorizer.add_user(login, password, rootdir, perm='elr' if not writable else 'elradfmwMT')
+            self.traffic[login] = ShareTraffic(self._limits('read'), self._limits('write'))
+            self.shares[key] = (login, password)
 
-        if not self.active():
-            srv = threading.Thread(target=self._run_server, name='FTP')
-            srv.deamon = True
-            srv.start()
+            if not self.active():
+                srv = threading.Thread(target=self._run_server, name='FTP')
+                srv.deamon = True
+                srv.start()
 
         return login, password
 
+    def _limits(self, direction):
+        limits = []
+        if self.limits.get(f'share_{direction}'):
+            limits.append(RateLimit(self.limits[f'share_{direction}']))
+        total = self.total_read if direction == 'read' else self.total_write
+        if total is not None:
+            limits.append(total)
+        return limits
+
     def get_creds(self, key):
         return self.shares.get(key)
 
+    def connections(self):
+        """Returns (control connections, open data channels). Not available in multiprocess mode"""
+        server = self.server
+        control = len(server.ip_map) if server is not None else 0
+        return control, sum(len(traffic.channels) for traffic in list(self.traffic.values()))
+
+    def transfer_stats(self, key):
+        """Returns (bytes sent, bytes received, send rate, receive rate) of a share or None, see ShareTraffic.stats"""
+        creds = self.shares.get(key)
+        traffic = self.traffic.get(creds[0]) if creds is not None else None
+        return traffic.stats() if traffic is not None else None
+
     def unshare(self, key):
-        if key not in self.shares:
-            return False
-        self.authorizer.remove_user(self.shares[key][0])
-        del self.shares[key]
-        if self.shares:
-            return True
-        if not self.active():  # never?
-            return True
-        self.server.close_all()
-        self.server = None
+        with self.lock:
+            if key not in self.shares:
+                return False
+            self.authorizer.remove_user(self.shares[key][0])
+            self.traffic.pop(self.shares[key][0], None)
+            del self.shares[key]
+            if self.shares:
+                return True
+            if not self.active():  # never?
+                return True
+            self.server.close_all()
+            self.server = None
         return True
 
     def force_stop(self):
@@ -0,0 +1,302 @@
+import email.utils
+import html
+import logging
+import os
+import secrets
+import stat
+import tarfile
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import quote, unquote, urlsplit
+
+
+def parse_range(header, size):
+    """Returns (start, end) (end is exclusive) of a single "bytes" range or None if the header should be ignored
+    (other units, malformed or multiple ranges). Raises ValueError if the range is not satisfiable
+    """
+    unit, _, spec = header.partition('=')
+    first, sep, last = spec.strip().partition('-')
+    if unit.strip().lower() != 'bytes' or not sep or not (first or last):
+        return None
+    if (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None  # also covers multiple ranges, which are served as a whole file
+    if not first:  # suffix: last N bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - int(last), 0), size
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if last and end <= start:
+        return None
+    if start >= size:
+        raise ValueError('Range starts after the end of file')
+    return start, min(end, size)
+
+
+def tar_members(directory):
+    """Returns [(TarInfo, path)] for a directory tree, names are relative to the parent of the directory.
+    Only directories and regular files are included, symlinks are skipped (os.walk doesn't follow them)
+    """
+    base = os.path.dirname(directory)
+    members = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for name in [None] + sorted(filenames):
+            path = dirpath if name is None else os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            info = tarfile.TarInfo(os.path.relpath(path, base).replace(os.sep, '/'))
+            info.mtime = int(st.st_mtime)
+            info.mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISDIR(st.st_mode):
+                info.type = tarfile.DIRTYPE
+            elif stat.S_ISREG(st.st_mode):
+                info.size = st.st_size
+            else:
+                continue
+            members.append((info, path))
+    return members
+
+
+def _tar_header(info):
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def _tar_padding(size):
+    return -size % tarfile.BLOCKSIZE
+
+
+def tar_size(members):
+    """Exact size of the archive written by send_tar"""
+    size = sum(len(_tar_header(info)) + info.size + _tar_padding(info.size) for info, _ in members)
+    size += 2 * tarfile.BLOCKSIZE
+    return size + -size % tarfile.RECORDSIZE
+
+
+def send_tar(sock, members):
+    """Streams an uncompressed tar archive to a socket. Headers are built in memory one at a time,
+    file contents are sent with socket.sendfile (os.sendfile if available), nothing else is buffered.
+    Files which were truncated while sending are padded with zeros, so the archive always has the size from tar_size
+    """
+    written = 0
+    for info, path in members:
+        header = _tar_header(info)
+        sock.sendall(header)
+        sent = 0
+        if info.size:
+            try:
+                with open(path, 'rb') as f:
+                    sent = sock.sendfile(f, 0, info.size)
+            except FileNotFoundError:
+                pass
+        tail = info.size - sent + _tar_padding(info.size)
+        while tail > 0:
+            chunk = min(tail, 65536)
+            sock.sendall(bytes(chunk))
+            tail -= chunk
+        written += len(header) + info.size + _tar_padding(info.size)
+    end = 2 * tarfile.BLOCKSIZE
+    sock.sendall(bytes(end + -(written + end) % tarfile.RECORDSIZE))
+
+
+class ShareHandler(BaseHTTPRequestHandler):
+    """GET/HEAD of shared files (with single-range requests) and directory indexes.
+    URLs are /<token>/<path inside the share>, a file share is served as /<token>/<file name>.
+    A directory is downloaded as a single tar archive with /<token>/<path>/?archive
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, every response has Content-Length
+    timeout = 60
+    server_version = 'tbot'
+
+    def log_message(self, format, *args):
+        logging.debug(f'HTTP {self.address_string()}: {format % args}')
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        url = urlsplit(self.path)
+        path = url.path
+        token, _, rel = path.lstrip('/').partition('/')
+        root = self.server.drop.resolve(token)
+        if root is None:
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        target = self.server.drop.locate(root, unquote(rel))
+        if target is None:
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        if os.path.isdir(target):
+            if not path.endswith('/'):
+                return self._redirect(path + '/')
+            if url.query == 'archive':
+                return self._send_archive(target, head)
+            return self._send_index(target, path, head)
+        self._send_file(target, head)
+
+    def _redirect(self, location):
+        self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+        self.send_header('Location', location)  # already percent-encoded (taken from the request line)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _send_index(self, directory, path, head):
+        try:
+            names = sorted(entry.name + ('/' if entry.is_dir() else '') for entry in os.scandir(directory))
+        except OSError:
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        title = html.escape(unquote(path))
+        lines = [f'<a href="{quote(name)}">{html.escape(name)}</a>' for name in names]
+        body = (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title></head>'
+                f'<body><h1>{title}</h1><p><a href="?archive">tar</a></p><pre>\n' + '\n'.join(lines) + '\n</pre></body></html>').encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _send_archive(self, directory, head):
+        members = tar_members(directory)
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/x-tar')
+        self.send_header('Content-Disposition', f"attachment; filename*=UTF-8''{quote(os.path.basename(directory))}.tar")
+        self.send_header('Accept-Ranges', 'none')
+        self.send_header('Content-Length', str(tar_size(members)))
+        self.end_headers()
+        if head:
+            return
+        try:
+            send_tar(self.connection, members)
+        except OSError:  # client disconnected
+            self.close_connection = True
+
+    def _send_file(self, target, head):
+        try:
+            f = open(target, 'rb')
+        except OSError:
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+            last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+
+            span = None
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if range_header and (if_range is None or if_range.strip() in (etag, last_modified)):
+                try:
+                    span = parse_range(range_header, size)
+                except ValueError:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            start, end = span or (0, size)
+            self.send_response(HTTPStatus.PARTIAL_CONTENT if span else HTTPStatus.OK)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Disposition', f"attachment; filename*=UTF-8''{quote(os.path.basename(target))}")
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            if span:
+                self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+            self.send_header('Content-Length', str(end - start))
+            self.end_headers()
+            if head or end == start:
+                return
+            try:
+                self.connection.sendfile(f, start, end - start)  # os.sendfile if available
+            except OSError:  # client disconnected
+                self.close_connection = True
+
+
+class HTTPDrop():
+    """HTTP download shares. Each share gets an unguessable token, the server runs only while there are shares.
+    Same lifecycle as FTPDrop: share() / get_creds() / unshare(), credentials are the share URL.
+    Removed shares are refused to new requests, downloads in progress are not interrupted.
+    """
+
+    def __init__(self, addr, base_url=None):
+        """addr - (host, port), base_url - URL prefix of the links (e.g. behind a reverse proxy)"""
+        self.addr = (addr[0], int(addr[1]))
+        self.base_url = (base_url or f'http://{addr[0]}:{addr[1]}').rstrip('/')
+        self.lock = threading.Lock()
+        self.shares = {}  # key: (token, url)
+        self.roots = {}  # token: resolved path
+        self.server = None
+
+    def resolve(self, token):
+        return self.roots.get(token)
+
+    @staticmethod
+    def locate(root, rel):
+        """Returns the real path of rel inside of the share root or None if it is outside (e.g. symlinks)"""
+        if root.is_file():
+            return str(root) if rel == root.name else None
+        try:
+            target = os.path.realpath(os.path.join(root, rel))
+            if os.path.commonpath([target, str(root)]) != str(root):
+                return None
+        except (ValueError, OSError):  # e.g. an embedded null byte (%00)
+            return None
+        return target
+
+    def _run_server(self, server):
+        server.serve_forever()
+
+    def share(self, rootdir, writable=False, key=None):
+        if writable:
+            raise ValueError('HTTP shares are read-only')
+        if key is None:
+            key = rootdir
+        root = Path(rootdir).resolve()
+
+        with self.lock:
+            if key in self.shares:
+                return self.shares[key][1]
+            if not self.active():  # bound before the share is registered, raises OSError (e.g. the port is in use)
+                server = ThreadingHTTPServer(self.addr, ShareHandler)
+                server.daemon_threads = True
+                server.drop = self
+                self.server = server
+                threading.Thread(target=self._run_server, args=(server,), name='HTTP', daemon=True).start()
+            token = secrets.token_urlsafe(16)
+            url = f'{self.base_url}/{token}/'
+            if root.is_file():
+                url += quote(root.name)
+            self.roots[token] = root
+            self.shares[key] = (token, url)
+        return url
+
+    def get_creds(self, key):
+        share = self.shares.get(key)
+        return share[1] if share is not None else None
+
+    def unshare(self, key):
+        with self.lock:
+            if key not in self.shares:
+                return False
+            token, _ = self.shares.pop(key)
+            del self.roots[token]
+            if not self.shares:
+                self._stop()
+        return True
+
+    def _stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def force_stop(self):
+        with self.lock:
+            self._stop()
+
+    def active(self):
+        return self.server is not None
@@ -0,0 +1,75 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class IngestQueue():
+    """Runs torrent adds on a shared thread pool without blocking the caller (the dispatcher thread).
+
+    A chat runs at most per_chat tasks at a time, the rest wait in the chat's queue,
+    so one big batch does not take all workers from other chats.
+    """
+
+    def __init__(self, workers, per_chat):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Ingest')
+        self.per_chat = max(1, per_chat)
+        self._lock = threading.Lock()
+        self._waiting = {}  # chat: deque of (task, batch, index)
+        self._running = {}  # chat: number of tasks in the pool
+        self._pending = 0  # submitted tasks which are not finished yet
+
+    def submit(self, chat, tasks, on_done):
+        """Runs the callables, then calls on_done(results) in a pool thread, results are in the order of tasks.
+        The result of a task which raised an exception is None
+        """
+        if not tasks:
+            on_done([])
+            return
+        batch = {'results': [None] * len(tasks), 'left': len(tasks), 'on_done': on_done}
+        with self._lock:
+            self._pending += len(tasks)
+            self._waiting.setdefault(chat, deque()).extend((task, batch, i) for i, task in enumerate(tasks))
+            self._start(chat)
+
+    def pending(self):
+        """Number of tasks queued or running"""
+        with self._lock:
+            return self._pending
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+    def _start(self, chat):
+        # called with the lock held
+        queue = self._waiting.get(chat)
+        while queue and self._running.get(chat, 0) < self.per_chat:
+            task, batch, i = queue.popleft()
+            self._running[chat] = self._running.get(chat, 0) + 1
+            self.pool.submit(self._run, chat, task, batch, i)
+        if not queue:
+            self._waiting.pop(chat, None)
+
+    def _run(self, chat, task, batch, i):
+        try:
+            batch['results'][i] = task()
+        except Exception:
+            logging.exception('Ingest task failed')
+        with self._lock:
+            self._running[chat] -= 1
+            if not self._running[chat]:
+                del self._running[chat]
+            try:
+                self._start(chat)
+            except RuntimeError:  # the pool is shut down
+                pass
+            batch['left'] -= 1
+            done = not batch['left']
+        try:
+            if done:
+                batch['on_done'](batch['results'])
+        except Exception:
+            logging.exception('Ingest callback failed')
+        finally:
+            with self._lock:
+                self._pending -= 1
@@ -0,0 +1,167 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram():
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # label values: [count per bucket (+Inf last), sum]
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labels, labels, le)} {total}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {_number(values[-1])}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labels)} {total}')
+        return lines
+
+
+class Counter():
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = dict(self._values)
+        lines += [f'{self.name}{_labels(self.labels, labels)} {_number(value)}' for labels, value in sorted(values.items())]
+        return lines
+
+
+class Gauge():
+    """Value is read on each scrape: callback returns a number or {label values (tuple): number}"""
+
+    def __init__(self, name, help, callback, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        try:
+            values = self.callback()
+        except Exception as e:  # don't break the whole scrape
+            logging.warning(f'Cannot collect metric {self.name}: {e}')
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines += [f'{self.name}{_labels(self.labels, labels)} {_number(value)}' for labels, value in sorted(values.items())]
+        return lines
+
+
+class Metrics():
+    """Registry of metrics, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = []
+        self.server = None
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, callback, labels=()):
+        return self._register(Gauge(name, help, callback, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, addr):
+        """Starts a background HTTP server with the /metrics endpoint"""
+        self.server = ThreadingHTTPServer((addr[0], int(addr[1])), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.metrics = self
+        threading.Thread(target=self.server.serve_forever, name='Metrics', daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            return self.send_error(404)
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def instrument_handler(handler, wrap, seen):
+    """Wraps the callback of a telegram handler (or of each handler of a ConversationHandler) with wrap(callback, handler).
+    seen - set of ids of already wrapped handlers, a handler shared by several conversations is wrapped once
+    """
+    if hasattr(handler, 'entry_points'):  # ConversationHandler
+        for states in [handler.entry_points, handler.fallbacks, *handler.states.values()]:
+            for h in states:
+                instrument_handler(h, wrap, seen)
+        return
+    if id(handler) in seen:
+        return
+    seen.add(id(handler))
+    handler.callback = wrap(handler.callback, handler)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Import an existing (shelve/dbm) bot DB into a SQLite DB"""
+
+import argparse
+import sys
+
+import shelve2 as shelve
+from db_sqlite import SqliteBotDB
+from registry import TorrentRegistry
+
+
+def read_shelve(path):
+    """Returns (torrents, whitelist, values) in SqliteBotDB.import_data format"""
+    db = shelve.open(path, 'w')  # not 'r': the shelf writes its cache back on close
+    try:
+        data = db.get('torrents', TorrentRegistry())
+        if isinstance(data, dict):  # old dict-of-sets layout
+            data = TorrentRegistry.from_legacy(data)
+        torrents = data.items()
+        whitelist = list(db.get('whitelist', []))
+        values = {key: db[key] for key in db if key.startswith('timer_') or key == 'disk_full'}
+    finally:
+        db.close()
+    return torrents, whitelist, values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('src', metavar='SHELVE_DB', help='Existing DB file (as passed to bot.py --db)')
+    parser.add_argument('dst', metavar='SQLITE_DB', help='SQLite DB file (created if missing)')
+    args = parser.parse_args()
+
+    try:
+        torrents, whitelist, values = read_shelve(args.src)
+    except Exception as e:
+        print(f'Cannot read {args.src}: {e}', file=sys.stderr)
+        sys.exit(1)
+
+    db = SqliteBotDB(args.dst)
+    db.import_data(torrents, whitelist, values)
+    db.close()
+    print(f'Imported {len(torrents)} torrents, {len(whitelist)} users and {len(values)} values')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
+
+
+class TokenBucket():
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _fill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Time until a token is available"""
+        self._fill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._fill(now)
+        self.tokens -= 1
+
+    def pause(self, now, duration):
+        self._fill(now)
+        self.tokens = min(self.tokens, 0) - duration * self.rate
+
+
+class Notifier():
+    """Outbound message queue with global and per-chat rate limits.
+
+    send() never blocks: messages are delivered by a separate thread, in order for each chat.
+    Chats are scheduled independently, so a chat waiting for its rate limit doesn't delay others.
+    Messages are retried on RetryAfter (after the requested delay) and network errors (with exponential backoff).
+    """
+
+    def __init__(self, bot, global_rate=25, chat_rate=1, max_retries=5):
+        self.bot = bot
+        self.chat_interval = 1 / chat_rate
+        self.max_retries = max_retries
+
+        self._cond = threading.Condition()
+        self._queues = {}  # chat: deque of [kwargs, attempts]
+        self._schedule = []  # heap of (time, seq, chat)
+        self._next_send = {}  # chat: earliest time for the next message
+        self._global = TokenBucket(global_rate, global_rate)
+        self._seq = itertools.count()
+        self._pending = 0
+        self.sent = 0
+        self.failed = 0
+
+        self._thread = threading.Thread(target=self._run, name='Notifier', daemon=True)
+        self._thread.start()
+
+    def send(self, chat_id, text, **kwargs):
+        with self._cond:
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+                self._push(chat_id, self._next_send.get(chat_id, 0))
+            queue.append([dict(chat_id=chat_id, text=text, **kwargs), 0])
+            self._pending += 1
+            self._cond.notify()
+
+    def depth(self):
+        return self._pending
+
+    def _push(self, chat, when):
+        heapq.heappush(self._schedule, (when, next(self._seq), chat))
+
+    def _next_message(self):
+        """Wait until a message can be sent, returns (chat, item)"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if not self._schedule:
+                    self._cond.wait()
+                    continue
+                when, _, chat = self._schedule[0]
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                delay = self._global.delay(now)
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._schedule)
+                self._global.take(now)
+                self._next_send[chat] = now + self.chat_interval
+                return chat, self._queues[chat].popleft()
+
+    def _done(self, chat, item, retry_at=None):
+        with self._cond:
+            queue = self._queues[chat]
+            if retry_at is not None:
+                queue.appendleft(item)
+            else:
+                self._pending -= 1
+            if queue:
+                self._push(chat, max(retry_at or 0, self._next_send[chat]))
+            else:
+                del self._queues[chat]
+            # forget rate limit state of idle chats
+            now = time.monotonic()
+            if len(self._next_send) > 2 * len(self._queues) + 100:
+                self._next_send = {c: t for c, t in self._next_send.items() if t > now or c in self._queues}
+
+    def _run(self):
+        while True:
+            chat, item = self._next_message()
+            retry_at = None
+            try:
+                self.bot.send_message(**item[0])
+                self.sent += 1
+            except RetryAfter as e:
+                # flood control may be global, so all chats are paused
+                now = time.monotonic()
+                with self._cond:
+                    self._global.pause(now, e.retry_after)
+                retry_at = now + e.retry_after
+            except BadRequest as e:  # subclass of NetworkError, but retrying won't help
+                logging.warning(f'Cannot send notification to {chat}: {e}')
+                self.failed += 1
+            except (TimedOut, NetworkError) as e:
+                item[1] += 1
+                if item[1] > self.max_retries:
+                    logging.error(f'Cannot send notification to {chat} after {item[1]} attempts: {e}')
+                    self.failed += 1
+                else:
+                    retry_at = time.monotonic() + 2 ** item[1]
+            except TelegramError as e:  # e.g. user has blocked the bot
+                logging.warning(f'Cannot send notification to {chat}: {e}')
+                self.failed += 1
+            except Exception:
+                logging.exception(f'Cannot send notification to {chat}')
+                self.failed += 1
+            self._done(chat, item, retry_at)
@@ -0,0 +1,146 @@
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+UPDATE_TYPES = ['callback_query', 'inline_query', 'message', 'edited_message', 'chosen_inline_result',
+                'channel_post', 'edited_channel_post', 'poll', 'poll_answer', 'my_chat_member', 'chat_member']
+
+_local = threading.local()
+
+
+@contextmanager
+def section(kind):
+    """Accounts time spent in an external system (rpc, telegram, db) to the current instrumented call of this thread.
+    Nested sections of the same kind are counted once
+    """
+    call = getattr(_local, 'call', None)
+    if call is None or kind in call.open:
+        yield
+        return
+    call.open.add(kind)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        call.open.discard(kind)
+        time_spent, calls = call.sections.get(kind, (0.0, 0))
+        call.sections[kind] = (time_spent + time.perf_counter() - start, calls + 1)
+
+
+class Call():
+    def __init__(self):
+        self.sections = {}  # kind: (time, calls)
+        self.open = set()
+        self.start = self.wall = self.cpu = 0.0
+
+
+def describe(handler):
+    """Commands, callback pattern or filters of a telegram handler"""
+    commands = getattr(handler, 'command', None)
+    if commands:
+        return ' '.join('/' + command for command in commands)
+    for attr in ('pattern', 'filters'):
+        value = getattr(handler, attr, None)
+        if value:
+            return str(getattr(value, 'pattern', value))
+    return type(handler).__name__
+
+
+def update_type(arg):
+    """Type of an update (first argument of a handler callback), "job" for JobQueue callbacks"""
+    return next((attr for attr in UPDATE_TYPES if getattr(arg, attr, None) is not None), 'job')
+
+
+class Profiler():
+    """Wall / CPU time of handlers and jobs with a slow-call log, and on-demand cProfile of the next N handler calls.
+
+    Handlers are run sequentially by the dispatcher, so only one call is profiled at a time,
+    calls from other threads (e.g. jobs) are not profiled while another one is.
+    """
+
+    def __init__(self, slow_threshold=1.0, top=15):
+        self.slow_threshold = slow_threshold  # seconds, 0 - disabled
+        self.top = top
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+        self._remaining = 0
+        self._stats = None
+        self._on_done = None
+
+    def profile_next(self, n, on_done):
+        """Profiles the next n handler calls, on_done(rows) is called with the top functions (see report)"""
+        with self._lock:
+            self._remaining = n
+            self._stats = None
+            self._on_done = on_done
+
+    @contextmanager
+    def measure(self, name, description, arg, histogram=None, profile=False):
+        """Measures a call of a handler or a job (arg - first argument of the callback), yields a Call"""
+        call = Call()
+        outer = getattr(_local, 'call', None)
+        _local.call = call
+        profiler = self._start_profile() if profile else None
+        call.start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield call
+        finally:
+            call.wall = time.perf_counter() - call.start
+            call.cpu = time.thread_time() - cpu
+            _local.call = outer
+            if profiler is not None:
+                self._stop_profile(profiler)
+            if histogram is not None:
+                histogram.observe(call.wall, name)
+            if self.slow_threshold and call.wall >= self.slow_threshold:
+                self._log_slow(name, description, arg, call)
+
+    def wrap(self, callback, name, description, histogram=None):
+        """Wraps a handler callback"""
+        @wraps(callback)
+        def wrapped(update, *args, **kwargs):
+            with self.measure(name, description, update, histogram, profile=True):
+                return callback(update, *args, **kwargs)
+        return wrapped
+
+    def _log_slow(self, name, description, arg, call):
+        breakdown = ', '.join(f'{kind} {spent:.3f} s ({calls} calls)' for kind, (spent, calls) in sorted(call.sections.items()))
+        logging.warning(f'Slow call: {name} [{description}], {update_type(arg)}: wall {call.wall:.3f} s, CPU {call.cpu:.3f} s'
+                        + (f', {breakdown}' if breakdown else ''))
+
+    def _start_profile(self):
+        if not self._remaining or not self._profile_lock.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profile(self, profiler):
+        profiler.disable()
+        self._profile_lock.release()
+        with self._lock:
+            if not self._remaining:  # restarted with profile_next(0)
+                return
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+            self._remaining -= 1
+            if self._remaining:
+                return
+            stats, on_done = self._stats, self._on_done
+            self._stats = self._on_done = None
+        on_done(self.report(stats))
+
+    def report(self, stats):
+        """Returns the top functions by cumulative time: [(function, file:line, calls, total time, cumulative time)]"""
+        rows = []
+        for (filename, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+            rows.append((function, f'{os.path.basename(filename)}:{line}', calls, total, cumulative))
+        rows.sort(key=lambda row: -row[4])
+        return rows[:self.top]
@@ -0,0 +1,184 @@
+from array import array
+
+
+NO_OWNER = -1
+
+
+class TorrentRegistry():
+    """Compact torrent ownership registry.
+
+    Each torrent is a row: its infohash is stored once (as bytes, 20 bytes for v1 hashes),
+    owner, active flag and size (sizeWhenDone, in bytes) are kept in array-backed columns.
+    Total size of each owner's torrents is maintained on every mutation, so usage() is O(1).
+    Per-owner indexes are arrays of integer row ids, the active index is the active flag column itself
+    (active rows are found with bytearray.find). Rows of removed torrents are reused.
+    The public API uses hex hash strings (as returned by transmission).
+
+    Mutations must be serialized by the caller (see BotDB). Reads are safe without locking:
+    containers are copied with atomic builtin calls before iteration and rows are re-checked after lookup.
+    """
+
+    __slots__ = ('_rows', '_keys', '_owner', '_active', '_size', '_free', '_by_owner', '_usage')
+
+    def __init__(self):
+        self._rows = {}  # hash: row id
+        self._keys = []  # row id: hash (None for free rows)
+        self._owner = array('q')
+        self._active = bytearray()
+        self._size = array('q')
+        self._free = []
+        self._by_owner = {}  # owner: array of row ids
+        self._usage = {}  # owner: total size
+
+    @classmethod
+    def from_legacy(cls, data):
+        """data - old dict-of-sets layout: {'active': set, 'owner': dict, 'owned': dict}"""
+        registry = cls()
+        for t_hash, owner in data['owner'].items():
+            registry.add(t_hash, owner, t_hash in data['active'])
+        return registry
+
+    def __getstate__(self):
+        rows = [row for row, key in enumerate(self._keys) if key is not None]
+        return (
+            [self._keys[row] for row in rows],
+            array('q', (self._owner[row] for row in rows)),
+            bytes(self._active[row] for row in rows),
+            array('q', (self._size[row] for row in rows))
+        )
+
+    def __setstate__(self, state):
+        self.__init__()
+        keys, owners, active, sizes = state
+        for key, owner, is_active, size in zip(keys, owners, active, sizes):
+            self._add(key, None if owner == NO_OWNER else owner, is_active, size)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, t_hash):
+        return bytes.fromhex(t_hash) in self._rows
+
+    def _add(self, key, owner, active, size=0):
+        if self._free:
+            row = self._free.pop()
+            self._keys[row] = key
+            self._owner[row] = NO_OWNER if owner is None else owner
+            self._active[row] = bool(active)
+            self._size[row] = size
+        else:
+            row = len(self._keys)
+            self._keys.append(key)
+            self._owner.append(NO_OWNER if owner is None else owner)
+            self._active.append(bool(active))
+            self._size.append(size)
+        self._rows[key] = row
+        if owner is not None:
+            self._by_owner.setdefault(owner, array('q')).append(row)
+            self._usage[owner] = self._usage.get(owner, 0) + size
+
+    def add(self, t_hash, owner, active, size=0):
+        key = bytes.fromhex(t_hash)
+        if key in self._rows:
+            self._remove(key)
+        self._add(key, owner, active, size)
+
+    def _remove(self, key):
+        row = self._rows.pop(key)
+        owner = self._owner[row]
+        if owner != NO_OWNER:
+            owned = self._by_owner[owner]
+            owned.remove(row)
+            if not owned:
+                del self._by_owner[owner]
+                del self._usage[owner]
+            else:
+                self._usage[owner] -= self._size[row]
+        self._keys[row] = None
+        self._owner[row] = NO_OWNER
+        self._active[row] = 0
+        self._size[row] = 0
+        self._free.append(row)
+
+    def remove(self, t_hash):
+        """Raises KeyError if there is no such torrent"""
+        self._remove(bytes.fromhex(t_hash))
+
+    def owner(self, t_hash):
+        """Raises KeyError if there is no such torrent"""
+        key = bytes.fromhex(t_hash)
+        while True:
+            row = self._rows[key]
+            owner = self._owner[row]
+            if self._keys[row] == key:  # row wasn't reused by a concurrent remove/add
+                return None if owner == NO_OWNER else owner
+
+    def set_active(self, t_hash, active):
+        """Returns True if the flag was changed. Unknown hashes are ignored"""
+        row = self._rows.get(bytes.fromhex(t_hash))
+        if row is None or self._active[row] == bool(active):
+            return False
+        self._active[row] = bool(active)
+        return True
+
+    def set_size(self, t_hash, size):
+        """Returns True if the size was changed. Unknown hashes are ignored"""
+        row = self._rows.get(bytes.fromhex(t_hash))
+        if row is None or self._size[row] == size:
+            return False
+        owner = self._owner[row]
+        if owner != NO_OWNER:
+            self._usage[owner] += size - self._size[row]
+        self._size[row] = size
+        return True
+
+    def usage(self, owner):
+        """Total size of torrents owned by `owner`"""
+        return self._usage.get(owner, 0)
+
+    def recount_usage(self):
+        """Rebuild per-owner totals from the size column"""
+        usage = {}
+        for owner, rows in list(self._by_owner.items()):
+            usage[owner] = sum(self._size[row] for row in rows)
+        self._usage = usage
+
+    def is_active(self, t_hash):
+        row = self._rows.get(bytes.fromhex(t_hash))
+        return row is not None and bool(self._active[row])
+
+    def _hex(self, rows):
+        keys = self._keys
+        return [key.hex() for key in (keys[row] for row in rows) if key is not None]
+
+    def hashes(self):
+        return [key.hex() for key in list(self._rows)]
+
+    def _active_rows(self):
+        rows = []
+        row = self._active.find(1)
+        while row != -1:
+            rows.append(row)
+            row = self._active.find(1, row + 1)
+        return rows
+
+    def active(self):
+        return set(self._hex(self._active_rows()))
+
+    def owned(self, owner):
+        rows = self._by_owner.get(owner)
+        return self._hex(rows.tolist()) if rows is not None else []
+
+    def items(self):
+        """Returns a list of (hash, owner, active, size)"""
+        return [(key.hex(), None if self._owner[row] == NO_OWNER else self._owner[row], bool(self._active[row]), self._size[row])
+                for key, row in list(self._rows.items())]
+
+    def missing(self, hashes):
+        """Returns registered hashes which are not in `hashes`"""
+        seen = bytearray(len(self._keys))
+        for t_hash in hashes:
+            row = self._rows.get(bytes.fromhex(t_hash))
+            if row is not None:
+                seen[row] = 1
+        return [key.hex() for key, row in self._rows.items() if not seen[row]]
@@ -0,0 +1,195 @@
+import base64
+import http.client
+import json
+import queue
+import socket
+import threading
+import time
+
+from transmission_rpc import Client as Transmission
+from transmission_rpc.error import TransmissionError
+from transmission_rpc.torrent import Torrent
+
+from profiling import section
+
+
+class RPCStats():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.methods = {}  # method: [calls, errors, total time, max time, bytes sent, bytes received]
+        self.histogram = None  # optional latency histogram with a "method" label, see metrics.py
+
+    def record(self, method, elapsed, sent, received, error=False):
+        if self.histogram is not None:
+            self.histogram.observe(elapsed, method)
+        with self._lock:
+            stats = self.methods.setdefault(method, [0, 0, 0.0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += int(error)
+            stats[2] += elapsed
+            stats[3] = max(stats[3], elapsed)
+            stats[4] += sent
+            stats[5] += received
+
+    def summary(self):
+        """Returns (calls per second, {method: {...}})"""
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            methods = {
+                method: {
+                    'calls': calls,
+                    'errors': errors,
+                    'avg_ms': total / calls * 1000 if calls else 0.0,
+                    'max_ms': max_time * 1000,
+                    'sent': sent,
+                    'received': received,
+                }
+                for method, (calls, errors, total, max_time, sent, received) in self.methods.items()
+            }
+        total_calls = sum(m['calls'] for m in methods.values())
+        return total_calls / uptime if uptime > 0 else 0.0, methods
+
+
+class Transport():
+    """Thread-safe transport for transmission RPC.
+
+    Keeps a pool of keep-alive HTTP connections (at most `pool_size` requests are sent at once)
+    and a session id shared by all threads, so the 409 handshake is done once after a daemon restart.
+    """
+
+    def __init__(self, host='127.0.0.1', port=9091, username=None, password=None, protocol='http',
+                 path='/transmission/rpc', timeout=30.0, pool_size=4, **kwargs):
+        self.host = host
+        self.port = int(port)
+        self.path = path
+        self.timeout = timeout
+        self._conn_cls = http.client.HTTPSConnection if protocol == 'https' else http.client.HTTPConnection
+        self._auth = None
+        if username is not None:
+            creds = f'{username}:{password or ""}'.encode()
+            self._auth = 'Basic ' + base64.b64encode(creds).decode()
+
+        self._pool = queue.LifoQueue()  # idle connections
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._session_lock = threading.Lock()
+        self.session_id = '0'
+        self.stats = RPCStats()
+
+    def _headers(self):
+        headers = {'Content-Type': 'application/json', 'X-Transmission-Session-Id': self.session_id}
+        if self._auth is not None:
+            headers['Authorization'] = self._auth
+        return headers
+
+    def _acquire(self, timeout):
+        if not self._slots.acquire(timeout=timeout):
+            raise TransmissionError('Timed out waiting for a free RPC connection')
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._conn_cls(self.host, self.port, timeout=timeout)
+
+    def _release(self, conn, reusable):
+        if reusable:
+            self._pool.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def _post(self, conn, body, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request('POST', self.path, body, self._headers())
+        response = conn.getresponse()
+        return response, response.read()
+
+    def request(self, query, timeout=None):
+        """Send a JSON-RPC query (dict or serialized), returns response text"""
+        if timeout is None:
+            timeout = self.timeout
+        if isinstance(query, str):
+            body = query.encode()
+            method = json.loads(query).get('method')
+        else:
+            body = json.dumps(query).encode()
+            method = query.get('method')
+
+        start = time.monotonic()
+        received = 0
+        conn = self._acquire(timeout)
+        reusable = False
+        try:
+            for attempt in range(3):
+                try:
+                    response, data = self._post(conn, body, timeout)
+                except socket.timeout as e:
+                    raise TransmissionError(f'Timeout in RPC call "{method}"') from e
+                except (http.client.HTTPException, ConnectionError) as e:
+                    # keep-alive connection was closed by the daemon (e.g. after restart), retry with a fresh one
+                    conn.close()
+                    if attempt > 0:
+                        raise TransmissionError(f'Connection error in RPC call "{method}": {e}') from e
+                    continue
+                received += len(data)
+                if response.status == 409:
+                    with self._session_lock:
+                        self.session_id = response.getheader('X-Transmission-Session-Id', '0')
+                    continue
+                if response.status in (401, 403):
+                    raise TransmissionError('Transmission RPC authorization failed')
+                if response.status != 200:
+                    raise TransmissionError(f'Unexpected RPC response: {response.status} {response.reason}')
+                reusable = not response.will_close
+                self.stats.record(method, time.monotonic() - start, len(body), received)
+                return data.decode('utf-8')
+            raise TransmissionError(f'Too many retries in RPC call "{method}"')
+        except TransmissionError:
+            self.stats.record(method, time.monotonic() - start, len(body), received, error=True)
+            raise
+        finally:
+            self._release(conn, reusable)
+
+
+class PooledTransmission(Transmission):
+    """transmission_rpc client which sends all queries through a shared Transport"""
+
+    def __init__(self, transport, **kwargs):
+        self.transport = transport  # must be set before Client.__init__, which already queries the session
+        super().__init__(**kwargs)
+
+    def _http_query(self, query, timeout=None):
+        with section('rpc'):
+            return self.transport.request(query, timeout)
+
+    def raw_call(self, method, arguments=None, timeout=None):
+        """Sends a query as is, returns the arguments of the response.
+        Unlike the Client methods, keeps everything the daemon returned (e.g. `removed` of a "recently-active" torrent-get)
+        """
+        data = json.loads(self._http_query({'method': method, 'arguments': arguments or {}}, timeout))
+        if data.get('result') != 'success':
+            raise TransmissionError(f'Query failed with result "{data.get("result")}"')
+        return data['arguments']
+
+    def add(self, torrent, **kwargs):
+        """Adds a torrent (magnet link / URL or a file-like object with .torrent contents), kwargs - torrent-add arguments
+        (e.g. download_dir, files_unwanted). Returns (Torrent, added), added is False if transmission already had the torrent,
+        which Client.add_torrent doesn't tell
+        """
+        arguments = {key.replace('_', '-'): value for key, value in kwargs.items()}
+        if hasattr(torrent, 'read'):
+            arguments['metainfo'] = base64.b64encode(torrent.read()).decode()
+        else:
+            arguments['filename'] = torrent
+        data = self.raw_call('torrent-add', arguments)
+        if 'torrent-added' in data:
+            return Torrent(self, data['torrent-added']), True
+        if 'torrent-duplicate' in data:
+            return Torrent(self, data['torrent-duplicate']), False
+        raise TransmissionError('Invalid torrent-add response')
+
+    def get_recently_active(self, arguments):
+        """Returns (Torrents, removed ids) changed or removed in the last minute. arguments - torrent fields"""
+        data = self.raw_call('torrent-get', {'fields': arguments, 'ids': 'recently-active'})
+        return [Torrent(self, fields) for fields in data['torrents']], data.get('removed', [])
@@ -0,0 +1,90 @@
+import re
+import threading
+
+
+separators = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """Case-folded words separated by single spaces ("The.Matrix_1999" -> "the matrix 1999")"""
+    return separators.sub(' ', text.casefold()).strip()
+
+
+def trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+class SearchIndex():
+    """Trigram index over torrent names.
+
+    Entries are (name, hash, id) tuples, as in TorrentCache.index(). sync() applies only the difference
+    with the previously indexed entries, so a rebuild of the list index costs O(changed torrents) postings updates.
+    A query matches names which contain every query word as a substring (case-insensitive, punctuation is ignored).
+    Candidates are found by intersecting posting sets of query trigrams and then verified.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._source = None  # last synced list of entries
+        self._docs = []  # doc id: (normalized name, entry), None for free ids
+        self._doc_ids = {}  # hash: doc id
+        self._free = []
+        self._postings = {}  # trigram: set of doc ids
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def _add(self, entry):
+        norm = normalize(entry[0])
+        if self._free:
+            doc = self._free.pop()
+            self._docs[doc] = (norm, entry)
+        else:
+            doc = len(self._docs)
+            self._docs.append((norm, entry))
+        self._doc_ids[entry[1]] = doc
+        for gram in set().union(*map(trigrams, norm.split())):
+            self._postings.setdefault(gram, set()).add(doc)
+
+    def _remove(self, t_hash):
+        doc = self._doc_ids.pop(t_hash)
+        norm, _ = self._docs[doc]
+        for gram in set().union(*map(trigrams, norm.split())):
+            docs = self._postings[gram]
+            docs.discard(doc)
+            if not docs:
+                del self._postings[gram]
+        self._docs[doc] = None
+        self._free.append(doc)
+
+    def sync(self, entries):
+        """entries - list of (name, hash, id) for all torrents. Does nothing if the same list was already synced"""
+        with self._lock:
+            if entries is self._source:
+                return
+            current = {entry[1]: entry for entry in entries}
+            for t_hash in [t_hash for t_hash in self._doc_ids if t_hash not in current]:
+                self._remove(t_hash)
+            for t_hash, entry in current.items():
+                doc = self._doc_ids.get(t_hash)
+                if doc is not None and self._docs[doc][1] == entry:
+                    continue
+                if doc is not None:  # renamed (e.g. magnet metadata was received) or id changed
+                    self._remove(t_hash)
+                self._add(entry)
+            self._source = entries
+
+    def find(self, query):
+        """Returns a sorted list of matching entries"""
+        words = normalize(query).split()
+        if not words:
+            return []
+        grams = set().union(*map(trigrams, words))
+        with self._lock:
+            if grams:
+                postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+                docs = [self._docs[doc] for doc in candidates]
+            else:  # only short words, scan all names
+                docs = [doc for doc in self._docs if doc is not None]
+        return sorted(entry for norm, entry in docs if all(word in norm for word in words))
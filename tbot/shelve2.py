@@ -3,11 +3,11 @@
 from pickle import Pickler, Unpickler
 from io import BytesIO
 
-import collections
+import collections.abc
 
 __all__ = ["Shelf", "DbfilenameShelf", "open"]
 
-class _ClosedDict(collections.MutableMapping):
+class _ClosedDict(collections.abc.MutableMapping):
     'Marker for a closed dict.  Access attempts raise a ValueError.'
 
     def closed(self, *args):
@@ -18,7 +18,7 @@ class _ClosedDict(collections.MutableMapping):
         return '<Closed Dictionary>'
 
 
-class Shelf(collections.MutableMapping):
+class Shelf(collections.abc.MutableMapping):
     """Base class for shelf implementations.
 
     This is initialized with a dictionary-like object.
@@ -31,6 +31,7 @@ class Shelf(collections.MutableMapping):
             protocol = 3
         self._protocol = protocol
         self.cache = {}
+        self.sizes = {}  # key: size of the last written pickle
         self.keyencoding = keyencoding
 
     def __iter__(self):
@@ -62,7 +63,9 @@ class Shelf(collections.MutableMapping):
         f = BytesIO()
         p = Pickler(f, self._protocol)
         p.dump(value)
-        self.dict[key.encode(self.keyencoding)] = f.getvalue()
+        data = f.getvalue()
+        self.sizes[key] = len(data)
+        self.dict[key.encode(self.keyencoding)] = data
 
     def __delitem__(self, key):
         del self.dict[key.encode(self.keyencoding)]
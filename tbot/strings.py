@@ -18,17 +18,23 @@ def format_speed(bps):
     bps /= 1000
     return f'{bps:.2f} MB/s'
 
-help = """Пришлите боту .torrent-файл для начала загрузки
+help = """Пришлите боту .torrent-файлы или magnet-ссылки (по одной на строку) для начала загрузки.
+Несколько торрентов, отправленных до выбора папки, добавляются вместе
 
 Доступные команды:
 /help - вывести эту инструкцию
 /limit - показать установленные ограничения скорости
 /setlimit - установить / снять ограничения скорости
 /my_torrents - вывести / редактировать список ваших торрентов
+/find <запрос> - найти торренты по названию (также можно искать, набрав имя бота в любом чате)
 /disk - показать заполненность диска"""
 
 
 disk_usage = 'Использовано: {} из {}, {:.1f}%'
+quota_usage = 'Ваши торренты: {} из {} ({:.1f}%)'
+quota_usage_unlimited = 'Ваши торренты: {}'
+profile_started = 'Профилируются следующие {} обработчиков, результат будет отправлен в этот чат'
+profile_usage = 'Использование: /profile <число обработчиков от 1 до 1000>'
 
 #limit
 notif_limit_set = '⚠ Установлены ограничения скорости\n'
@@ -63,14 +69,32 @@ error_load_file = '❌ Ошибка при чтении torrent-файла'
 error = '❌ Неизвестная ошибка'
 invalid_dirname = '❌ Недопустимое имя папки. Попробуйте еще раз (/cancel для отмены)'
 nohash = '❌ Ошибка - не найден хеш торрента.'
+quota_exceeded = '❌ Превышена квота: ваши торренты занимают {} из {}. Удалите ненужные торренты и попробуйте снова'
 
 select_dir = 'Выберите папку для загрузки (/cancel для отмены)'
+batch_full = '⚠ Можно добавить не более {} торрентов за раз, пропущено: {}'
+batch_added = 'Добавлено торрентов: {} из {}'
+batch_status = {
+    'duplicate': 'дубликат',
+    'quota': 'превышена квота',
+    'error_load_file': 'ошибка при чтении файла',
+    'nohash': 'не найден хеш',
+    'error': 'неизвестная ошибка'
+}
 dirlist = [('🎬 Фильмы', 'Films'), ('📺 Сериалы', 'Series'), ('🎵 Музыка', 'Music'),
         ('🎮 Игры', 'Games'), ('⚙ ПО', 'Software'),
         ('Другое', '')]
 dir_buttons = dict(dirlist)
 dir_kb = [[e[0] for e in dirlist[i:i+2]] for i in range(0, len(dirlist), 2)]
 
+# file selection
+preview_hint = 'Выберите файлы для загрузки. Нажатие на файл меняет его приоритет'
+preview_header = '{}\nВыбрано файлов: {} из {}, {} из {}\n'
+preview_expired = 'Список файлов устарел, отправьте torrent-файл ещё раз'
+no_files_selected = 'Не выбрано ни одного файла'
+# (name, mark), the last one means "don't download"
+file_priority = [('обычный', '✅'), ('высокий', '⏫'), ('низкий', '⏬'), ('не загружать', '❌')]
+
 make_dir = 'Введите имя папки (допустимые символы - буквы, цифры, пробел, ".", "-", "_")'
 
 #fallbacks
@@ -79,8 +103,12 @@ cancelled = 'Операция отменена'
 
 # notification
 finished = '🔔 "{}" - загрузка завершена!'
+finished_digest = '🔔 Загрузка завершена ({}):'
+finished_digest_part = '🔔 Загрузка завершена ({}, часть {}):'
 disk_full = '❗ Диск переполнен, все загрузки были остановлены'
+disk_full_soon = '❗ Диск скоро будет переполнен, все загрузки были остановлены'
 disk_ok = '💾 На диске достаточно свободного места, можно возобновить загрузку вручную'
+quota_stopped = '❗ Превышена квота ({} из {}), загрузки остановлены:\n{}'
 
 # torrent management
 status = {
@@ -94,6 +122,10 @@ status = {
     'stopping': ('Остановка...', '⏳⏸⏳')
 }
 
+# search
+find_usage = 'Использование: /find <часть названия торрента>'
+find_expired = 'Поиск устарел, повторите /find'
+
 # arrows
 left = 'Вы уже на первой странице!'
 right = 'Вы уже на последней странице!'
@@ -101,6 +133,12 @@ right = 'Вы уже на последней странице!'
 del_confirm = 'Вы точно хотите удалить торрент "{}" и скачанные файлы?'
 deleted = 'Торрент был удалён'
 
+# bulk actions
+selected = 'Выбрано торрентов: {}'
+nothing_selected = 'Ничего не выбрано'
+bulk_del_confirm = 'Вы точно хотите удалить выбранные торренты ({} шт.) и скачанные файлы?'
+bulk_done = 'Готово, торрентов: {}'
+
 # FTP share
 ftp_error = 'Неизвестная ошибка, невозможно получить FTP-доступ'
 ftp_incomplete = 'Невозможно получить FTP-доступ (загрузка не завершена)'
@@ -110,6 +148,31 @@ ftp_start = 'FTP-сервер запущен\nЛогин: `{}`\nПароль: `{
 ftp_stop = 'FTP-сервер остановлен'
 ftp_unshare = 'Доступ по FTP к "{}" закрыт'
 ftp_stopped = 'FTP-сервер уже остановлен'
+http_unshare = 'Доступ по HTTP к "{}" закрыт'
+
+
+def format_finished(titles, max_length=4096):
+    """Returns a list of messages (split if longer than max_length, too long titles are truncated)"""
+    if not titles:
+        return []
+    if len(titles) == 1:
+        title = titles[0]
+        room = max_length - len(finished.format(''))
+        return [finished.format(title if len(title) <= room else title[:room - 1] + '…')]
+    header_len = len(finished_digest_part.format(len(titles), 999)) + 1
+    lines = [f'• {title}' for title in titles]
+    lines = [line if header_len + len(line) <= max_length else line[:max_length - header_len - 1] + '…' for line in lines]
+    parts = [[]]
+    part_len = header_len
+    for line in lines:
+        if parts[-1] and part_len + len(line) + 1 > max_length:
+            parts.append([])
+            part_len = header_len
+        parts[-1].append(line)
+        part_len += len(line) + 1
+    if len(parts) == 1:
+        return ['\n'.join([finished_digest.format(len(titles))] + parts[0])]
+    return ['\n'.join([finished_digest_part.format(len(titles), i + 1)] + part) for i, part in enumerate(parts)]
 
 
 def format_torrents(torrents, offset, n, ftp):
@@ -119,6 +182,35 @@ def format_torrents(torrents, offset, n, ftp):
     return '\n'.join(lines)
 
 
+def format_batch(results, max_length=4096):
+    """results - list of (status, title)"""
+    added = sum(status == 'added' for status, _ in results)
+    lines = [('✅ ' if added == len(results) else '⚠ ') + batch_added.format(added, len(results))]
+    lines += [f'❌ {title} - {batch_status[status]}' for status, title in results if status != 'added']
+    text = '\n'.join(lines)
+    return text if len(text) <= max_length else text[:max_length - 1] + '…'
+
+
+def format_preview(title, selected, total, selected_size, total_size, files):
+    """files - list of (number, path, size, priority)"""
+    lines = [preview_header.format(title, selected, total, format_size(selected_size), format_size(total_size))]
+    for number, path, size, priority in files:
+        line = f'{file_priority[priority][1]} {number}. {path} ({format_size(size)})'
+        lines.append(line if len(line) <= 300 else line[:299] + '…')
+    return '\n'.join(lines)
+
+
+def format_file_button(number, path, priority):
+    name = path.rsplit('/', 1)[-1]
+    if len(name) > 40:
+        name = name[:39] + '…'
+    return f'{file_priority[priority][1]} {number}. {name}'
+
+
+def format_short(t):
+    return f'{format_size(t.sizeWhenDone)} {status[t.status][1]}' + (f' {t.progress:.2f}%' if t.status.startswith('down') else '')
+
+
 def format_torrent(t, override_status=None, ftp=False):
     lines = [
             t.name,
@@ -138,9 +230,45 @@ def format_torrent(t, override_status=None, ftp=False):
     return '\n'.join(lines)
 
 
-def format_ftp(addr, details):
+def format_stats(cache, rpc_rate, rpc_methods):
+    lines = [
+        f'Кэш торрентов: {cache["torrents"]} шт., попаданий {cache["hits"]}, промахов {cache["misses"]} ({cache["hit_ratio"] * 100:.1f}%)',
+        f'Синхронизаций: полных {cache["full_syncs"]}, инкрементальных {cache["delta_syncs"]}',
+        f'Списки: перестроений индекса {cache["index_builds"]}, загрузок страниц {cache["page_fetches"]}',
+        f'RPC: {rpc_rate:.2f} вызовов/с'
+    ]
+    for method, m in sorted(rpc_methods.items(), key=lambda item: -item[1]['calls']):
+        lines.append(f'{method}: {m["calls"]} ({m["errors"]} ошибок), {m["avg_ms"]:.1f} / {m["max_ms"]:.1f} мс, '
+                     f'⬆ {format_size(m["sent"])} ⬇ {format_size(m["received"])}')
+    return '\n'.join(lines)
+
+
+def format_profile(count, rows):
+    lines = [f'Профиль {count} обработчиков, суммарное / собственное время:']
+    for function, location, calls, total, cumulative in rows:
+        lines.append(f'`{cumulative * 1000:.1f}` / `{total * 1000:.1f}` мс, {calls} выз. — `{function} ({location})`')
+    return '\n'.join(lines)
+
+
+def format_ftp(addr, details, traffic=None):
     if details is None:
         return 'Доступ по FTP закрыт'
     login, password, timer = details
     timer_info = time.strftime('%H:%M:%S %Z', time.localtime(timer))
-    return f'Адрес: `{addr}`\nЛогин: `{login}`\nПароль: `{password}`\nДействует до: {timer_info}'
+    msg = f'Адрес: `{addr}`\nЛогин: `{login}`\nПароль: `{password}`\nДействует до: {timer_info}'
+    if traffic is not None:
+        sent, received, send_rate, recv_rate = traffic
+        msg += f'\nСкачано: {format_size(sent)} ({format_speed(send_rate)})'
+        if received:
+            msg += f'\nЗагружено: {format_size(received)} ({format_speed(recv_rate)})'
+    return msg
+
+
+def format_http(url, timer=None):
+    if url is None:
+        return 'Доступ по HTTP закрыт'
+    timer_info = time.strftime('%H:%M:%S %Z', time.localtime(timer))
+    msg = f'Ссылка: `{url}`\n'
+    if url.endswith('/'):  # directory
+        msg += f'Одним архивом: `{url}?archive`\n'
+    return msg + f'Действует до: {timer_info}'